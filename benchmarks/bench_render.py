@@ -0,0 +1,108 @@
+"""Compare the matplotlib and Pillow table backends of expense_viz.
+
+Every (backend, rows) case runs in a fresh process so that peak RSS
+includes the backend's imports.
+
+Usage: python benchmarks/bench_render.py [rows ...]
+"""
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bot'))
+
+COLUMNS = ['Date', 'User', 'Store', 'Amount', 'Currency', 'Amount EUR', 'Category']
+
+
+def make_rows(rows):
+    return [
+        (
+            '01/03/2025',
+            'user',
+            f'shop {i}',
+            round(random.uniform(1, 200), 2),
+            'EUR',
+            round(random.uniform(1, 200), 2),
+            'Grocery',
+        )
+        for i in range(rows)
+    ]
+
+
+def make_budget(months):
+    from categories import EXPENSE_CATEGORIES
+
+    return [
+        {
+            'month': month % 12 + 1,
+            **{
+                f'{cat}_{kind}': random.uniform(-100, 100)
+                for cat in EXPENSE_CATEGORIES + ['Total']
+                for kind in ('budget', 'actual', 'left')
+            },
+        }
+        for month in range(months)
+    ]
+
+
+def child(backend, rows):
+    start = time.perf_counter()
+    import expense_viz
+
+    import_s = time.perf_counter() - start
+    data = make_rows(rows)
+    start = time.perf_counter()
+    expense_viz.create_expense_table(data, COLUMNS, 'Bench', backend=backend)
+    expense_s = time.perf_counter() - start
+
+    # Five table rows per month
+    budget = make_budget(max(1, rows // 5))
+    start = time.perf_counter()
+    expense_viz.create_budget_table(budget, backend=backend)
+    budget_s = time.perf_counter() - start
+
+    print(json.dumps({
+        'backend': backend,
+        'rows': rows,
+        'import_ms': round(import_s * 1000, 1),
+        'expense_table_ms': round(expense_s * 1000, 1),
+        'budget_table_ms': round(budget_s * 1000, 1),
+        'peak_rss_mb': round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+    }))
+
+
+def main(sizes):
+    print(
+        f'{"backend":>10} {"rows":>6} {"import ms":>10} {"expense ms":>11} '
+        f'{"budget ms":>10} {"peak RSS MB":>12}'
+    )
+    for rows in sizes:
+        for backend in ('matplotlib', 'pillow'):
+            proc = subprocess.run(
+                [sys.executable, __file__, '--child', backend, str(rows)],
+                capture_output=True,
+                text=True,
+            )
+            if proc.returncode != 0:
+                error = proc.stderr.strip().splitlines()[-1]
+                print(f'{backend:>10} {rows:>6} failed: {error}')
+                continue
+            res = json.loads(proc.stdout)
+            print(
+                f'{backend:>10} {rows:>6} {res["import_ms"]:>10} '
+                f'{res["expense_table_ms"]:>11} {res["budget_table_ms"]:>10} '
+                f'{res["peak_rss_mb"]:>12}'
+            )
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2], int(sys.argv[3]))
+    else:
+        main([int(arg) for arg in sys.argv[1:]] or [10, 100, 1000])
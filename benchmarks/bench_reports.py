@@ -0,0 +1,121 @@
+"""Compare the legacy /actual + /top queries with the period report.
+
+Usage: python benchmarks/bench_reports.py [rows ...]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bot'))
+
+import database  # noqa: E402
+from categories import EXPENSE_CATEGORIES  # noqa: E402
+
+# The four statements /actual and /top used to run
+LEGACY_QUERIES = [
+    '''SELECT category, ROUND(SUM(amount_eur), 2) as total_amount
+       FROM expenses WHERE day >= ? AND category != 'Travel'
+       GROUP BY category ORDER BY total_amount DESC''',
+    '''SELECT ROUND(SUM(amount_eur), 2) as total_amount
+       FROM expenses WHERE day >= ? AND category != 'Travel\'''',
+    '''SELECT 'Travel' as category, ROUND(SUM(amount_eur), 2) as total_amount
+       FROM expenses WHERE day >= ? AND category = 'Travel\'''',
+    '''WITH RankedExpenses AS (
+           SELECT category, username, pos, ROUND(amount_eur, 2) as amount_eur,
+               ROW_NUMBER() OVER (
+                   PARTITION BY category ORDER BY amount_eur DESC
+               ) as rn
+           FROM expenses WHERE day >= ? AND category != 'Travel'
+       )
+       SELECT category, username, pos, amount_eur FROM RankedExpenses
+       WHERE rn <= 5 ORDER BY category, amount_eur DESC''',
+]
+
+
+def fill(rows):
+    today = datetime.now()
+    day, period = database._day_and_period(today)
+    data = [
+        (
+            today.strftime('%d/%m/%Y'),
+            random.choice(['alice', 'bob']),
+            f'shop {random.randrange(500)}',
+            amount,
+            'EUR',
+            amount,
+            random.choice(EXPENSE_CATEGORIES),
+            today.isoformat(),
+            day,
+            period,
+        )
+        for amount in (round(random.uniform(1, 200), 2) for _ in range(rows))
+    ]
+    with database.write_conn() as conn:
+        conn.executemany(
+            'INSERT INTO expenses (date, username, pos, amount, currency, '
+            'amount_eur, category, created_at, day, period) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            data,
+        )
+
+
+def count_scans(statements):
+    """Count table/index passes over expenses in the query plans."""
+    scans = 0
+    with database.read_conn() as conn:
+        for query, params in statements:
+            plan = conn.execute('EXPLAIN QUERY PLAN ' + query, params)
+            scans += sum(
+                1
+                for row in plan
+                if row[3].startswith(('SCAN expenses', 'SEARCH expenses'))
+            )
+    return scans
+
+
+def timed(func, repeat=20):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def run_legacy(start_day):
+    with database.read_conn() as conn:
+        for query in LEGACY_QUERIES:
+            conn.execute(query, (start_day,)).fetchall()
+
+
+def main(sizes):
+    start_day = database._period_start_day()
+    period = start_day // 100
+    print(f'{"rows":>10} {"legacy ms":>10} {"report ms":>10} scans')
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            database.DB_FILE = os.path.join(tmp, 'bench.db')
+            database.init_db()
+            fill(rows)
+
+            legacy_ms = timed(lambda: run_legacy(start_day))
+            report_ms = timed(lambda: database.get_period_report(start_day))
+            legacy_scans = count_scans(
+                (query, (start_day,)) for query in LEGACY_QUERIES
+            )
+            report_scans = count_scans([
+                (database.REPORT_QUERY, (start_day,)),
+                (database.ROLLUP_TOTALS_QUERY, (period, period * 100, start_day)),
+            ])
+            print(
+                f'{rows:>10} {legacy_ms:>10.2f} {report_ms:>10.2f} '
+                f'{legacy_scans} -> {report_scans}'
+            )
+            database.close_connections()
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,271 @@
+"""Time the hot paths of the bot on synthetic ledgers and write JSON.
+
+Every query function of database.py runs against databases filled by
+synthetic.py, followed by the write paths, message parsing and both
+table renderers. Everything runs offline: no bot token or API key is
+needed.
+
+Usage:
+    python benchmarks/bench_suite.py [--rows 10000 1000000] [--output FILE]
+    python benchmarks/bench_suite.py --compare OLD.json NEW.json
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bot'))
+
+import database  # noqa: E402
+import parsing  # noqa: E402
+import synthetic  # noqa: E402
+
+# Seconds spent repeating one benchmark, and its fewest and most runs
+TIME_BUDGET = 1.0
+MIN_RUNS = 3
+MAX_RUNS = 50
+# Table rows rendered by each backend
+RENDER_ROWS = (10, 100, 1000)
+# Ratio of median times reported as a regression by --compare
+REGRESSION_RATIO = 1.2
+
+
+def measure(func, min_runs=MIN_RUNS, max_runs=MAX_RUNS):
+    """Run func repeatedly and get the best and median time in ms."""
+    times = []
+    deadline = time.perf_counter() + TIME_BUDGET
+    while len(times) < min_runs or (
+        len(times) < max_runs and time.perf_counter() < deadline
+    ):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        'best_ms': round(min(times), 3),
+        'median_ms': round(statistics.median(times), 3),
+        'runs': len(times),
+    }
+
+
+def query_benchmarks():
+    """Read paths of database.py, as (name, function) pairs."""
+    today = datetime.now()
+    start_day = database._period_start_day()
+    return [
+        ('get_schema_version', database.get_schema_version),
+        ('get_meta', lambda: database.get_meta('commands_hash')),
+        ('get_export_watermark', lambda: database.get_export_watermark(1)),
+        ('get_change_cursor', database.get_change_cursor),
+        ('load_currency_codes', database.load_currency_codes),
+        ('get_latest_rates', database.get_latest_rates),
+        ('load_states', lambda: database.load_states('expense', 0)),
+        ('get_budget_status', lambda: database.get_budget_status(
+            'Grocery', today.year, today.month
+        )),
+        ('get_last_expenses', database.get_last_expenses),
+        ('get_pos_counts', database.get_pos_counts),
+        ('get_period_report', lambda: database.get_period_report(start_day)),
+        ('get_current_month_expenses', database.get_current_month_expenses),
+        ('get_top_expenses_per_category',
+         database.get_top_expenses_per_category),
+        ('get_budget_comparison', database.get_budget_comparison),
+    ]
+
+
+def write_benchmarks():
+    """Write paths of database.py; each run adds rows."""
+    batch = [('Lidl', 12.5, 'EUR', 12.5, 'Grocery', None)] * 100
+    counter = iter(range(10**9))
+
+    def import_rows():
+        now = datetime.now()
+        day, period = database._day_and_period(now)
+        database.import_expenses([
+            (
+                now.strftime('%d/%m/%Y'), 'bench', 'Lidl', 12.5, 'EUR', 12.5,
+                'Grocery', now.isoformat(), None, day, period,
+                f'bench-{next(counter)}',
+            )
+            for _ in range(1000)
+        ])
+
+    return [
+        ('add_expense', lambda: database.add_expense(
+            '01/03/2025', 'bench', 'Lidl', 12.5, 'EUR', 12.5, 'Grocery'
+        )),
+        ('add_expenses_100', lambda: database.add_expenses(
+            '01/03/2025', 'bench', batch
+        )),
+        ('import_expenses_1000', import_rows),
+        ('add_budget', lambda: database.add_budget(3, 'Grocery', 300)),
+        ('save_state', lambda: database.save_state(
+            'expense', 1, '{}', time.time()
+        )),
+    ]
+
+
+def ledger_results(rows):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_FILE = os.path.join(tmp, 'bench.db')
+        database.init_db()
+        start = time.perf_counter()
+        synthetic.fill(rows)
+        fill_s = time.perf_counter() - start
+        results.append({
+            'name': 'synthetic.fill',
+            'rows': rows,
+            'best_ms': round(fill_s * 1000, 1),
+            'median_ms': round(fill_s * 1000, 1),
+            'runs': 1,
+            'per_second': round(rows / fill_s),
+        })
+        for name, func in query_benchmarks() + write_benchmarks():
+            result = measure(func)
+            results.append({'name': f'database.{name}', 'rows': rows, **result})
+            print(
+                f'{rows:>10} {name:<32} {result["median_ms"]:>10.3f} ms',
+                file=sys.stderr,
+            )
+        # Scans every expense, so it is only run once
+        results.append({
+            'name': 'database.rebuild_rollups',
+            'rows': rows,
+            **measure(database.rebuild_rollups, min_runs=1, max_runs=1),
+        })
+        database.close_connections()
+    return results
+
+
+def parsing_results():
+    stores = synthetic.store_names()
+    lines = [
+        f'{i % 500 + 0.5} {stores[i % len(stores)]}'
+        + (' (usd)' if i % 5 == 0 else '')
+        for i in range(10000)
+    ]
+    batches = ['\n'.join(lines[i:i + 20]) for i in range(0, len(lines), 20)]
+
+    def parse_lines():
+        for line in lines:
+            parsing.parse_message(line)
+
+    def parse_batches():
+        for batch in batches:
+            parsing.parse_batch(batch)
+
+    results = []
+    for name, func in (
+        ('parsing.parse_message', parse_lines),
+        ('parsing.parse_batch', parse_batches),
+    ):
+        result = measure(func)
+        result['per_second'] = round(len(lines) / result['median_ms'] * 1000)
+        results.append({'name': name, 'rows': len(lines), **result})
+    return results
+
+
+def render_results():
+    """Time both renderers, each in a fresh process to measure peak RSS."""
+    script = os.path.join(os.path.dirname(__file__), 'bench_render.py')
+    results = []
+    for rows in RENDER_ROWS:
+        for backend in ('matplotlib', 'pillow'):
+            proc = subprocess.run(
+                [sys.executable, script, '--child', backend, str(rows)],
+                capture_output=True,
+                text=True,
+            )
+            if proc.returncode != 0:
+                error = proc.stderr.strip().splitlines()[-1]
+                print(f'{backend} {rows} rows failed: {error}', file=sys.stderr)
+                results.append({
+                    'name': f'expense_viz.{backend}',
+                    'rows': rows,
+                    'error': error,
+                })
+                continue
+            res = json.loads(proc.stdout)
+            for table in ('expense_table', 'budget_table'):
+                results.append({
+                    'name': f'expense_viz.{table}.{backend}',
+                    'rows': rows,
+                    'best_ms': res[f'{table}_ms'],
+                    'median_ms': res[f'{table}_ms'],
+                    'runs': 1,
+                    'peak_rss_mb': res['peak_rss_mb'],
+                })
+    return results
+
+
+def run(sizes):
+    results = []
+    for rows in sizes:
+        results.extend(ledger_results(rows))
+    results.extend(parsing_results())
+    results.extend(render_results())
+    return {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'sizes': sizes,
+        },
+        'results': results,
+    }
+
+
+def compare(old_file, new_file):
+    """Print the change of every median time between two result files."""
+    with open(old_file) as f:
+        old = {(r['name'], r['rows']): r for r in json.load(f)['results']}
+    with open(new_file) as f:
+        new = json.load(f)['results']
+    regressions = 0
+    print(f'{"benchmark":<44} {"rows":>10} {"old ms":>10} {"new ms":>10} ratio')
+    for result in new:
+        before = old.get((result['name'], result['rows']))
+        if not (before or {}).get('median_ms') or 'median_ms' not in result:
+            continue
+        ratio = result['median_ms'] / before['median_ms']
+        flag = ' slower' if ratio > REGRESSION_RATIO else ''
+        regressions += bool(flag)
+        print(
+            f'{result["name"]:<44} {result["rows"]:>10} '
+            f'{before["median_ms"]:>10.3f} {result["median_ms"]:>10.3f} '
+            f'{ratio:5.2f}{flag}'
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--rows', type=int, nargs='+', default=[10_000, 1_000_000],
+        help='ledger sizes to benchmark, e.g. 10000 1000000 10000000',
+    )
+    parser.add_argument('--output', help='write the JSON results to a file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare) else 0)
+
+    report = json.dumps(run(args.rows), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Fill a database with a synthetic ledger for benchmarks.
+
+Expenses span several years up to today, come from a few users and
+many stores of uneven popularity, and are paid in several currencies.
+Rows are generated and inserted in chunks, so even 10M rows fit in
+memory.
+
+Usage: python benchmarks/synthetic.py DB_FILE ROWS
+"""
+import itertools
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bot'))
+
+import database  # noqa: E402
+from categories import EXPENSE_CATEGORIES  # noqa: E402
+
+YEARS = 4
+USERS = ('alice', 'bob', 'carol')
+# Units per 1 EUR; most expenses are in EUR
+CURRENCIES = {'EUR': 1.0, 'USD': 1.08, 'GBP': 0.85, 'CHF': 0.95, 'PLN': 4.3}
+CURRENCY_WEIGHTS = (80, 8, 5, 4, 3)
+STORES = 2000
+CHUNK_SIZE = 100_000
+
+_WORDS = (
+    'pingo', 'doce', 'lidl', 'cafe', 'nata', 'pizza', 'hut', 'metro', 'uber',
+    'bolt', 'farmacia', 'central', 'mercado', 'casa', 'bar', 'kiosk',
+)
+
+
+def store_names(count=STORES, seed=1):
+    rng = random.Random(seed)
+    return [
+        f'{rng.choice(_WORDS).title()} {rng.choice(_WORDS).title()} {i}'
+        for i in range(count)
+    ]
+
+
+def generate(rows, seed=1):
+    """Yield expense rows in the column order of fill()."""
+    rng = random.Random(seed)
+    stores = store_names(seed=seed)
+    # A few stores get most of the expenses
+    store_weights = list(itertools.accumulate(
+        1 / (rank + 1) for rank in range(len(stores))
+    ))
+    store_categories = [rng.choice(EXPENSE_CATEGORIES) for _ in stores]
+    currencies = list(CURRENCIES)
+    currency_weights = list(itertools.accumulate(CURRENCY_WEIGHTS))
+    now = datetime.now()
+    span = YEARS * 365 * 24 * 3600
+    for _ in range(rows):
+        when = now - timedelta(seconds=rng.randrange(span))
+        store = rng.choices(range(len(stores)), cum_weights=store_weights)[0]
+        currency = rng.choices(currencies, cum_weights=currency_weights)[0]
+        amount = round(rng.lognormvariate(2.5, 1.0), 2)
+        day, period = database._day_and_period(when)
+        yield (
+            when.strftime('%d/%m/%Y'),
+            rng.choice(USERS),
+            stores[store],
+            amount,
+            currency,
+            round(amount / CURRENCIES[currency], 2),
+            store_categories[store],
+            when.isoformat(),
+            when.date().isoformat(),
+            day,
+            period,
+        )
+
+
+def fill(rows, seed=1):
+    """Insert rows expenses, a year of budgets and exchange rates."""
+    expenses = generate(rows, seed)
+    while True:
+        chunk = [row for _, row in zip(range(CHUNK_SIZE), expenses)]
+        if not chunk:
+            break
+        with database.write_conn() as conn:
+            conn.executemany(
+                'INSERT INTO expenses (date, username, pos, amount, currency, '
+                'amount_eur, category, created_at, rate_date, day, period) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                chunk,
+            )
+
+    rng = random.Random(seed)
+    for month in range(1, 13):
+        for category in EXPENSE_CATEGORIES:
+            database.add_budget(month, category, rng.randrange(50, 800, 50))
+    database.save_currency_codes(set(CURRENCIES))
+    database.save_rates(datetime.now().date().isoformat(), CURRENCIES)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(__doc__.strip().splitlines()[-1])
+    database.DB_FILE = sys.argv[1]
+    database.init_db()
+    start = time.perf_counter()
+    fill(int(sys.argv[2]))
+    database.close_connections()
+    print(f'{sys.argv[2]} rows in {time.perf_counter() - start:.1f} s')
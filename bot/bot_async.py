@@ -0,0 +1,146 @@
+"""Run the bot on AsyncTeleBot.
+
+Updates are received by an asyncio long-polling loop and handed to the
+regular handlers of bot_main, which run off the event loop: report
+commands on a pool of render workers, everything else (expense entry,
+conversations and database writes) in order on a single main worker.
+Currency codes and rates are refreshed on the loop with aiohttp.
+"""
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot.async_telebot import AsyncTeleBot
+
+import currencyapi
+
+# Threads rendering report tables in parallel
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', 2))
+# Commands that only read the database and render or export a report
+REPORT_COMMANDS = frozenset({'last', 'actual', 'top', 'get_budget', 'dump'})
+
+
+def _chat_id(update):
+    if update.message is not None:
+        return update.message.chat.id
+    if update.callback_query is not None and update.callback_query.message:
+        return update.callback_query.message.chat.id
+    return None
+
+
+def _command(update):
+    message = update.message
+    if message is None or not message.text or not message.text.startswith('/'):
+        return None
+    return message.text.split()[0][1:].split('@')[0].lower()
+
+
+class UpdateRouter:
+    """Run updates through a synchronous TeleBot on two executors.
+
+    The main executor has a single thread, so expense entry and the
+    conversation state of bot_main are only touched by one thread and
+    keep the order updates arrived in. Report commands go to the render
+    pool, unless the chat is in the middle of a conversation, and so do
+    inline queries.
+    """
+
+    def __init__(self, bot, render_workers=RENDER_WORKERS, in_conversation=None):
+        self.bot = bot
+        self.in_conversation = in_conversation
+        # Handlers must run in the executor thread, not in TeleBot's pool
+        self.bot.threaded = False
+        self.main_executor = ThreadPoolExecutor(
+            1, thread_name_prefix='bot-main'
+        )
+        self.render_executor = ThreadPoolExecutor(
+            render_workers, thread_name_prefix='bot-render'
+        )
+
+    def _in_conversation(self, update):
+        if self.in_conversation is None:
+            return False
+        return self.in_conversation(_chat_id(update))
+
+    def executor_for(self, update):
+        # Inline queries only read in-memory indexes and must answer fast
+        if update.inline_query is not None:
+            return self.render_executor
+        if _command(update) in REPORT_COMMANDS and not self._in_conversation(update):
+            return self.render_executor
+        return self.main_executor
+
+    def _process(self, update):
+        try:
+            self.bot.process_new_updates([update])
+        except Exception:
+            logging.exception(f'Error processing update {update.update_id}')
+
+    def submit(self, update):
+        """Schedule an update and return its Future."""
+        return self.executor_for(update).submit(self._process, update)
+
+    def shutdown(self):
+        self.render_executor.shutdown(wait=True)
+        self.main_executor.shutdown(wait=True)
+
+
+class ForwardingBot(AsyncTeleBot):
+    """AsyncTeleBot that passes every received update to an UpdateRouter."""
+
+    def __init__(self, token, router):
+        super().__init__(token)
+        self.router = router
+
+    async def process_new_updates(self, updates):
+        for update in updates:
+            self.router.submit(update)
+
+
+async def _refresh_periodically(refresh, fresh_for, interval, session,
+                                executor):
+    # Data stored by the previous run is used until it goes stale, so a
+    # restart does not spend API quota on a refetch
+    loop = asyncio.get_running_loop()
+    await asyncio.sleep(await loop.run_in_executor(executor, fresh_for))
+    while True:
+        await refresh(session, executor)
+        await asyncio.sleep(interval)
+
+
+async def _run(bot, in_conversation):
+    import aiohttp
+
+    router = UpdateRouter(bot, in_conversation=in_conversation)
+    poller = ForwardingBot(bot.token, router)
+    async with aiohttp.ClientSession() as session:
+        # Stale data must not start sync refreshes racing the loops below
+        currencyapi.set_background_refresh(False)
+        refreshers = [
+            asyncio.create_task(_refresh_periodically(
+                currencyapi.refresh_currency_codes_async,
+                currencyapi.codes_fresh_for, currencyapi.CODES_TTL,
+                session, router.main_executor,
+            )),
+            asyncio.create_task(_refresh_periodically(
+                currencyapi.refresh_rates_async,
+                currencyapi.rates_fresh_for, currencyapi.RATES_TTL,
+                session, router.main_executor,
+            )),
+        ]
+        try:
+            await poller.infinity_polling(skip_pending=True)
+        finally:
+            for task in refreshers:
+                task.cancel()
+            currencyapi.set_background_refresh(True)
+            router.shutdown()
+
+
+def run(bot, in_conversation=None):
+    """Serve the handlers registered on the synchronous bot asynchronously.
+
+    in_conversation(chat_id) tells whether a chat waits for a reply.
+    """
+    asyncio.run(_run(bot, in_conversation))
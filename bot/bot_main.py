@@ -1,28 +1,38 @@
+import hashlib
+import html
 import io
 import logging
 import os
-import re
+import threading
+import time
 from datetime import date, datetime
-from http import HTTPStatus
-import sqlite3
 
-import matplotlib.pyplot as plt
-import pandas as pd
 import requests
+import urllib3
 from dotenv import load_dotenv
 from telebot import TeleBot, types
+from telebot.apihelper import ApiTelegramException
 from telebot.util import quick_markup
 
+import currencyapi
+import dispatcher
 import keyboards
 import expense_viz
+import export
+import importer
 import database
+import merchants
 import messages
+import metrics
+import outbox
+import parsing
+import profiling
+import render_cache
+import state_store
+import webhook
 from categories import EXPENSE_CATEGORIES
-from exceptions import (
-    NoApiResponseError,
-    NoCredentialsError,
-    ServerResponseError,
-)
+from exceptions import NoCredentialsError
+from parsing import TRANS_REGEX, parse_message
 
 load_dotenv()
 
@@ -34,17 +44,48 @@ logging.basicConfig(
 )
 
 bot = TeleBot(token=os.getenv('BOT_TOKEN'))
+# Messages are sent through a rate-limited queue once main() starts it
+send_queue = outbox.Outbox(bot)
+
+# Seconds after start-up to import and warm the table renderer; -1 disables
+PREWARM_DELAY = float(os.getenv('PREWARM_DELAY', 2))
+# How updates are received and handled: polling, async or webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+BOT_MODES = ('polling', 'async', 'webhook')
+# Chat allowed to use /profile and receiving the captured profiles
+ADMIN_CHAT_ID = int(os.getenv('ADMIN_CHAT_ID', 0))
+
+# Conversations in progress, per chat
+pending_expenses = state_store.StateStore('expense', state_store.PendingExpense)
+budget_sessions = state_store.StateStore('budget', state_store.BudgetSession)
+pending_batches = state_store.StateStore('batch', state_store.PendingBatch)
+# Categories suggested from the history of each store
+category_index = merchants.CategoryIndex()
+# Store names suggested in inline mode
+pos_index = merchants.PrefixIndex()
+# Seconds Telegram may cache the answer to an inline query
+INLINE_CACHE_TIME = 30
+
+
+def _waiting_step(chat_id):
+    """Get the store and record of a chat that waits for a text reply."""
+    candidates = [
+        (store.updated_at(chat_id), store, record)
+        for store in (pending_expenses, budget_sessions, pending_batches)
+        for record in (store.get(chat_id),)
+        if record is not None and record.step in TEXT_STEPS[store.kind]
+    ]
+    if not candidates:
+        return None
+    _, store, record = max(candidates, key=lambda item: item[0])
+    return store, record
 
-TRANS_REGEX = r'^(\d+(?:[.,]\d+)?)\s+(.*?)(?:\s+\(([^)]+)\))?$'
-DEFAULT_CURRENCY = 'EUR'
-TARGET_CUR = 'EUR'
-RATES_URL = 'https://api.currencyapi.com/v3/latest'
-CURR_URL = 'https://api.currencyapi.com/v3/currencies'
-
-data_to_write = {}
 
-# Dictionary to store budget setting state for users
-budget_state = {}
+@bot.message_handler(func=lambda message: _waiting_step(message.chat.id) is not None)
+def continue_conversation(message):
+    """Pass a reply to the step of the conversation waiting for it."""
+    store, record = _waiting_step(message.chat.id)
+    STEP_HANDLERS[store.kind, record.step](message, record)
 
 
 @bot.message_handler(commands=['start'])
@@ -52,7 +93,7 @@ def start_message(message):
     chat_id = message.chat.id
 
     message = messages.WELCOME_MESSAGE
-    bot.send_message(chat_id, message)
+    send_queue.send_message(chat_id, message)
 
 
 @bot.message_handler(commands=['last'])
@@ -69,15 +110,21 @@ def last_expenses(message):
             'Amount EUR',
             'Category',
         ]
-        buf = expense_viz.create_expense_table(data, columns, 'Last 10 Expenses')
-        bot.send_photo(chat_id, buf, caption='Here are your last 10 expenses:')
+        send_table(
+            chat_id,
+            'Here are your last 10 expenses:',
+            expense_viz.create_expense_table,
+            data,
+            columns,
+            'Last 10 Expenses',
+        )
 
     except Exception as e:
         logging.exception(
             f"""Error in last_expenses handler for chat_id={message.chat.id}.
             Error = {e}"""
         )
-        bot.send_message(
+        send_queue.send_message(
             message.chat.id,
             'An error occurred while getting the last expenses.',
         )
@@ -87,24 +134,26 @@ def last_expenses(message):
 def actual_expenses(message):
     chat_id = message.chat.id
     try:
-        data, total, travel_amount = database.get_current_month_expenses()
+        report = database.get_period_report(top_n=0)
         columns = ['Category', 'Total Amount (EUR)']
-        buf = expense_viz.create_expense_table(
-            data, 
-            columns, 
+        send_table(
+            chat_id,
+            'Here are your current month expenses by category:',
+            expense_viz.create_expense_table,
+            report.category_totals,
+            columns,
             'Current Month Expenses',
             include_total=True,
-            total=total,
-            travel_data=travel_amount
+            total=report.total,
+            travel_data=report.travel_total
         )
-        bot.send_photo(chat_id, buf, caption='Here are your current month expenses by category:')
 
     except Exception as e:
         logging.exception(
             f"""Error in actual_expenses handler for chat_id={message.chat.id}.
             Error = {e}"""
         )
-        bot.send_message(
+        send_queue.send_message(
             message.chat.id,
             'An error occurred while getting the current month expenses.',
         )
@@ -114,132 +163,154 @@ def actual_expenses(message):
 def top_expenses(message):
     chat_id = message.chat.id
     try:
-        data = database.get_top_expenses_per_category()
+        report = database.get_period_report(top_n=5)
         columns = ['Category', 'User', 'Store', 'Amount (EUR)']
-        buf = expense_viz.create_expense_table(data, columns, 'Top 5 Expenses per Category')
-        bot.send_photo(chat_id, buf, caption='Here are top 5 expenses per category:')
+        send_table(
+            chat_id,
+            'Here are top 5 expenses per category:',
+            expense_viz.create_expense_table,
+            report.top_expenses,
+            columns,
+            'Top 5 Expenses per Category',
+        )
 
     except Exception as e:
         logging.exception(
             f"""Error in top_expenses handler for chat_id={message.chat.id}.
             Error = {e}"""
         )
-        bot.send_message(
+        send_queue.send_message(
             message.chat.id,
             'An error occurred while getting the top expenses.',
         )
 
 
+def send_table(chat_id, caption, renderer, *args, **kwargs):
+    """Render a table image and send it, reusing cached renders and uploads.
+
+    Returns the sent message, or None if the renderer had nothing to draw.
+    """
+    key = render_cache.make_key(renderer.__name__, *args, **kwargs)
+    file_id = render_cache.get_file_id(key)
+    if file_id is not None:
+        try:
+            return send_queue.call(
+                'send_photo', chat_id, file_id, caption=caption
+            )
+        except ApiTelegramException:
+            render_cache.forget_file_id(key)
+
+    data = render_cache.get(key)
+    if data is None:
+        buf = renderer(*args, **kwargs)
+        if buf is None:
+            return None
+        data = buf.getvalue()
+        render_cache.put(key, data)
+
+    msg = send_queue.call('send_photo', chat_id, data, caption=caption)
+    render_cache.put_file_id(key, msg.photo[-1].file_id)
+    return msg
+
+
 @bot.message_handler(commands=['add_budget'])
 def start_budget_setup(message):
     """Start the budget setup process."""
     chat_id = message.chat.id
     
     # Initialize state for this user
-    budget_state[chat_id] = {
-        'month': None,
-        'current_category': None,
-        'budgets': {}
-    }
+    budget_sessions.put(chat_id, state_store.BudgetSession(step='month'))
     
     markup = keyboards.get_stop_markup()
-    msg = bot.send_message(
+    send_queue.send_message(
         chat_id,
         "Please enter the month (1-12) for which you want to set the budget:",
         reply_markup=markup
     )
-    bot.register_next_step_handler(msg, process_month)
 
 
-def process_month(message):
+def process_month(message, state):
     """Process the month input and start category budget setup."""
     chat_id = message.chat.id
     
     try:
         month = int(message.text)
         if 1 <= month <= 12:
-            budget_state[chat_id]['month'] = month
-            start_category_budget(chat_id)
+            state.month = month
+            start_category_budget(chat_id, state)
         else:
             markup = keyboards.get_stop_markup()
-            msg = bot.send_message(
+            send_queue.send_message(
                 chat_id,
                 "Please enter a valid month (1-12):",
                 reply_markup=markup
             )
-            bot.register_next_step_handler(msg, process_month)
     except ValueError:
         markup = keyboards.get_stop_markup()
-        msg = bot.send_message(
+        send_queue.send_message(
             chat_id,
             "Please enter a valid month number (1-12):",
             reply_markup=markup
         )
-        bot.register_next_step_handler(msg, process_month)
 
 
-def start_category_budget(chat_id):
+def start_category_budget(chat_id, state):
     """Start the process of setting budget for each category."""
-    state = budget_state[chat_id]
-    
     # Find the next category that needs a budget
     next_category = None
     for category in EXPENSE_CATEGORIES:
-        if category not in state['budgets']:
+        if category not in state.budgets:
             next_category = category
             break
     
     if next_category:
-        state['current_category'] = next_category
+        state.current_category = next_category
+        state.step = 'amount'
+        budget_sessions.put(chat_id, state)
         markup = keyboards.get_stop_markup()
-        msg = bot.send_message(
+        send_queue.send_message(
             chat_id,
             f"Enter budget amount in EUR for {next_category}:",
             reply_markup=markup
         )
-        bot.register_next_step_handler(msg, process_category_budget)
     else:
         # All categories are done
-        save_budgets(chat_id)
+        save_budgets(chat_id, state)
 
 
-def process_category_budget(message):
+def process_category_budget(message, state):
     """Process the budget amount for a category."""
     chat_id = message.chat.id
-    state = budget_state[chat_id]
     
     try:
         amount = float(message.text)
         if amount >= 0:
-            state['budgets'][state['current_category']] = round(amount, 2)
-            start_category_budget(chat_id)  # Move to next category
+            state.budgets[state.current_category] = round(amount, 2)
+            start_category_budget(chat_id, state)  # Move to next category
         else:
             markup = keyboards.get_stop_markup()
-            msg = bot.send_message(
+            send_queue.send_message(
                 chat_id,
                 "Please enter a non-negative amount:",
                 reply_markup=markup
             )
-            bot.register_next_step_handler(msg, process_category_budget)
     except ValueError:
         markup = keyboards.get_stop_markup()
-        msg = bot.send_message(
+        send_queue.send_message(
             chat_id,
             "Please enter a valid number:",
             reply_markup=markup
         )
-        bot.register_next_step_handler(msg, process_category_budget)
 
 
-def save_budgets(chat_id):
+def save_budgets(chat_id, state):
     """Save all budget targets to the database."""
-    state = budget_state[chat_id]
     success = True
     error_msg = None
     
     try:
-        for category, amount in state['budgets'].items():
-            if not database.add_budget(state['month'], category, amount):
+        for category, amount in state.budgets.items():
+            if not database.add_budget(state.month, category, amount):
                 success = False
                 error_msg = f"Failed to save budget for category {category}"
                 break
@@ -253,20 +324,20 @@ def save_budgets(chat_id):
         )
     
     if success:
-        bot.send_message(
+        send_queue.send_message(
             chat_id,
-            f"Budget targets for month {state['month']} have been saved successfully!",
+            f"Budget targets for month {state.month} have been saved successfully!",
             reply_markup=types.ReplyKeyboardRemove()
         )
     else:
-        bot.send_message(
+        send_queue.send_message(
             chat_id,
             f"An error occurred while saving the budget targets: {error_msg}",
             reply_markup=types.ReplyKeyboardRemove()
         )
     
     # Clean up state
-    budget_state.pop(chat_id, None)
+    budget_sessions.pop(chat_id)
 
 
 @bot.callback_query_handler(func=lambda call: call.data == 'stop_budget')
@@ -275,11 +346,11 @@ def handle_budget_stop(call):
     chat_id = call.message.chat.id
     
     # Clean up state
-    budget_state.pop(chat_id, None)
+    budget_sessions.pop(chat_id)
     
-    bot.answer_callback_query(call.id)
-    bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=None)
-    bot.send_message(
+    send_queue.answer_callback_query(chat_id, call.id)
+    send_queue.edit_message_reply_markup(chat_id, call.message.message_id)
+    send_queue.send_message(
         chat_id,
         "Budget setup has been cancelled.",
         reply_markup=types.ReplyKeyboardRemove()
@@ -288,26 +359,33 @@ def handle_budget_stop(call):
 
 @bot.message_handler(commands=['get_budget'])
 def get_budget(message):
-    """Send budget comparison table to the user."""
+    """Send budget comparison table to the user.
+
+    An optional year can be passed, e.g. /get_budget 2024.
+    """
     chat_id = message.chat.id
+    args = message.text.split()[1:]
+    if args and not (args[0].isdigit() and len(args[0]) == 4):
+        send_queue.send_message(chat_id, 'Please specify the year like this: /get_budget 2024')
+        return
+    year = int(args[0]) if args else datetime.now().year
     try:
-        data = database.get_budget_comparison()
+        data = database.get_budget_comparison(year)
         if not data:
-            bot.send_message(
+            send_queue.send_message(
                 chat_id,
-                'No budget or expense data found for this year.'
+                f'No budget or expense data found for {year}.'
             )
             return
 
-        buf = expense_viz.create_budget_table(data)
-        if buf:
-            bot.send_photo(
-                chat_id,
-                buf,
-                caption='Budget vs Actual Expenses Comparison'
-            )
-        else:
-            bot.send_message(
+        sent = send_table(
+            chat_id,
+            f'Budget vs Actual Expenses Comparison, {year}',
+            expense_viz.create_budget_table,
+            data,
+        )
+        if not sent:
+            send_queue.send_message(
                 chat_id,
                 'No data to display.'
             )
@@ -318,78 +396,366 @@ def get_budget(message):
             f"""Error in get_budget handler for chat_id={message.chat.id}.
             Error details: {error_msg}"""
         )
-        bot.send_message(
+        send_queue.send_message(
             message.chat.id,
             f'An error occurred while getting the budget comparison: {error_msg}',
         )
 
 
+@bot.message_handler(func=lambda message: parsing.is_batch(message.text))
+def check_message_for_batch(message):
+    """Handle a message with one expense per line."""
+    chat_id = message.chat.id
+    expenses, errors = parsing.parse_batch(message.text)
+    if not expenses:
+        send_queue.send_message(chat_id, messages.NOT_TRANSACTION)
+        return
+    if len(expenses) + len(errors) > parsing.MAX_BATCH_LINES:
+        send_queue.send_message(
+            chat_id, messages.BATCH_TOO_LONG.format(parsing.MAX_BATCH_LINES)
+        )
+        return
+    if errors:
+        lines = '\n'.join(f'{number}: {line}' for number, line in errors)
+        send_queue.send_message(chat_id, f'{messages.BATCH_ERRORS}\n{lines}')
+        return
+
+    try:
+        unknown = convert_batch(expenses)
+    except Exception as err:
+        send_queue.send_message(chat_id, err)
+        return
+    if unknown:
+        send_queue.send_message(
+            chat_id, messages.BATCH_UNKNOWN_CURRENCY.format(', '.join(unknown))
+        )
+        return
+
+    for expense in expenses:
+        expense['predicted'] = None
+        if expense['category'] is None:
+            expense['category'] = expense['predicted'] = (
+                category_index.predict(expense['pos'])
+            )
+    confirm_batch(chat_id, state_store.PendingBatch(expenses))
+
+
+def convert_batch(expenses):
+    """Add EUR amounts with one rate lookup per distinct currency.
+
+    Returns the sorted list of currencies that are not known.
+    """
+    rates = {}
+    for expense in expenses:
+        currency = expense['currency']
+        if currency not in rates:
+            if currency == 'EUR':
+                rates[currency] = (1.0, None)
+            elif currencyapi.is_known_currency(currency):
+                rates[currency] = currencyapi.convert(1.0, currency)
+            else:
+                rates[currency] = None
+        if rates[currency] is not None:
+            rate, rate_date = rates[currency]
+            expense['sum_in_eur'] = round(expense['sum'] * rate, 2)
+            expense['rate_date'] = rate_date
+    return sorted(currency for currency, rate in rates.items() if rate is None)
+
+
+def confirm_batch(chat_id, batch, remove_keyboard=False):
+    """Ask for missing categories, then for approval of the whole batch.
+
+    Categories are asked once per store, so a batch mixing groceries and
+    a taxi ride doesn't end up under one category.
+    """
+    pos = _uncategorized_pos(batch)
+    if pos is not None:
+        batch.step = 'category'
+        pending_batches.put(chat_id, batch)
+        send_queue.send_message(
+            chat_id,
+            messages.BATCH_CATEGORY.format(pos),
+            reply_markup=keyboards.category_keyboard(),
+        )
+        return
+
+    batch.step = 'approval'
+    pending_batches.put(chat_id, batch)
+    lines = [
+        f"{html.escape(item['pos'])}: {item['sum']} {item['currency']}, "
+        f"{item['sum_in_eur']:.2f} EUR, {item['category']}"
+        for item in batch.items
+    ]
+    total = sum(item['sum_in_eur'] for item in batch.items)
+    message_text = '\n'.join(
+        lines + [f'<b>Total</b>: {total:.2f} EUR', '', 'Is everything correct?']
+    )
+    markup = quick_markup(
+        {
+            'Yes': {'callback_data': 'approve_batch'},
+            'No': {'callback_data': 'decline_batch'},
+        },
+        row_width=2,
+    )
+    if remove_keyboard:
+        send_queue.send_message(
+            chat_id,
+            messages.BATCH_SUMMARY,
+            reply_markup=types.ReplyKeyboardRemove(),
+        )
+    send_queue.send_message(chat_id, message_text, 'HTML', reply_markup=markup)
+
+
+def _uncategorized_pos(batch):
+    """Get the store of the first batch item without a category, if any."""
+    for item in batch.items:
+        if item['category'] is None:
+            return item['pos']
+    return None
+
+
+def get_batch_category(message, batch):
+    """Set the category of the items of the store that was asked about."""
+    pos = _uncategorized_pos(batch).lower()
+    for item in batch.items:
+        if item['category'] is None and item['pos'].lower() == pos:
+            item['category'] = message.text
+    confirm_batch(message.chat.id, batch, remove_keyboard=True)
+
+
+@bot.callback_query_handler(
+    func=lambda call: call.data in ('approve_batch', 'decline_batch')
+)
+def batch_callback_query(call):
+    """Save or drop all expenses of a batch."""
+    chat_id = call.message.chat.id
+    batch = pending_batches.get(chat_id)
+    if batch is None or batch.step != 'approval':
+        send_queue.answer_callback_query(chat_id, call.id, messages.EXPENSE_EXPIRED)
+        send_queue.delete_message(chat_id, call.message.id)
+        return
+
+    if call.data == 'decline_batch':
+        pending_batches.pop(chat_id)
+        send_queue.answer_callback_query(chat_id, call.id, 'Declined')
+        send_queue.delete_message(chat_id, call.message.id)
+        send_queue.send_message(chat_id, messages.TRANSACTION_DELETED)
+        return
+
+    database.add_expenses(
+        date.today().strftime('%d/%m/%Y'),
+        call.from_user.username,
+        [
+            (
+                item['pos'],
+                item['sum'],
+                item['currency'],
+                item['sum_in_eur'],
+                item['category'],
+                item.get('rate_date'),
+            )
+            for item in batch.items
+        ],
+    )
+    for item in batch.items:
+        category_index.add(item['pos'], item['category'], item.get('predicted'))
+        pos_index.add(item['pos'], item['category'], item['currency'])
+    pending_batches.pop(chat_id)
+    send_queue.answer_callback_query(chat_id, call.id, 'Approved')
+    send_queue.delete_message(chat_id, call.message.id)
+    send_queue.send_message(chat_id, messages.BATCH_SAVED.format(len(batch.items)))
+    for category in dict.fromkeys(item['category'] for item in batch.items):
+        check_budget_status(chat_id, category, None)
+
+
 @bot.message_handler(regexp=TRANS_REGEX)
 def check_message_for_transaction(message):
     chat_id = message.chat.id
-    trans_data = parse_message(message.text)
+    trans_data = state_store.PendingExpense(**parse_message(message.text))
+    trans_data.category = trans_data.predicted = category_index.predict(
+        trans_data.pos
+    )
     try:
-        if trans_data['currency'] == 'EUR':
-            trans_data['sum_in_eur'] = trans_data['sum']
+        if trans_data.currency == 'EUR':
+            trans_data.sum_in_eur = trans_data.sum
             write_transaction(message, trans_data)
-        elif trans_data['currency'] not in get_currency_codes():
-            check_currency_code(message, trans_data)
+        elif not currencyapi.is_known_currency(trans_data.currency):
+            trans_data.step = 'currency'
+            pending_expenses.put(chat_id, trans_data)
+            send_queue.send_message(chat_id, messages.UNKNOWN_CURRENCY)
         else:
-            sum_in_eur = get_rate(trans_data['currency']) * trans_data['sum']
-            trans_data['sum_in_eur'] = round(sum_in_eur, 2)
+            convert_to_eur(trans_data)
             write_transaction(message, trans_data)
     except Exception as err:
-        bot.send_message(chat_id, err)
+        send_queue.send_message(chat_id, err)
+
+
+@bot.inline_handler(func=lambda query: True)
+def suggest_stores(query):
+    """Suggest known stores for "@bot 12.5 pin" from the in-memory index."""
+    parsed = parsing.parse_inline_query(query.query)
+    results = []
+    if parsed is not None:
+        amount, prefix = parsed
+        for i, (pos, category, currency) in enumerate(pos_index.suggest(prefix)):
+            text = parsing.inline_expense_text(amount, pos, currency)
+            results.append(types.InlineQueryResultArticle(
+                id=str(i),
+                title=pos,
+                description=f'{amount} {currency}, {category}',
+                input_message_content=types.InputTextMessageContent(text),
+            ))
+    bot.answer_inline_query(
+        query.id, results, cache_time=INLINE_CACHE_TIME, is_personal=True
+    )
 
 
-@bot.message_handler(commands=['dump'])
-def dump_data(message):
-    """Send Excel file with complete database dump."""
+@bot.message_handler(commands=['import'])
+def import_usage(message):
+    send_queue.send_message(message.chat.id, messages.IMPORT_USAGE)
+
+
+@bot.message_handler(content_types=['document'])
+def import_document(message):
+    """Import expenses from a CSV document sent with an /import caption."""
     chat_id = message.chat.id
+    caption = message.caption or ''
+    if caption.split()[:1] != ['/import']:
+        send_queue.send_message(chat_id, messages.IMPORT_USAGE)
+        return
     try:
-        # Create Excel writer
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            # Get expenses data
-            conn = sqlite3.connect('expenses.db')
-            
-            # Dump expenses table
-            expenses_df = pd.read_sql_query(
-                'SELECT * FROM expenses ORDER BY created_at DESC', 
-                conn
+        options = importer.parse_options(caption.split()[1:])
+    except ValueError as e:
+        send_queue.send_message(chat_id, f'{e}\n\n{messages.IMPORT_USAGE}')
+        return
+
+    status = send_queue.call('send_message', chat_id, 'Importing...')
+
+    def report(result, done=False):
+        text = f'{"Imported" if done else "Importing"}: {result}'
+        send_queue.edit_message_text(text, chat_id, status.message_id)
+
+    try:
+        # The file is streamed instead of being downloaded into memory
+        url = bot.get_file_url(message.document.file_id)
+        with requests.get(url, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            text = io.TextIOWrapper(
+                response.raw, encoding=options.encoding, newline=''
             )
-            expenses_df.to_excel(writer, sheet_name='Expenses', index=False)
-            
-            # Dump planned_expenses table
-            budget_df = pd.read_sql_query(
-                'SELECT * FROM planned_expenses ORDER BY month, category', 
-                conn
+            result = importer.import_csv(
+                text, options, message.from_user.username, progress=report
             )
-            budget_df.to_excel(writer, sheet_name='Budget', index=False)
-            
-            conn.close()
-        
-        # Prepare the file for sending
-        output.seek(0)
-        
-        # Send the file
-        bot.send_document(
-            chat_id,
-            ('database_dump.xlsx', output),
-            caption='Complete database dump'
+        report(result, done=True)
+        if result.imported:
+            merchants.load_indexes(category_index, pos_index)
+    except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+        # The file URL holds the bot token, so the error text is kept out
+        # of the chat and the log
+        logging.warning(f'Failed to download an import file: {type(e).__name__}')
+        send_queue.edit_message_text(
+            messages.IMPORT_DOWNLOAD_FAILED, chat_id, status.message_id
         )
-        
+    except ValueError as e:
+        # A wrong column mapping, number or encoding in the file
+        send_queue.edit_message_text(
+            f'The import failed: {e}', chat_id, status.message_id
+        )
+    except Exception:
+        logging.exception('Error importing expenses')
+        send_queue.edit_message_text(
+            messages.IMPORT_FAILED, chat_id, status.message_id
+        )
+
+
+@bot.message_handler(commands=['dump'])
+def dump_data(message):
+    """Send a database dump.
+
+    Usage: /dump [since|full] [xlsx|csv|jsonl] [from=YYYY-MM-DD]
+    [to=YYYY-MM-DD] [columns=date,pos,...]
+
+    "since" only exports rows added or changed since the last "since" or
+    "full" dump to this chat; both move the chat's watermark forward, so
+    they are refused for csv (no budgets) and with filters.
+    """
+    chat_id = message.chat.id
+    args = message.text.split()[1:]
+    mode = None
+    if args and args[0].lower() in ('since', 'full'):
+        mode = args.pop(0).lower()
+    try:
+        options = export.parse_options(args)
+    except ValueError as e:
+        send_queue.send_message(chat_id, f'{e}\n\n{messages.DUMP_USAGE}')
+        return
+    if mode and not options.is_complete():
+        send_queue.send_message(chat_id, messages.DUMP_MODE_PARTIAL)
+        return
+
+    try:
+        caption = 'Complete database dump'
+        if mode:
+            options.upto = database.get_change_cursor()
+        if mode == 'since':
+            options.after = database.get_export_watermark(chat_id)
+            if options.after == options.upto:
+                send_queue.send_message(chat_id, messages.DUMP_NO_CHANGES)
+                return
+            caption = 'Changes since the last dump'
+
+        file_name, output = export.export(options)
+        with output:
+            send_queue.call(
+                'send_document',
+                chat_id,
+                (file_name, output),
+                caption=caption
+            )
+        if mode:
+            database.set_export_watermark(chat_id, options.upto)
+
     except Exception as e:
         logging.exception("Error creating database dump")
-        bot.send_message(
+        send_queue.send_message(
             chat_id,
             f'An error occurred while creating the database dump: {str(e)}'
         )
 
 
+@bot.message_handler(
+    commands=['profile'],
+    func=lambda message: message.chat.id == ADMIN_CHAT_ID,
+)
+def profile_command(message):
+    """Request profile captures or show the profiling status."""
+    args = message.text.split()[1:]
+    if args:
+        try:
+            kind, value = args
+            if kind == 'slow':
+                profiling.set_slow_query_ms(float(value))
+            else:
+                profiling.request(kind, int(value))
+        except ValueError:
+            send_queue.send_message(message.chat.id, messages.PROFILE_USAGE)
+            return
+    send_queue.send_message(message.chat.id, profiling.status())
+
+
+# Registered last, so that it only gets texts no other handler takes
 @bot.message_handler(func=lambda message: True)
 def send_basic_message(message):
-    bot.send_message(message.chat.id, messages.NOT_TRANSACTION)
+    send_queue.send_message(message.chat.id, messages.NOT_TRANSACTION)
+
+
+def send_profile(path):
+    """Send a profile summary to the admin chat."""
+    with open(path, 'rb') as f:
+        send_queue.call(
+            'send_document', ADMIN_CHAT_ID, f, caption=os.path.basename(path)
+        )
 
 
 def setup_bot_commands():
@@ -401,88 +767,113 @@ def setup_bot_commands():
         types.BotCommand(command='add_budget', description='Set budget targets for a month'),
         types.BotCommand(command='get_budget', description='Show budget vs actual expenses'),
         types.BotCommand(command='dump', description='Get complete database dump'),
+        types.BotCommand(command='import', description='Import expenses from a CSV file'),
     ]
-    bot.set_my_commands(commands)
-
 
-def parse_message(message):
-    """Parse message text to create expanse data."""
-    pattern = re.compile(
-        TRANS_REGEX,
-        re.IGNORECASE,
-    )
-    match = pattern.match(message.strip())
+    # Registering commands is a network round trip, so it is skipped when
+    # this bot already has the same command set
+    commands_hash = hashlib.sha256(
+        repr([(c.command, c.description) for c in commands]).encode()
+    ).hexdigest()
+    key = f'commands_hash:{bot.token.split(":")[0]}'
+    if database.get_meta(key) == commands_hash:
+        return False
 
-    amount_str = match.group(1).replace(',', '.')
-    pos = match.group(2).strip()
-    cur_str = match.group(3)
+    bot.set_my_commands(commands)
+    database.set_meta(key, commands_hash)
+    return True
 
-    try:
-        amount = round(float(amount_str), 2)
-    except ValueError:
-        return None
 
-    if cur_str is None:
-        cur = DEFAULT_CURRENCY
-    else:
-        cur = cur_str.upper().strip()
+def setup_webhook():
+    """Point Telegram at our webhook, or remove it when polling.
+
+    Returns True if a request to Telegram was made.
+    """
+    key = f'webhook_hash:{bot.token.split(":")[0]}'
+    stored = database.get_meta(key, '')
+    if BOT_MODE != 'webhook':
+        # Telegram refuses getUpdates while a webhook is set
+        if not stored:
+            return False
+        bot.remove_webhook()
+        database.set_meta(key, '')
+        return True
+
+    url = os.getenv('WEBHOOK_URL')
+    if not url:
+        raise NoCredentialsError('WEBHOOK_URL is required in webhook mode')
+    if not webhook.WEBHOOK_SECRET:
+        raise NoCredentialsError('WEBHOOK_SECRET is required in webhook mode')
+    webhook_hash = hashlib.sha256(
+        f'{url}\n{webhook.WEBHOOK_SECRET}'.encode()
+    ).hexdigest()
+    if stored == webhook_hash:
+        return False
 
-    return {'pos': pos, 'sum': amount, 'currency': cur}
+    # Updates that arrived during a restart are kept and delivered
+    bot.set_webhook(
+        url=url,
+        secret_token=webhook.WEBHOOK_SECRET,
+        drop_pending_updates=False,
+    )
+    database.set_meta(key, webhook_hash)
+    return True
 
 
 def check_currency_code(message, trans_data):
     """Check that currency code is valid, if not - ask for a valid one"""
     chat_id = message.chat.id
-    trans_data['currency'] = message.text.upper().strip()
+    trans_data.currency = message.text.upper().strip()
     if message.text == 'stop':
-        bot.send_message(chat_id, messages.STOP_INPUT)
-    elif trans_data['currency'] not in get_currency_codes():
-        msg = bot.send_message(chat_id, messages.UNKNOWN_CURRENCY)
-        bot.register_next_step_handler(
-            msg,
-            check_currency_code,
-            trans_data,
-        )
-    else:
-        sum_in_eur = get_rate(trans_data['currency']) * trans_data['sum']
-        trans_data['sum_in_eur'] = round(sum_in_eur, 2)
-        write_transaction(message, trans_data)
+        pending_expenses.pop(chat_id)
+        send_queue.send_message(chat_id, messages.STOP_INPUT)
+        return
+    try:
+        if not currencyapi.is_known_currency(trans_data.currency):
+            send_queue.send_message(chat_id, messages.UNKNOWN_CURRENCY)
+        else:
+            convert_to_eur(trans_data)
+            write_transaction(message, trans_data)
+    except Exception as err:
+        send_queue.send_message(chat_id, err)
 
 
 def write_transaction(message, trans_data):
     """Write expense data DB"""
     chat_id = message.chat.id
-    if 'category' not in trans_data:
-        cat_msg = bot.send_message(
+    if trans_data.category is None:
+        trans_data.step = 'category'
+        pending_expenses.put(chat_id, trans_data)
+        send_queue.send_message(
             chat_id,
             messages.CATEGORY,
             reply_markup=keyboards.category_keyboard(),
         )
-        bot.register_next_step_handler(cat_msg, get_category, trans_data)
     else:
-        data_to_write[chat_id] = trans_data
+        trans_data.step = 'approval'
+        pending_expenses.put(chat_id, trans_data)
         message_text = (
-            f"📍 <b>Store</b>: {trans_data['pos']}\n"
-            f"💰 <b>Price</b>: {trans_data['sum']} {trans_data['currency']}\n"
-            f"🔄 <b>EUR Amount</b>: {trans_data['sum_in_eur']:.2f}\n"
-            f"📊 <b>Category</b>: {trans_data['category']}"
+            f"📍 <b>Store</b>: {trans_data.pos}\n"
+            f"💰 <b>Price</b>: {trans_data.sum} {trans_data.currency}\n"
+            f"🔄 <b>EUR Amount</b>: {trans_data.sum_in_eur:.2f}\n"
+            f"📊 <b>Category</b>: {trans_data.category}"
         )
 
-        markup = quick_markup(
-            {
-                'Yes': {'callback_data': 'approve'},
-                'No': {'callback_data': 'decline'},
-            },
-            row_width=2,
-        )
+        buttons = {
+            'Yes': {'callback_data': 'approve'},
+            'No': {'callback_data': 'decline'},
+        }
+        if trans_data.predicted is not None:
+            buttons['Change category'] = {'callback_data': 'change_category'}
+        markup = quick_markup(buttons, row_width=2)
 
-        bot.send_message(
+        send_queue.send_message(
             chat_id,
             message_text,
             'HTML',
             reply_markup=types.ReplyKeyboardRemove(),
         )
-        bot.send_message(
+        send_queue.send_message(
             chat_id,
             'Is everything correct?',
             'HTML',
@@ -494,41 +885,23 @@ def check_budget_status(chat_id, category, amount):
     """Check budget status and send notification if needed."""
     try:
         # Get current month's budget data
-        current_month = datetime.now().strftime("%m")
-        conn = sqlite3.connect('expenses.db')
-        cursor = conn.cursor()
-        
-        # Get budget amount
-        cursor.execute(
-            'SELECT amount_eur FROM planned_expenses WHERE month = ? AND category = ?',
-            (current_month, category)
-        )
-        budget_row = cursor.fetchone()
-        if not budget_row:
+        today = datetime.now()
+        status = database.get_budget_status(category, today.year, today.month)
+        if status is None:
             return  # No budget set for this category
-        
-        budget = budget_row[0]
-        
-        # Get total expenses for this category this month
-        cursor.execute('''
-            SELECT COALESCE(SUM(amount_eur), 0) 
-            FROM expenses 
-            WHERE category = ? 
-            AND strftime('%m', created_at) = ?
-        ''', (category, current_month))
-        
-        total_expenses = cursor.fetchone()[0]
+
+        budget, total_expenses = status
         remaining = budget - total_expenses
         
         # Prepare notification if needed
         if remaining < 0:
-            bot.send_message(
+            send_queue.send_message(
                 chat_id,
                 f"⚠️ Warning: Category '{category}' is over budget by {abs(remaining):.2f} EUR",
                 parse_mode='HTML'
             )
         elif remaining < (budget * 0.1):  # Less than 10% remaining
-            bot.send_message(
+            send_queue.send_message(
                 chat_id,
                 f"⚠️ Warning: Only {remaining:.2f} EUR left in '{category}' budget ({(remaining/budget*100):.1f}%)",
                 parse_mode='HTML'
@@ -536,8 +909,6 @@ def check_budget_status(chat_id, category, amount):
     
     except Exception as e:
         logging.exception("Error checking budget status")
-    finally:
-        conn.close()
 
 
 @bot.callback_query_handler(func=lambda call: True)
@@ -545,82 +916,153 @@ def callback_query(call):
     """Handle callback action."""
     chat_id = call.message.chat.id
     user = call.from_user
-    trans_data = data_to_write.get(chat_id)
+    trans_data = pending_expenses.get(chat_id)
+    expired = trans_data is None or trans_data.step != 'approval'
+    if call.data in ('approve', 'decline', 'change_category') and expired:
+        send_queue.answer_callback_query(chat_id, call.id, messages.EXPENSE_EXPIRED)
+        send_queue.delete_message(chat_id, call.message.id)
+        return
     
     if call.data == 'decline':
-        bot.answer_callback_query(call.id, 'Declined')
-        data_to_write.pop(chat_id, None)
-        bot.delete_message(chat_id, call.message.id)
-        bot.send_message(
+        send_queue.answer_callback_query(chat_id, call.id, 'Declined')
+        pending_expenses.pop(chat_id)
+        send_queue.delete_message(chat_id, call.message.id)
+        send_queue.send_message(
             chat_id,
             messages.TRANSACTION_DELETED,
         )
     
+    if call.data == 'change_category':
+        send_queue.answer_callback_query(chat_id, call.id)
+        send_queue.delete_message(chat_id, call.message.id)
+        trans_data.category = None
+        write_transaction(call.message, trans_data)
+
     if call.data == 'approve':
         trans_date = date.today()
         database.add_expense(
             trans_date.strftime('%d/%m/%Y'),
             user.username,
-            trans_data['pos'],
-            trans_data['sum'],
-            trans_data['currency'],
-            trans_data['sum_in_eur'],
-            trans_data['category'],
-        )
-        data_to_write.pop(chat_id, None)
-        bot.answer_callback_query(call.id, 'Approved')
-        bot.delete_message(chat_id, call.message.id)
-        bot.send_message(
+            trans_data.pos,
+            trans_data.sum,
+            trans_data.currency,
+            trans_data.sum_in_eur,
+            trans_data.category,
+            rate_date=trans_data.rate_date,
+        )
+        category_index.add(
+            trans_data.pos, trans_data.category, trans_data.predicted
+        )
+        pos_index.add(trans_data.pos, trans_data.category, trans_data.currency)
+        pending_expenses.pop(chat_id)
+        send_queue.answer_callback_query(chat_id, call.id, 'Approved')
+        send_queue.delete_message(chat_id, call.message.id)
+        send_queue.send_message(
             chat_id,
             messages.TRANSACTION_SAVED,
         )
         # Check budget status after saving
-        check_budget_status(chat_id, trans_data['category'], trans_data['sum_in_eur'])
+        check_budget_status(chat_id, trans_data.category, trans_data.sum_in_eur)
 
 
 def get_category(message, trans_data):
     """Add category to expanse data."""
-    trans_data['category'] = message.text
+    trans_data.category = message.text
     write_transaction(message, trans_data)
 
 
-def get_currency_codes() -> list[str]:
-    """Get list of currency codes from CurrencyAPI."""
-    payload = {'apikey': os.getenv('CURRENCYAPI_KEY')}
-    try:
-        response = requests.get(CURR_URL, params=payload)
-    except Exception:
-        raise NoApiResponseError('No response from API')
-
-    if response.status_code != HTTPStatus.OK:
-        raise ServerResponseError(
-            f'Response code is different from 200: {response.status_code}'
-        )
+# Steps that wait for a text message, and the functions handling the reply
+STEP_HANDLERS = {
+    ('expense', 'currency'): check_currency_code,
+    ('expense', 'category'): get_category,
+    ('budget', 'month'): process_month,
+    ('budget', 'amount'): process_category_budget,
+    ('batch', 'category'): get_batch_category,
+}
+TEXT_STEPS = {
+    kind: {step for step_kind, step in STEP_HANDLERS if step_kind == kind}
+    for kind in ('expense', 'budget', 'batch')
+}
+
+
+def convert_to_eur(trans_data):
+    """Add EUR amount and the rate date used to expense data."""
+    sum_in_eur, rate_date = currencyapi.convert(
+        trans_data.sum,
+        trans_data.currency,
+    )
+    trans_data.sum_in_eur = round(sum_in_eur, 2)
+    trans_data.rate_date = rate_date
 
-    res = response.json()['data']
-    list_of_currencies = list(res.keys())
-    return list_of_currencies
 
+def _collect_stats():
+    """Current sizes and counters of the conversation stores and clients."""
+    for store in (pending_expenses, budget_sessions, pending_batches):
+        yield (
+            f'conversations{{kind="{store.kind}"}}',
+            'Conversations in progress', 'gauge', len(store),
+        )
+    yield (
+        'outbox_queued', 'Calls waiting to be sent to Telegram', 'gauge',
+        send_queue.queued(),
+    )
+    for result, value in send_queue.stats.items():
+        yield (
+            f'outbox_calls_total{{result="{result}"}}',
+            'Calls handled by the send queue', 'counter', value,
+        )
+    client = currencyapi.get_client_stats()
+    for key in ('requests', 'failures', 'retries', 'rejected'):
+        yield (
+            f'currencyapi_{key}_total', f'CurrencyAPI {key}', 'counter',
+            client[key],
+        )
+    yield (
+        'currencyapi_circuit_open', 'Whether CurrencyAPI requests are refused',
+        'gauge', int(client['circuit'] != 'closed'),
+    )
+    for result, value in category_index.stats.items():
+        yield (
+            f'category_predictions_total{{result="{result}"}}',
+            'Category predictions by outcome', 'counter', value,
+        )
 
-def get_rate(currency: str) -> float:
-    """Get conversion rate for provided currency code."""
-    payload = {
-        'apikey': os.getenv('CURRENCYAPI_KEY'),
-        'base_currency': currency,
-        'currencies': TARGET_CUR,
-    }
-    try:
-        response = requests.get(RATES_URL, params=payload)
-    except Exception:
-        raise NoApiResponseError('No response from API')
 
-    if response.status_code != HTTPStatus.OK:
-        raise ServerResponseError(
-            f'Response code is different from 200: {response.status_code}'
+def _collect_dispatcher(workers):
+    for i, stats in enumerate(workers.stats()):
+        labels = f'{{worker="{i}"}}'
+        yield (
+            f'dispatch_queued{labels}', 'Updates waiting per worker', 'gauge',
+            stats['queued'],
         )
+        yield (
+            f'dispatch_processed_total{labels}', 'Updates handled', 'counter',
+            stats['processed'],
+        )
+        yield (
+            f'dispatch_errors_total{labels}', 'Updates that raised', 'counter',
+            stats['errors'],
+        )
+        yield (
+            f'dispatch_busy_seconds_total{labels}', 'Time spent handling updates',
+            'counter', stats['busy_seconds'],
+        )
+
 
-    conversion_rate = response.json()['data']['EUR']['value']
-    return conversion_rate
+def start_metrics():
+    """Time handlers, database and API calls and serve the metrics."""
+    metrics.instrument_handlers(bot)
+    metrics.instrument_module(database, 'db', metrics.public_functions(database))
+    metrics.instrument_module(currencyapi, 'currencyapi', (
+        'fetch_currency_codes', 'fetch_latest_rates',
+        'fetch_currency_codes_async', 'fetch_latest_rates_async',
+    ))
+    metrics.instrument_telegram()
+    metrics.add_collector(_collect_stats)
+    server = metrics.MetricsServer()
+    server.start()
+    logging.info(f'Serving metrics on port {server.port}')
+    return server
 
 
 def check_tokens():
@@ -634,11 +1076,82 @@ def check_tokens():
 def main():
     if not check_tokens():
         raise NoCredentialsError
+    if BOT_MODE not in BOT_MODES:
+        raise ValueError(f'Unknown BOT_MODE: {BOT_MODE}')
+
+    timings = []
+    start = time.perf_counter()
+
+    def phase(name):
+        nonlocal start
+        now = time.perf_counter()
+        timings.append(f'{name} {(now - start) * 1000:.0f} ms')
+        start = now
 
     database.init_db()
-    setup_bot_commands()
+    phase('init_db')
+    stores = (pending_expenses, budget_sessions, pending_batches)
+    restored = sum(store.restore() for store in stores)
+    state_store.start_sweeper(*stores)
+    phase(f'restore {restored} conversations')
+    categorized, prefixes = merchants.load_indexes(category_index, pos_index)
+    phase(f'store indexes ({categorized} categorized, {prefixes} names)')
+    if setup_bot_commands():
+        phase('set_my_commands')
+    else:
+        phase('commands (unchanged)')
+    if setup_webhook():
+        phase('webhook')
+    if BOT_MODE != 'async':
+        # The async runtime refreshes currency data on its event loop
+        currencyapi.start_codes_refresher()
+        phase('codes refresher')
+    logging.info(f'Startup ({BOT_MODE}): {", ".join(timings)}')
+
+    if PREWARM_DELAY >= 0:
+        prewarm = threading.Timer(PREWARM_DELAY, expense_viz.prewarm)
+        prewarm.daemon = True
+        prewarm.start()
+
+    profiling.instrument_handlers(bot)
+    profiling.instrument_renderers(
+        expense_viz, ('create_expense_table', 'create_budget_table')
+    )
+    if ADMIN_CHAT_ID:
+        profiling.set_dump_handler(send_profile)
+    metrics_server = start_metrics() if metrics.METRICS_PORT else None
+    send_queue.start()
+    try:
+        if BOT_MODE == 'async':
+            import bot_async
 
-    bot.polling(skip_pending=True)
+            bot_async.run(bot, in_conversation=_waiting_step)
+        else:
+            # Handlers run in the dispatcher workers, not in TeleBot's pool
+            bot.threaded = False
+            workers = dispatcher.Dispatcher(
+                lambda update: bot.process_new_updates([update])
+            )
+            workers.start()
+            if metrics_server:
+                metrics.add_collector(lambda: _collect_dispatcher(workers))
+            try:
+                if BOT_MODE == 'webhook':
+                    server = webhook.WebhookServer(workers.submit)
+                    logging.info(f'Serving webhook on port {server.port}')
+                    try:
+                        server.serve_forever()
+                    finally:
+                        server.stop()
+                else:
+                    workers.poll(bot, skip_pending=True)
+            finally:
+                workers.stop()
+    finally:
+        send_queue.stop()
+        if metrics_server:
+            logging.info(f'Handler latency: {metrics.summary("handler")}')
+            metrics_server.stop()
 
 
 if __name__ == '__main__':
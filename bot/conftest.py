@@ -0,0 +1,12 @@
+import pytest
+
+import database
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Point database.py at a fresh file and close its pool afterwards."""
+    monkeypatch.setattr(database, 'DB_FILE', str(tmp_path / 'test.db'))
+    database.init_db()
+    yield database
+    database.close_connections()
@@ -0,0 +1,552 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from datetime import date
+from http import HTTPStatus
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import database
+from exceptions import NoApiResponseError, NoRateError, ServerResponseError
+
+CURR_URL = 'https://api.currencyapi.com/v3/currencies'
+RATES_URL = 'https://api.currencyapi.com/v3/latest'
+BASE_CURRENCY = 'EUR'
+TARGET_CUR = 'EUR'
+
+# How long (seconds) a loaded set of currency codes is considered fresh
+CODES_TTL = int(os.getenv('CURRENCY_CODES_TTL', 24 * 60 * 60))
+# How long (seconds) exchange rates are used before a new bulk fetch
+RATES_TTL = int(os.getenv('RATES_TTL', 24 * 60 * 60))
+# Pause (seconds) before retrying after a failed rates fetch
+RATES_RETRY_DELAY = 10 * 60
+
+# Seconds to wait for a connection and for a response
+CONNECT_TIMEOUT = float(os.getenv('CURRENCYAPI_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.getenv('CURRENCYAPI_READ_TIMEOUT', 10))
+# Attempts per request; retries wait a random part of a doubling delay
+MAX_ATTEMPTS = int(os.getenv('CURRENCYAPI_ATTEMPTS', 3))
+if MAX_ATTEMPTS < 1:
+    raise ValueError(f'CURRENCYAPI_ATTEMPTS must be at least 1: {MAX_ATTEMPTS}')
+RETRY_BASE_DELAY = 0.5
+# Failed requests in a row before requests are refused for BREAKER_RESET s
+BREAKER_THRESHOLD = int(os.getenv('CURRENCYAPI_BREAKER_THRESHOLD', 5))
+BREAKER_RESET = float(os.getenv('CURRENCYAPI_BREAKER_RESET', 60))
+# Keep-alive connections kept open to CurrencyAPI
+POOL_SIZE = 4
+
+# Whether stale codes and rates start a refresh thread when read. The
+# async runtime turns it off, as its own refresher loops keep them fresh
+_background_refresh = True
+
+
+def set_background_refresh(enabled):
+    """Let stale codes and rates start refresh threads, or stop them."""
+    global _background_refresh
+    _background_refresh = enabled
+
+
+class CircuitBreaker:
+    """Refuse requests for a while after repeated failures.
+
+    The circuit is closed while requests succeed. After threshold failed
+    requests in a row it opens and requests are refused for reset_timeout
+    seconds; then one trial request is let through, which closes the
+    circuit if it succeeds or opens it again if it fails.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Check whether a request may be made now."""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if (
+                self.state == 'open'
+                and time.monotonic() - self.opened_at >= self.reset_timeout
+            ):
+                self.state = 'half-open'
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.threshold:
+                if self.state != 'open':
+                    logging.warning('CurrencyAPI circuit opened')
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+
+_breaker = CircuitBreaker()
+_session = None
+_session_lock = threading.Lock()
+
+client_stats = {
+    'requests': 0,
+    'failures': 0,
+    'retries': 0,
+    'rejected': 0,
+    'latency_total': 0.0,
+    'latency_max': 0.0,
+}
+
+
+def get_session():
+    """Get the shared keep-alive session for CurrencyAPI requests."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=POOL_SIZE
+            )
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def get_client_stats():
+    """Get request counters, latency and the circuit state."""
+    stats = dict(client_stats, circuit=_breaker.state)
+    stats['latency_avg'] = (
+        stats['latency_total'] / stats['requests'] if stats['requests'] else 0.0
+    )
+    return stats
+
+
+def _record_latency(started, failed):
+    latency = time.perf_counter() - started
+    client_stats['requests'] += 1
+    client_stats['latency_total'] += latency
+    client_stats['latency_max'] = max(client_stats['latency_max'], latency)
+    if failed:
+        client_stats['failures'] += 1
+
+
+def _retry_delay(attempt):
+    return random.uniform(0, RETRY_BASE_DELAY * 2 ** attempt)
+
+
+def _is_retryable(status):
+    return status == HTTPStatus.TOO_MANY_REQUESTS or status >= 500
+
+
+def _check_circuit():
+    if not _breaker.allow():
+        client_stats['rejected'] += 1
+        raise NoApiResponseError('CurrencyAPI is unavailable, not retrying yet')
+
+
+def _decode(started, decode):
+    """Decode the JSON of a 200 answer; garbage counts as a failure."""
+    try:
+        res = decode()
+    except ValueError:
+        _record_latency(started, failed=True)
+        _breaker.record_failure()
+        raise ServerResponseError('Response is not valid JSON') from None
+    _record_latency(started, failed=False)
+    _breaker.record_success()
+    return res
+
+
+def _get(url, params):
+    """GET a CurrencyAPI endpoint and return the decoded JSON.
+
+    Connection errors, timeouts, 429 and 5xx answers are retried.
+    """
+    _check_circuit()
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt:
+            client_stats['retries'] += 1
+            time.sleep(_retry_delay(attempt))
+        started = time.perf_counter()
+        try:
+            response = get_session().get(
+                url, params=params, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
+            )
+        except requests.RequestException:
+            _record_latency(started, failed=True)
+            error = NoApiResponseError('No response from API')
+            continue
+        status = response.status_code
+        if status == HTTPStatus.OK:
+            return _decode(started, response.json)
+        _record_latency(started, failed=True)
+        error = ServerResponseError(
+            f'Response code is different from 200: {status}'
+        )
+        if not _is_retryable(status):
+            # The API is up, the request itself is wrong
+            _breaker.record_success()
+            raise error
+    _breaker.record_failure()
+    raise error
+
+
+async def _get_async(session, url, params):
+    """GET a CurrencyAPI endpoint with an aiohttp session, like _get()."""
+    import aiohttp
+
+    _check_circuit()
+    timeout = aiohttp.ClientTimeout(
+        sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+    )
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt:
+            client_stats['retries'] += 1
+            await asyncio.sleep(_retry_delay(attempt))
+        started = time.perf_counter()
+        try:
+            async with session.get(
+                url, params=params, timeout=timeout
+            ) as response:
+                status = response.status
+                body = await response.read() if status == HTTPStatus.OK else None
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            _record_latency(started, failed=True)
+            error = NoApiResponseError('No response from API')
+            continue
+        if status == HTTPStatus.OK:
+            return _decode(started, functools.partial(json.loads, body))
+        _record_latency(started, failed=True)
+        error = ServerResponseError(
+            f'Response code is different from 200: {status}'
+        )
+        if not _is_retryable(status):
+            _breaker.record_success()
+            raise error
+    _breaker.record_failure()
+    raise error
+
+
+# Process-wide currency code registry
+_codes = frozenset()
+_codes_loaded_at = 0.0
+_codes_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+_refresher = None
+
+codes_stats = {
+    'hits': 0,
+    'misses': 0,
+    'refreshes': 0,
+    'refresh_errors': 0,
+}
+
+
+def fetch_currency_codes():
+    """Download the list of currency codes from CurrencyAPI."""
+    payload = {'apikey': os.getenv('CURRENCYAPI_KEY')}
+    return frozenset(_get(CURR_URL, payload)['data'].keys())
+
+
+async def fetch_currency_codes_async(session):
+    """Download the list of currency codes using an aiohttp session."""
+    payload = {'apikey': os.getenv('CURRENCYAPI_KEY', '')}
+    res = await _get_async(session, CURR_URL, payload)
+    return frozenset(res['data'].keys())
+
+
+def _set_codes(codes, loaded_at):
+    global _codes, _codes_loaded_at
+    with _codes_lock:
+        _codes = frozenset(codes)
+        _codes_loaded_at = loaded_at
+
+
+def _codes_are_stale():
+    return time.time() - _codes_loaded_at >= CODES_TTL
+
+
+def refresh_currency_codes():
+    """Fetch currency codes from the API and persist them to the database."""
+    if not _refresh_lock.acquire(blocking=False):
+        # Another thread is already refreshing
+        return False
+    try:
+        codes = fetch_currency_codes()
+        _store_codes(codes)
+        return True
+    except Exception as e:
+        codes_stats['refresh_errors'] += 1
+        logging.warning(f'Failed to refresh currency codes. Error = {e}')
+        return False
+    finally:
+        _refresh_lock.release()
+
+
+def _store_codes(codes):
+    database.save_currency_codes(codes)
+    _set_codes(codes, time.time())
+    codes_stats['refreshes'] += 1
+    logging.debug(f'Currency codes refreshed: {len(codes)} codes')
+
+
+async def refresh_currency_codes_async(session, executor=None):
+    """Fetch currency codes without blocking the event loop.
+
+    The database write runs on executor (the loop's default executor if
+    None).
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        codes = await fetch_currency_codes_async(session)
+        await loop.run_in_executor(executor, _store_codes, codes)
+        return True
+    except Exception as e:
+        codes_stats['refresh_errors'] += 1
+        logging.warning(f'Failed to refresh currency codes. Error = {e}')
+        return False
+
+
+def _load_stored_codes():
+    """Populate the registry from the database after a cold start."""
+    codes, updated_at = database.load_currency_codes()
+    if codes:
+        _set_codes(codes, updated_at)
+
+
+def codes_fresh_for():
+    """Return the seconds until the stored currency codes go stale."""
+    if not _codes:
+        _load_stored_codes()
+    return max(0.0, _codes_loaded_at + CODES_TTL - time.time())
+
+
+def _refresh_in_background():
+    threading.Thread(
+        target=refresh_currency_codes,
+        name='currency-codes-refresh',
+        daemon=True,
+    ).start()
+
+
+def get_currency_codes():
+    """Return the set of known currency codes.
+
+    Codes are served from memory. An empty registry is filled from the
+    database and, failing that, from the API; stale codes are still served
+    while a refresh runs in the background.
+    """
+    if not _codes:
+        _load_stored_codes()
+
+    if not _codes:
+        codes_stats['misses'] += 1
+        refresh_currency_codes()
+        if not _codes:
+            raise NoApiResponseError('Currency codes are not available')
+        return _codes
+
+    codes_stats['hits'] += 1
+    if _background_refresh and _codes_are_stale():
+        _refresh_in_background()
+    return _codes
+
+
+def is_known_currency(code):
+    """Check that the currency code is supported by CurrencyAPI."""
+    return code in get_currency_codes()
+
+
+def _refresh_loop():
+    while True:
+        time.sleep(CODES_TTL)
+        refresh_currency_codes()
+
+
+def start_codes_refresher():
+    """Start a daemon thread that refreshes currency codes every TTL."""
+    global _refresher
+    if _refresher is not None:
+        return
+    _refresher = threading.Thread(
+        target=_refresh_loop,
+        name='currency-codes-refresher',
+        daemon=True,
+    )
+    _refresher.start()
+
+
+# Local exchange-rate store: units of each currency per 1 BASE_CURRENCY
+_rates = {}
+_rates_date = None
+_rates_fetched_at = 0.0
+_rates_next_try = 0.0
+_rates_lock = threading.Lock()
+_rates_refresh_lock = threading.Lock()
+
+rates_stats = {
+    'hits': 0,
+    'misses': 0,
+    'refreshes': 0,
+    'refresh_errors': 0,
+}
+
+
+def fetch_latest_rates():
+    """Download rates for all currencies against BASE_CURRENCY in one call.
+
+    Returns the date the rates are valid for and a dict of currency code
+    to units per 1 BASE_CURRENCY.
+    """
+    payload = {
+        'apikey': os.getenv('CURRENCYAPI_KEY'),
+        'base_currency': BASE_CURRENCY,
+    }
+    return _parse_rates(_get(RATES_URL, payload))
+
+
+async def fetch_latest_rates_async(session):
+    """Download the latest rates using an aiohttp session."""
+    payload = {
+        'apikey': os.getenv('CURRENCYAPI_KEY', ''),
+        'base_currency': BASE_CURRENCY,
+    }
+    return _parse_rates(await _get_async(session, RATES_URL, payload))
+
+
+def _parse_rates(res):
+    updated_at = res.get('meta', {}).get('last_updated_at')
+    rate_date = updated_at[:10] if updated_at else date.today().isoformat()
+    rates = {code: item['value'] for code, item in res['data'].items()}
+    return rate_date, rates
+
+
+def _set_rates(rate_date, fetched_at, rates):
+    global _rates, _rates_date, _rates_fetched_at
+    rates = dict(rates)
+    rates[BASE_CURRENCY] = 1.0
+    with _rates_lock:
+        _rates = rates
+        _rates_date = rate_date
+        _rates_fetched_at = fetched_at
+
+
+def refresh_rates():
+    """Fetch the latest rates from the API and persist them to the database."""
+    global _rates_next_try
+    if not _rates_refresh_lock.acquire(blocking=False):
+        return False
+    try:
+        _store_rates(*fetch_latest_rates())
+        return True
+    except Exception as e:
+        rates_stats['refresh_errors'] += 1
+        _rates_next_try = time.time() + RATES_RETRY_DELAY
+        logging.warning(f'Failed to refresh exchange rates. Error = {e}')
+        return False
+    finally:
+        _rates_refresh_lock.release()
+
+
+def _store_rates(rate_date, rates):
+    database.save_rates(rate_date, rates)
+    _set_rates(rate_date, time.time(), rates)
+    rates_stats['refreshes'] += 1
+    logging.debug(f'Exchange rates for {rate_date} refreshed')
+
+
+async def refresh_rates_async(session, executor=None):
+    """Fetch the latest rates without blocking the event loop.
+
+    The database write runs on executor (the loop's default executor if
+    None).
+    """
+    global _rates_next_try
+    loop = asyncio.get_running_loop()
+    try:
+        rate_date, rates = await fetch_latest_rates_async(session)
+        await loop.run_in_executor(executor, _store_rates, rate_date, rates)
+        return True
+    except Exception as e:
+        rates_stats['refresh_errors'] += 1
+        _rates_next_try = time.time() + RATES_RETRY_DELAY
+        logging.warning(f'Failed to refresh exchange rates. Error = {e}')
+        return False
+
+
+def _load_stored_rates():
+    rate_date, fetched_at, rates = database.get_latest_rates()
+    if rates:
+        _set_rates(rate_date, fetched_at, rates)
+
+
+def rates_fresh_for():
+    """Return the seconds until the stored exchange rates go stale."""
+    if not _rates:
+        _load_stored_rates()
+    return max(0.0, _rates_fetched_at + RATES_TTL - time.time())
+
+
+def get_rates():
+    """Return the rate date and the dict of rates currently in use.
+
+    Rates are served from memory. Stale rates are still served while a
+    refresh runs in the background, falling back to the most recent stored
+    rates if the API is unavailable.
+    """
+    global _rates_next_try
+    if not _rates:
+        _load_stored_rates()
+
+    if not _rates:
+        rates_stats['misses'] += 1
+        refresh_rates()
+        if not _rates:
+            raise NoApiResponseError('Exchange rates are not available')
+        return _rates_date, _rates
+
+    rates_stats['hits'] += 1
+    now = time.time()
+    if (
+        _background_refresh
+        and now - _rates_fetched_at >= RATES_TTL
+        and now >= _rates_next_try
+    ):
+        # Don't start another refresh while this one is running
+        _rates_next_try = now + RATES_RETRY_DELAY
+        threading.Thread(
+            target=refresh_rates,
+            name='rates-refresh',
+            daemon=True,
+        ).start()
+    with _rates_lock:
+        return _rates_date, _rates
+
+
+def convert(amount, currency, target=TARGET_CUR):
+    """Convert amount between two currencies using local cross-rates.
+
+    Returns the converted amount and the date of the rates used.
+    """
+    if currency == target:
+        return amount, None
+
+    rate_date, rates = get_rates()
+    try:
+        value = amount * rates[target] / rates[currency]
+    except KeyError as e:
+        raise NoRateError(f'No exchange rate for {e.args[0]}') from None
+    return value, rate_date
@@ -1,17 +1,146 @@
+import heapq
+import logging
 import os
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from datetime import datetime
-import logging
+from pathlib import Path
+
+import profiling
 from categories import EXPENSE_CATEGORIES
 
 DB_FILE = os.getenv('DB_FILE', 'expenses.db')
 
+# Number of read-only connections kept open for report queries
+READ_POOL_SIZE = int(os.getenv('DB_READ_POOL_SIZE', 4))
+
+# Applied once to every connection when it is opened
+CONNECTION_PRAGMAS = (
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA temp_store = MEMORY',
+)
+WRITER_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+)
+
+_writer = None
+_write_lock = threading.RLock()
+_readers = queue.LifoQueue()
+_readers_opened = 0
+_pool_lock = threading.Lock()
+_pool_file = None
+
+
+def _open_writer():
+    conn = sqlite3.connect(
+        DB_FILE, check_same_thread=False, factory=profiling.TimedConnection
+    )
+    for pragma in WRITER_PRAGMAS + CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _open_reader():
+    uri = Path(DB_FILE).absolute().as_uri() + '?mode=ro'
+    conn = sqlite3.connect(
+        uri, uri=True, check_same_thread=False,
+        factory=profiling.TimedConnection,
+    )
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _check_pool():
+    """Open the writer connection, reopening everything if DB_FILE changed."""
+    global _writer, _pool_file
+    with _pool_lock:
+        if _writer is not None and _pool_file == DB_FILE:
+            return
+        _close_all()
+        _writer = _open_writer()
+        _pool_file = DB_FILE
+
+
+def _close_all():
+    global _writer, _readers, _readers_opened, _pool_file
+    if _writer is not None:
+        _writer.close()
+    while True:
+        try:
+            _readers.get_nowait().close()
+        except queue.Empty:
+            break
+    _writer = None
+    _readers = queue.LifoQueue()
+    _readers_opened = 0
+    _pool_file = None
+
+
+def close_connections():
+    """Close the writer and all pooled reader connections."""
+    with _write_lock, _pool_lock:
+        _close_all()
+
+
+@contextmanager
+def write_conn():
+    """Yield the shared writer connection inside a transaction.
+
+    Writes are serialized; the transaction is committed on success and
+    rolled back if the block raises.
+    """
+    _check_pool()
+    with _write_lock:
+        conn = _writer
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+@contextmanager
+def read_conn():
+    """Yield a read-only connection from the reader pool."""
+    global _readers_opened
+    _check_pool()
+    pool = _readers
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        with _pool_lock:
+            can_open = _readers_opened < READ_POOL_SIZE
+            if can_open:
+                _readers_opened += 1
+        conn = _open_reader() if can_open else pool.get()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        pool.put(conn)
+
 
 def init_db():
-    """Initialize the database with the required tables."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    """Initialize the database and bring its schema up to date."""
+    migrate()
+
+
+def _column_names(cursor, table):
+    cursor.execute(f'PRAGMA table_info({table})')
+    return [row[1] for row in cursor.fetchall()]
+
 
+def _migration_initial_tables(cursor):
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS expenses (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -37,185 +166,755 @@ def init_db():
     )
     """)
 
-    conn.commit()
-    conn.close()
 
+def _migration_currency_tables(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS currency_codes (
+        code TEXT PRIMARY KEY,
+        updated_at REAL NOT NULL
+    )
+    """)
 
-def add_expense(date, username, pos, amount, currency, amount_eur, category):
-    """Add a new expense to the database."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-
-    cursor.execute(
-        'INSERT INTO expenses (date, username, pos, amount, currency, amount_eur, category, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-        (
-            date,
-            username,
-            pos,
-            amount,
-            currency,
-            amount_eur,
-            category,
-            datetime.now().isoformat(),
-        ),
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS rates (
+        rate_date TEXT NOT NULL,
+        currency TEXT NOT NULL,
+        value REAL NOT NULL,
+        fetched_at REAL NOT NULL,
+        PRIMARY KEY (rate_date, currency)
     )
+    """)
 
-    conn.commit()
-    conn.close()
-    return True
+    if 'rate_date' not in _column_names(cursor, 'expenses'):
+        cursor.execute('ALTER TABLE expenses ADD COLUMN rate_date TEXT')
 
 
-def get_last_expenses(limit=5):
-    """Get the last N expenses from the database."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+def _migration_expense_days(cursor):
+    """Add sortable day (YYYYMMDD) and period (YYYYMM) columns with indexes."""
+    columns = _column_names(cursor, 'expenses')
+    if 'day' not in columns:
+        cursor.execute('ALTER TABLE expenses ADD COLUMN day INTEGER')
+    if 'period' not in columns:
+        cursor.execute('ALTER TABLE expenses ADD COLUMN period INTEGER')
+
+    cursor.execute("""
+    UPDATE expenses
+    SET day = CAST(strftime('%Y%m%d', substr(created_at, 1, 10)) AS INTEGER),
+        period = CAST(strftime('%Y%m', substr(created_at, 1, 10)) AS INTEGER)
+    WHERE day IS NULL OR period IS NULL
+    """)
+
+    # Covering indexes for the report queries
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_expenses_day
+    ON expenses (day, category, amount_eur, username, pos)
+    """)
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_expenses_period
+    ON expenses (period, category, amount_eur)
+    """)
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_expenses_created_at
+    ON expenses (created_at)
+    """)
+
 
-    cursor.execute(
-        'SELECT date, username, pos, amount, currency, amount_eur, category FROM expenses ORDER BY created_at DESC LIMIT ?',
-        (limit,),
+# Rebuilds monthly_totals from scratch
+ROLLUP_REBUILD_SQL = (
+    'DELETE FROM monthly_totals',
+    """
+    INSERT INTO monthly_totals (period, category, username, total_eur, count)
+    SELECT period, category, username, SUM(amount_eur), COUNT(*)
+    FROM expenses
+    GROUP BY period, category, username
+    """,
+)
+
+
+def _migration_monthly_totals(cursor):
+    """Add the monthly_totals rollup kept up to date by triggers."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS monthly_totals (
+        period INTEGER NOT NULL,
+        category TEXT NOT NULL,
+        username TEXT NOT NULL,
+        total_eur REAL NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (period, category, username)
     )
+    """)
+
+    # Triggers run inside the statement that changes expenses, so the
+    # rollup is always updated in the same transaction
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS expenses_rollup_insert
+    AFTER INSERT ON expenses
+    BEGIN
+        INSERT INTO monthly_totals (period, category, username, total_eur, count)
+        VALUES (NEW.period, NEW.category, NEW.username, NEW.amount_eur, 1)
+        ON CONFLICT (period, category, username) DO UPDATE
+        SET total_eur = total_eur + excluded.total_eur, count = count + 1;
+    END
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS expenses_rollup_delete
+    AFTER DELETE ON expenses
+    BEGIN
+        UPDATE monthly_totals
+        SET total_eur = total_eur - OLD.amount_eur, count = count - 1
+        WHERE period = OLD.period
+        AND category = OLD.category
+        AND username = OLD.username;
+        DELETE FROM monthly_totals WHERE count <= 0;
+    END
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS expenses_rollup_update
+    AFTER UPDATE OF period, category, username, amount_eur ON expenses
+    BEGIN
+        UPDATE monthly_totals
+        SET total_eur = total_eur - OLD.amount_eur, count = count - 1
+        WHERE period = OLD.period
+        AND category = OLD.category
+        AND username = OLD.username;
+        INSERT INTO monthly_totals (period, category, username, total_eur, count)
+        VALUES (NEW.period, NEW.category, NEW.username, NEW.amount_eur, 1)
+        ON CONFLICT (period, category, username) DO UPDATE
+        SET total_eur = total_eur + excluded.total_eur, count = count + 1;
+        DELETE FROM monthly_totals WHERE count <= 0;
+    END
+    """)
 
-    results = cursor.fetchall()
-    conn.close()
+    for statement in ROLLUP_REBUILD_SQL:
+        cursor.execute(statement)
 
-    return results
 
+def _migration_bot_meta(cursor):
+    """Add a key/value table for small pieces of bot state."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS bot_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )
+    """)
 
-def create_budget_table():
-    """Create a table for storing monthly budget targets per category."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
 
+def _migration_export_watermarks(cursor):
+    """Add per-chat export watermarks and a change log of budget edits."""
     cursor.execute("""
-    CREATE TABLE IF NOT EXISTS budget_targets (
+    CREATE TABLE IF NOT EXISTS export_watermarks (
+        chat_id INTEGER PRIMARY KEY,
+        last_expense_id INTEGER NOT NULL,
+        last_change_id INTEGER NOT NULL,
+        exported_at TEXT NOT NULL
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS change_log (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
-        category TEXT NOT NULL,
-        amount_eur REAL NOT NULL,
-        month INTEGER NOT NULL CHECK (month BETWEEN 1 AND 12),
-        created_at TEXT NOT NULL,
-        UNIQUE(category, month)
+        table_name TEXT NOT NULL,
+        row_id INTEGER NOT NULL,
+        op TEXT NOT NULL
     )
     """)
 
-    conn.commit()
-    conn.close()
+    for op, row in (('insert', 'NEW'), ('update', 'NEW'), ('delete', 'OLD')):
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS planned_expenses_log_{op}
+        AFTER {op.upper()} ON planned_expenses
+        BEGIN
+            INSERT INTO change_log (table_name, row_id, op)
+            VALUES ('planned_expenses', {row}.id, '{op}');
+        END
+        """)
+
+    # Budgets set before the log existed count as changes for the first
+    # incremental export
+    cursor.execute("""
+    INSERT INTO change_log (table_name, row_id, op)
+    SELECT 'planned_expenses', id, 'insert' FROM planned_expenses
+    WHERE NOT EXISTS (SELECT 1 FROM change_log)
+    """)
 
 
-def get_current_month_expenses():
-    """Get expenses for the current month starting from the 5th day."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+def _migration_conversation_state(cursor):
+    """Add the table backing in-progress conversations."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS conversation_state (
+        kind TEXT NOT NULL,
+        chat_id INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (kind, chat_id)
+    )
+    """)
 
-    # Get current month's start date (5th day)
-    today = datetime.now()
-    if today.day < 5:
-        # If we're before the 5th, get previous month's data from the 5th
-        if today.month == 1:
-            start_date = f"{today.year-1}-12-05T00:00:00"
-        else:
-            start_date = f"{today.year}-{today.month-1:02d}-05T00:00:00"
-    else:
-        # Get current month's data from the 5th
-        start_date = f"{today.year}-{today.month:02d}-05T00:00:00"
-
-    # Get main expenses (excluding Travel)
-    cursor.execute('''
-        SELECT category, ROUND(SUM(amount_eur), 2) as total_amount
-        FROM expenses 
-        WHERE created_at >= ? AND category != 'Travel'
-        GROUP BY category
-        ORDER BY total_amount DESC
-    ''', (start_date,))
-    main_results = cursor.fetchall()
-
-    # Calculate total (excluding Travel)
-    cursor.execute('''
-        SELECT ROUND(SUM(amount_eur), 2) as total_amount
-        FROM expenses 
-        WHERE created_at >= ? AND category != 'Travel'
-    ''', (start_date,))
-    total = cursor.fetchone()[0] or 0.0
-
-    # Get Travel expenses separately
-    cursor.execute('''
-        SELECT 'Travel' as category, ROUND(SUM(amount_eur), 2) as total_amount
-        FROM expenses 
-        WHERE created_at >= ? AND category = 'Travel'
-    ''', (start_date,))
-    travel_result = cursor.fetchone()
-    travel_amount = travel_result[1] if travel_result and travel_result[1] else 0.0
-
-    conn.close()
-
-    return main_results, total, travel_amount
 
+def _migration_expense_dedup(cursor):
+    """Add the key used to skip expenses imported twice."""
+    if 'dedup_key' not in _column_names(cursor, 'expenses'):
+        cursor.execute('ALTER TABLE expenses ADD COLUMN dedup_key TEXT')
+    # Expenses entered by hand have no key; NULLs never conflict
+    cursor.execute("""
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_expenses_dedup
+    ON expenses (dedup_key)
+    """)
 
-def get_top_expenses_per_category():
-    """Get top 5 expenses per category for the current month starting from the 5th day."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
 
-    # Get current month's start date (5th day)
+# Ordered schema migrations. Each one must be safe to run on a database
+# that already has some of its changes.
+MIGRATIONS = [
+    (1, _migration_initial_tables),
+    (2, _migration_currency_tables),
+    (3, _migration_expense_days),
+    (4, _migration_monthly_totals),
+    (5, _migration_bot_meta),
+    (6, _migration_export_watermarks),
+    (7, _migration_conversation_state),
+    (8, _migration_expense_dedup),
+]
+
+
+def get_schema_version():
+    """Get the version of the last applied migration."""
+    with read_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT MAX(version) FROM schema_version')
+        version = cursor.fetchone()[0]
+
+    return version or 0
+
+
+def migrate():
+    """Apply all pending migrations, each in its own transaction."""
+    with write_conn() as conn:
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied_at TEXT NOT NULL
+        )
+        """)
+
+    current = get_schema_version()
+    for version, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        with write_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN')
+            migration(cursor)
+            cursor.execute(
+                'INSERT INTO schema_version (version, applied_at) VALUES (?, ?)',
+                (version, datetime.now().isoformat()),
+            )
+        logging.info(f'Applied database migration {version}')
+
+
+def rebuild_rollups():
+    """Rebuild monthly_totals from expenses.
+
+    Returns the number of (period, category, username) rows that were
+    missing or differed from the recomputed totals.
+    """
+    with write_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT COUNT(*) FROM (
+                SELECT period, category, username,
+                    ROUND(SUM(amount_eur), 2), COUNT(*)
+                FROM expenses
+                GROUP BY period, category, username
+                EXCEPT
+                SELECT period, category, username,
+                    ROUND(total_eur, 2), count
+                FROM monthly_totals
+            )
+        ''')
+        mismatches = cursor.fetchone()[0]
+        cursor.execute('''
+            SELECT COUNT(*) FROM monthly_totals m
+            WHERE NOT EXISTS (
+                SELECT 1 FROM expenses e
+                WHERE e.period = m.period
+                AND e.category = m.category
+                AND e.username = m.username
+            )
+        ''')
+        mismatches += cursor.fetchone()[0]
+
+        for statement in ROLLUP_REBUILD_SQL:
+            cursor.execute(statement)
+
+    if mismatches:
+        logging.warning(f'Rebuilt monthly_totals, {mismatches} rows differed')
+    return mismatches
+
+
+def _day_and_period(dt):
+    """Get the integer day (YYYYMMDD) and period (YYYYMM) of a datetime."""
+    return dt.year * 10000 + dt.month * 100 + dt.day, dt.year * 100 + dt.month
+
+
+def _period_start_day():
+    """Get the first day of the current reporting month (from the 5th)."""
     today = datetime.now()
     if today.day < 5:
         # If we're before the 5th, get previous month's data from the 5th
         if today.month == 1:
-            start_date = f"{today.year-1}-12-05T00:00:00"
-        else:
-            start_date = f"{today.year}-{today.month-1:02d}-05T00:00:00"
-    else:
-        # Get current month's data from the 5th
-        start_date = f"{today.year}-{today.month:02d}-05T00:00:00"
-
-    # Get top 5 expenses for each category except Travel
-    cursor.execute('''
-        WITH RankedExpenses AS (
-            SELECT 
-                category,
+            return (today.year - 1) * 10000 + 1205
+        return today.year * 10000 + (today.month - 1) * 100 + 5
+    # Get current month's data from the 5th
+    return today.year * 10000 + today.month * 100 + 5
+
+
+def add_expense(
+    date, username, pos, amount, currency, amount_eur, category, rate_date=None
+):
+    """Add a new expense to the database."""
+    now = datetime.now()
+    day, period = _day_and_period(now)
+    with write_conn() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute(
+            """INSERT INTO expenses (date, username, pos, amount, currency,
+               amount_eur, category, created_at, rate_date, day, period)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (
+                date,
                 username,
                 pos,
-                ROUND(amount_eur, 2) as amount_eur,
-                ROW_NUMBER() OVER (PARTITION BY category ORDER BY amount_eur DESC) as rn
-            FROM expenses 
-            WHERE created_at >= ? AND category != 'Travel'
+                amount,
+                currency,
+                amount_eur,
+                category,
+                now.isoformat(),
+                rate_date,
+                day,
+                period,
+            ),
+        )
+
+    return True
+
+
+def get_meta(key, default=None):
+    """Get a value from the bot_meta table."""
+    with read_conn() as conn:
+        row = conn.execute(
+            'SELECT value FROM bot_meta WHERE key = ?', (key,)
+        ).fetchone()
+
+    return row[0] if row else default
+
+
+def set_meta(key, value):
+    """Store a value in the bot_meta table."""
+    with write_conn() as conn:
+        conn.execute(
+            """INSERT INTO bot_meta (key, value) VALUES (?, ?)
+               ON CONFLICT(key) DO UPDATE SET value = excluded.value""",
+            (key, value),
+        )
+
+
+def get_export_watermark(chat_id):
+    """Get the last expense id and change log id exported to a chat."""
+    with read_conn() as conn:
+        row = conn.execute(
+            'SELECT last_expense_id, last_change_id FROM export_watermarks '
+            'WHERE chat_id = ?',
+            (chat_id,),
+        ).fetchone()
+
+    return tuple(row) if row else (0, 0)
+
+
+def set_export_watermark(chat_id, watermark):
+    """Store the (expense id, change log id) exported to a chat."""
+    with write_conn() as conn:
+        conn.execute(
+            """INSERT INTO export_watermarks
+               (chat_id, last_expense_id, last_change_id, exported_at)
+               VALUES (?, ?, ?, ?)
+               ON CONFLICT(chat_id) DO UPDATE SET
+               last_expense_id = excluded.last_expense_id,
+               last_change_id = excluded.last_change_id,
+               exported_at = excluded.exported_at""",
+            (chat_id, *watermark, datetime.now().isoformat()),
+        )
+
+
+def get_change_cursor():
+    """Get the newest expense id and change log id."""
+    with read_conn() as conn:
+        row = conn.execute(
+            'SELECT (SELECT COALESCE(MAX(id), 0) FROM expenses), '
+            '(SELECT COALESCE(MAX(id), 0) FROM change_log)'
+        ).fetchone()
+
+    return tuple(row)
+
+
+def save_state(kind, chat_id, data, updated_at):
+    """Store the serialized conversation state of a chat."""
+    with write_conn() as conn:
+        conn.execute(
+            """INSERT INTO conversation_state (kind, chat_id, data, updated_at)
+               VALUES (?, ?, ?, ?)
+               ON CONFLICT(kind, chat_id) DO UPDATE SET
+               data = excluded.data, updated_at = excluded.updated_at""",
+            (kind, chat_id, data, updated_at),
+        )
+
+
+def delete_state(kind, chat_id):
+    """Remove the conversation state of a chat."""
+    with write_conn() as conn:
+        conn.execute(
+            'DELETE FROM conversation_state WHERE kind = ? AND chat_id = ?',
+            (kind, chat_id),
+        )
+
+
+def delete_expired_states(kind, before):
+    """Remove conversation states last changed before a timestamp."""
+    with write_conn() as conn:
+        conn.execute(
+            'DELETE FROM conversation_state WHERE kind = ? AND updated_at < ?',
+            (kind, before),
+        )
+
+
+def load_states(kind, since):
+    """Get (chat_id, data, updated_at) of states changed since a timestamp.
+
+    Rows are ordered from the least to the most recently changed.
+    """
+    with read_conn() as conn:
+        return conn.execute(
+            'SELECT chat_id, data, updated_at FROM conversation_state '
+            'WHERE kind = ? AND updated_at >= ? ORDER BY updated_at',
+            (kind, since),
+        ).fetchall()
+
+
+def add_expenses(date, username, expenses):
+    """Add several expenses in one transaction.
+
+    expenses are (pos, amount, currency, amount_eur, category, rate_date)
+    tuples.
+    """
+    now = datetime.now()
+    day, period = _day_and_period(now)
+    created_at = now.isoformat()
+    with write_conn() as conn:
+        conn.executemany(
+            """INSERT INTO expenses (date, username, pos, amount, currency,
+               amount_eur, category, created_at, rate_date, day, period)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            [
+                (date, username, *expense[:5], created_at, expense[5], day, period)
+                for expense in expenses
+            ],
+        )
+
+
+def import_expenses(rows):
+    """Add imported expenses, skipping those whose dedup_key is stored.
+
+    rows are (date, username, pos, amount, currency, amount_eur, category,
+    created_at, rate_date, day, period, dedup_key) tuples. Returns the
+    number of rows added.
+    """
+    with write_conn() as conn:
+        cursor = conn.executemany(
+            """INSERT OR IGNORE INTO expenses (date, username, pos, amount,
+               currency, amount_eur, category, created_at, rate_date, day,
+               period, dedup_key)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            rows,
+        )
+        return cursor.rowcount
+
+
+def save_currency_codes(codes):
+    """Replace the stored list of currency codes."""
+    with write_conn() as conn:
+        cursor = conn.cursor()
+
+        updated_at = time.time()
+        cursor.execute('DELETE FROM currency_codes')
+        cursor.executemany(
+            'INSERT INTO currency_codes (code, updated_at) VALUES (?, ?)',
+            [(code, updated_at) for code in codes],
+        )
+
+
+def load_currency_codes():
+    """Get stored currency codes and the time they were fetched."""
+    with read_conn() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT code, updated_at FROM currency_codes')
+        rows = cursor.fetchall()
+
+    if not rows:
+        return frozenset(), 0.0
+    return frozenset(row[0] for row in rows), min(row[1] for row in rows)
+
+
+def save_rates(rate_date, rates):
+    """Store exchange rates (units of currency per 1 EUR) for a date."""
+    with write_conn() as conn:
+        cursor = conn.cursor()
+
+        fetched_at = time.time()
+        cursor.executemany(
+            """INSERT INTO rates (rate_date, currency, value, fetched_at)
+               VALUES (?, ?, ?, ?)
+               ON CONFLICT(rate_date, currency)
+               DO UPDATE SET value = excluded.value,
+               fetched_at = excluded.fetched_at""",
+            [(rate_date, cur, value, fetched_at) for cur, value in rates.items()],
+        )
+
+
+def get_latest_rates():
+    """Get the most recent stored exchange rates.
+
+    Returns the rate date, the time the rates were fetched and a dict of
+    currency code to units per 1 EUR. The dict is empty if nothing is stored.
+    """
+    with read_conn() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT MAX(rate_date) FROM rates')
+        rate_date = cursor.fetchone()[0]
+        if rate_date is None:
+            return None, 0.0, {}
+
+        cursor.execute(
+            'SELECT currency, value, fetched_at FROM rates WHERE rate_date = ?',
+            (rate_date,),
+        )
+        rows = cursor.fetchall()
+
+    rates = {row[0]: row[1] for row in rows}
+    fetched_at = max(row[2] for row in rows)
+    return rate_date, fetched_at, rates
+
+
+def get_rate_history(currency):
+    """Get (rate_date, units per 1 EUR) of a currency, oldest first."""
+    with read_conn() as conn:
+        return conn.execute(
+            'SELECT rate_date, value FROM rates WHERE currency = ? '
+            'ORDER BY rate_date',
+            (currency,),
+        ).fetchall()
+
+
+def get_budget_status(category, year, month):
+    """Get budget and total expenses for a category in a month.
+
+    Returns None if no budget is set for the category.
+    """
+    month_text = f"{month:02d}"
+    with read_conn() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute(
+            'SELECT amount_eur FROM planned_expenses WHERE month = ? AND category = ?',
+            (month_text, category),
         )
-        SELECT category, username, pos, amount_eur
-        FROM RankedExpenses
-        WHERE rn <= 5
-        ORDER BY category, amount_eur DESC
-    ''', (start_date,))
+        budget_row = cursor.fetchone()
+        if not budget_row:
+            return None
 
-    results = cursor.fetchall()
-    conn.close()
+        cursor.execute('''
+            SELECT COALESCE(SUM(total_eur), 0)
+            FROM monthly_totals
+            WHERE period = ? AND category = ?
+        ''', (year * 100 + month, category))
+        total_expenses = cursor.fetchone()[0]
+
+    return budget_row[0], total_expenses
+
+
+def get_last_expenses(limit=5):
+    """Get the last N expenses from the database."""
+    with read_conn() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute(
+            """SELECT date, username, pos, amount, currency, amount_eur, category
+               FROM expenses ORDER BY created_at DESC LIMIT ?""",
+            (limit,),
+        )
+
+        results = cursor.fetchall()
 
     return results
 
 
+def get_pos_counts():
+    """Get (pos, category, currency, count) of every store spelling used."""
+    with read_conn() as conn:
+        return conn.execute(
+            'SELECT pos, category, currency, COUNT(*) FROM expenses '
+            'GROUP BY pos, category, currency'
+        ).fetchall()
+
+
+def create_budget_table():
+    """Create a table for storing monthly budget targets per category."""
+    with write_conn() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS budget_targets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            category TEXT NOT NULL,
+            amount_eur REAL NOT NULL,
+            month INTEGER NOT NULL CHECK (month BETWEEN 1 AND 12),
+            created_at TEXT NOT NULL,
+            UNIQUE(category, month)
+        )
+        """)
+
+
+@dataclass
+class PeriodReport:
+    """Summary of expenses in a reporting period."""
+
+    start_day: int
+    # (category, total) for every category except Travel, biggest first
+    category_totals: list = field(default_factory=list)
+    # Total of all categories except Travel
+    total: float = 0.0
+    travel_total: float = 0.0
+    # (category, username, pos, amount_eur), top N per category except Travel
+    top_expenses: list = field(default_factory=list)
+
+
+# Expenses the top N are picked from, read with a single range scan of
+# the covering idx_expenses_day index. The top N are kept while the rows
+# stream in, which avoids the temp b-tree sorts of a window query.
+REPORT_QUERY = '''
+    SELECT category, username, pos, amount_eur
+    FROM expenses
+    WHERE day >= ?
+'''
+
+
+# Category totals from day start_day onwards: the monthly rollup from the
+# start month on, minus the raw expenses of that month before start_day.
+ROLLUP_TOTALS_QUERY = '''
+    SELECT category, SUM(total), SUM(count)
+    FROM (
+        SELECT category, total_eur as total, count
+        FROM monthly_totals
+        WHERE period >= ?
+        UNION ALL
+        SELECT category, -amount_eur, -1
+        FROM expenses
+        WHERE day >= ? AND day < ?
+    )
+    GROUP BY category
+    HAVING SUM(count) > 0
+'''
+
+
+def _rollup_totals(start_day):
+    start_period = start_day // 100
+    with read_conn() as conn:
+        rows = conn.execute(
+            ROLLUP_TOTALS_QUERY, (start_period, start_period * 100, start_day)
+        ).fetchall()
+    return {category: total for category, total, count in rows}
+
+
+def _scan_top(start_day, top_n):
+    top = {}
+    with read_conn() as conn:
+        for category, username, pos, amount_eur in conn.execute(
+            REPORT_QUERY, (start_day,)
+        ):
+            if category == 'Travel':
+                continue
+            # Keep the N biggest expenses per category in a min-heap
+            heap = top.setdefault(category, [])
+            item = (amount_eur, username, pos)
+            if len(heap) < top_n:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+    return top
+
+
+def get_period_report(start_day=None, top_n=5):
+    """Get category totals, Travel split and top expenses of a period.
+
+    The period starts on start_day (YYYYMMDD), by default on the 5th day
+    of the current reporting month. Totals are read from the monthly
+    rollup; only the top expenses (top_n > 0) need the period's rows.
+    """
+    if start_day is None:
+        start_day = _period_start_day()
+
+    totals = _rollup_totals(start_day)
+    top = _scan_top(start_day, top_n) if top_n > 0 else {}
+
+    report = PeriodReport(start_day)
+    report.travel_total = round(totals.pop('Travel', 0.0), 2)
+    report.category_totals = sorted(
+        ((category, round(total, 2)) for category, total in totals.items()),
+        key=lambda item: item[1],
+        reverse=True,
+    )
+    report.total = round(sum(totals.values()), 2)
+    for category in sorted(top):
+        for amount_eur, username, pos in sorted(top[category], reverse=True):
+            report.top_expenses.append(
+                (category, username, pos, round(amount_eur, 2))
+            )
+    return report
+
+
+def get_current_month_expenses():
+    """Get expenses for the current month starting from the 5th day."""
+    report = get_period_report(top_n=0)
+    return report.category_totals, report.total, report.travel_total
+
+
+def get_top_expenses_per_category():
+    """Get the top 5 expenses per category of the period starting on the 5th."""
+    return get_period_report().top_expenses
+
+
 def add_budget(month, category, amount_eur):
     """Add or update budget target for a category in a specific month."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-
     # Convert month number to text format (e.g., "3" to "03")
     month_text = f"{month:02d}"
 
     try:
-        cursor.execute(
-            '''INSERT INTO planned_expenses 
-               (month, category, amount_eur, created_at) 
-               VALUES (?, ?, ?, ?)
-               ON CONFLICT(month, category) 
-               DO UPDATE SET amount_eur = ?, created_at = ?''',
-            (
-                month_text,
-                category,
-                amount_eur,
-                datetime.now().isoformat(),
-                amount_eur,
-                datetime.now().isoformat(),
-            ),
-        )
-        conn.commit()
+        with write_conn() as conn:
+            conn.execute(
+                '''INSERT INTO planned_expenses 
+                   (month, category, amount_eur, created_at) 
+                   VALUES (?, ?, ?, ?)
+                   ON CONFLICT(month, category) 
+                   DO UPDATE SET amount_eur = ?, created_at = ?''',
+                (
+                    month_text,
+                    category,
+                    amount_eur,
+                    datetime.now().isoformat(),
+                    amount_eur,
+                    datetime.now().isoformat(),
+                ),
+            )
         success = True
     except sqlite3.Error as e:
         logging.error(
@@ -231,85 +930,80 @@ def add_budget(month, category, amount_eur):
             Error: {str(e)}"""
         )
         success = False
-    finally:
-        conn.close()
 
     return success
 
 
-def get_budget_comparison():
-    """Get budget vs actual expenses comparison by month."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+# Budget and actual total for every (month, category) pair of a year.
+# Budgets are set per month number and apply to every year.
+BUDGET_COMPARISON_QUERY = '''
+    SELECT month, category, SUM(budget), ROUND(SUM(actual), 2)
+    FROM (
+        SELECT CAST(month AS INTEGER) as month, category,
+            amount_eur as budget, 0 as actual
+        FROM planned_expenses
+        UNION ALL
+        SELECT period % 100 as month, category,
+            0 as budget, SUM(total_eur) as actual
+        FROM monthly_totals
+        WHERE period BETWEEN ? AND ?
+        GROUP BY period, category
+    )
+    GROUP BY month, category
+    ORDER BY month
+'''
 
-    try:
-        # Get all months that have either budget or expenses
-        cursor.execute('''
-            WITH months AS (
-                -- Get months from planned_expenses
-                SELECT DISTINCT month FROM planned_expenses
-                UNION
-                -- Get months from expenses (extract month from created_at)
-                SELECT DISTINCT strftime('%m', substr(created_at, 1, 10)) as month 
-                FROM expenses
-                WHERE created_at >= datetime('now', 'start of year')
-            )
-            SELECT month FROM months ORDER BY month
-        ''')
-        months = [row[0] for row in cursor.fetchall()]
-        logging.debug(f"Found months: {months}")
-
-        result = []
-        for month in months:
-            # Get budget data for the month
-            cursor.execute('''
-                SELECT category, amount_eur
-                FROM planned_expenses
-                WHERE month = ?
-            ''', (month,))  # month is already in correct format
-            budget_data = dict(cursor.fetchall())
-            logging.debug(f"Month {month} budget data: {budget_data}")
-
-            # Get actual expenses for the month
-            cursor.execute('''
-                SELECT category, ROUND(SUM(amount_eur), 2) as total
-                FROM expenses
-                WHERE strftime('%m', substr(created_at, 1, 10)) = ?
-                AND created_at >= datetime('now', 'start of year')
-                GROUP BY category
-            ''', (month,))  # month is already in correct format
-            actual_data = dict(cursor.fetchall())
-            logging.debug(f"Month {month} actual data: {actual_data}")
 
-            # Calculate totals and remaining budget
-            month_data = {'month': int(month)}  # Convert month to integer for display
-            total_budget = 0
-            total_actual = 0
+def get_budget_comparison(year=None):
+    """Get budget vs actual expenses comparison by month of a year."""
+    if year is None:
+        year = datetime.now().year
 
-            for category in EXPENSE_CATEGORIES:
-                budget = budget_data.get(category, 0) or 0
-                actual = actual_data.get(category, 0) or 0
-                remaining = budget - actual
+    try:
+        with read_conn() as conn:
+            rows = conn.execute(
+                BUDGET_COMPARISON_QUERY, (year * 100 + 1, year * 100 + 12)
+            ).fetchall()
+    except Exception:
+        logging.exception("Error in get_budget_comparison:")
+        raise
 
-                month_data[f"{category}_budget"] = budget
-                month_data[f"{category}_actual"] = actual
-                month_data[f"{category}_left"] = remaining
+    # Pivot (month, category) rows into one dict per month
+    months = {}
+    for month, category, budget, actual in rows:
+        months.setdefault(month, {})[category] = (budget or 0, actual or 0)
 
-                total_budget += budget
-                total_actual += actual
+    result = []
+    for month, categories in months.items():
+        month_data = {'month': month}
+        total_budget = 0
+        total_actual = 0
 
-            month_data["Total_budget"] = total_budget
-            month_data["Total_actual"] = total_actual
-            month_data["Total_left"] = total_budget - total_actual
+        for category in EXPENSE_CATEGORIES:
+            budget, actual = categories.get(category, (0, 0))
+            remaining = budget - actual
 
-            result.append(month_data)
-            logging.debug(f"Processed data for month {month}: {month_data}")
+            month_data[f"{category}_budget"] = budget
+            month_data[f"{category}_actual"] = actual
+            month_data[f"{category}_left"] = remaining
 
-    except Exception as e:
-        logging.exception("Error in get_budget_comparison:")
-        raise
+            total_budget += budget
+            total_actual += actual
 
-    finally:
-        conn.close()
+        month_data["Total_budget"] = total_budget
+        month_data["Total_actual"] = total_actual
+        month_data["Total_left"] = total_budget - total_actual
+
+        result.append(month_data)
 
+    logging.debug(f"Budget comparison for {year}: {result}")
     return result
+
+
+if __name__ == '__main__':
+    import sys
+
+    if sys.argv[1:] != ['rebuild_rollups']:
+        sys.exit('Usage: python database.py rebuild_rollups')
+    init_db()
+    print(f'Rollups rebuilt, {rebuild_rollups()} rows differed')
@@ -0,0 +1,115 @@
+"""Handle updates of different chats in parallel, keeping each chat in order.
+
+Updates are hashed by chat id onto one of DISPATCH_WORKERS queues, each
+drained by its own thread. All updates of a chat go through the same
+worker, so they are handled strictly in the order they arrived.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+
+DISPATCH_WORKERS = int(os.getenv('DISPATCH_WORKERS', 4))
+# Updates waiting per worker before submit() blocks
+DISPATCH_QUEUE_SIZE = int(os.getenv('DISPATCH_QUEUE_SIZE', 100))
+# Seconds to wait before polling again after an error
+POLL_RETRY_DELAY = 3
+
+
+def chat_id_of(update):
+    """Get the chat (or user) an update belongs to."""
+    for message in (
+        update.message,
+        update.edited_message,
+        update.callback_query.message if update.callback_query else None,
+    ):
+        if message is not None:
+            return message.chat.id
+    for event in (update.callback_query, update.inline_query):
+        if event is not None:
+            return event.from_user.id
+    return 0
+
+
+def shard_of(chat_id, shards=DISPATCH_WORKERS):
+    return hash(chat_id) % shards
+
+
+class Dispatcher:
+    """Pool of workers passing updates to process(update) in chat order."""
+
+    def __init__(self, process, workers=DISPATCH_WORKERS,
+                 queue_size=DISPATCH_QUEUE_SIZE):
+        self.process = process
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._stats = [
+            {'processed': 0, 'errors': 0, 'busy_seconds': 0.0}
+            for _ in range(workers)
+        ]
+        self._threads = [
+            threading.Thread(
+                target=self._work, args=(i,), name=f'dispatch-{i}', daemon=True
+            )
+            for i in range(workers)
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, update):
+        """Queue an update, blocking while its worker's queue is full."""
+        shard = shard_of(chat_id_of(update), len(self._queues))
+        self._queues[shard].put(update)
+
+    def _work(self, index):
+        updates = self._queues[index]
+        stats = self._stats[index]
+        while True:
+            update = updates.get()
+            if update is None:
+                return
+            start = time.perf_counter()
+            try:
+                self.process(update)
+            except Exception:
+                stats['errors'] += 1
+                logging.exception(f'Error processing update {update.update_id}')
+            stats['busy_seconds'] += time.perf_counter() - start
+            stats['processed'] += 1
+
+    def stats(self):
+        """Get queue depth, handled updates and busy time of every worker."""
+        return [
+            dict(stats, queued=updates.qsize())
+            for updates, stats in zip(self._queues, self._stats)
+        ]
+
+    def stop(self):
+        """Let the workers finish queued updates and stop them."""
+        for updates in self._queues:
+            updates.put(None)
+        for thread in self._threads:
+            thread.join()
+        logging.info(f'Dispatcher stopped: {self.stats()}')
+
+    def poll(self, bot, timeout=20, skip_pending=True):
+        """Long-poll Telegram and dispatch the updates until interrupted."""
+        offset = None
+        if skip_pending:
+            pending = bot.get_updates(offset=-1, timeout=0)
+            if pending:
+                offset = pending[-1].update_id + 1
+        while True:
+            try:
+                updates = bot.get_updates(
+                    offset=offset, timeout=timeout, long_polling_timeout=timeout
+                )
+            except Exception as e:
+                logging.warning(f'Failed to get updates. Error = {e}')
+                time.sleep(POLL_RETRY_DELAY)
+                continue
+            for update in updates:
+                self.submit(update)
+                offset = update.update_id + 1
@@ -8,3 +8,7 @@ class NoApiResponseError(Exception):
 
 class ServerResponseError(Exception):
     pass
+
+
+class NoRateError(Exception):
+    pass
@@ -1,15 +1,75 @@
 import io
-import pandas as pd
-import matplotlib.pyplot as plt
-import numpy as np
+import logging
+import os
+import threading
+import time
 from categories import EXPENSE_CATEGORIES
 from datetime import datetime
 
+# pandas and matplotlib take most of the bot's start-up time, so they are
+# imported on first use by _mpl() or ahead of time by prewarm(). Pillow,
+# through table_raster, is imported where the pillow backend draws
+pd = None
+plt = None
+# pyplot keeps global state, so figures are drawn one at a time
+_mpl_lock = threading.Lock()
 
-def create_expense_table(data, columns, title, include_total=False, total=None, travel_data=None):
+# Rendering backend used when a call doesn't pick one: matplotlib or pillow
+VIZ_BACKEND = os.getenv('VIZ_BACKEND', 'matplotlib')
+BACKENDS = ('matplotlib', 'pillow')
+
+
+def _mpl():
+    """Import pandas and matplotlib on first use."""
+    global pd, plt
+    if plt is None:
+        import matplotlib
+
+        matplotlib.use('Agg')
+        import matplotlib.pyplot
+        import pandas
+
+        pd, plt = pandas, matplotlib.pyplot
+    return pd, plt
+
+
+def prewarm():
+    """Import the configured backend and draw a small table to warm caches."""
+    start = time.perf_counter()
+    try:
+        create_expense_table([('Grocery', 1.0)], ['Category', 'Amount'], 'Warm-up')
+    except Exception:
+        logging.exception('Failed to prewarm the table renderer')
+        return
+    logging.info(
+        f'Prewarmed {VIZ_BACKEND} renderer in '
+        f'{(time.perf_counter() - start) * 1000:.0f} ms'
+    )
+
+
+def _get_backend(backend):
+    backend = backend or VIZ_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown rendering backend: {backend}')
+    return backend
+
+
+def create_expense_table(data, columns, title, include_total=False, total=None, travel_data=None, backend=None):
     """Create a table visualization of expenses data."""
+    if _get_backend(backend) == 'pillow':
+        return _expense_table_pillow(
+            data, columns, title, include_total, total, travel_data
+        )
+    with _mpl_lock:
+        return _expense_table_matplotlib(
+            data, columns, title, include_total, total, travel_data
+        )
+
+
+def _expense_table_matplotlib(data, columns, title, include_total, total, travel_data):
+    pd, plt = _mpl()
     df = pd.DataFrame(data, columns=columns)
-    
+
     # Add total row if requested
     if include_total and total is not None:
         total_row = pd.DataFrame([['Total', total]], columns=columns)
@@ -18,7 +78,7 @@ def create_expense_table(data, columns, title, include_total=False, total=None,
     # Calculate figure height based on number of rows
     row_height = 0.5  # height per row in inches
     fig_height = max(6, (len(df) + 2) * row_height)  # minimum height of 6 inches
-    
+
     # Create figure and axis
     fig, ax = plt.subplots(figsize=(12, fig_height))
     ax.axis('off')
@@ -40,7 +100,7 @@ def create_expense_table(data, columns, title, include_total=False, total=None,
     # If travel data exists, add it as a separate mini-table below
     if travel_data is not None and travel_data > 0:
         travel_text = f"Travel expenses: {travel_data:.2f} EUR"
-        plt.figtext(0.5, 0.02, travel_text, ha='center', fontsize=10, 
+        plt.figtext(0.5, 0.02, travel_text, ha='center', fontsize=10,
                    bbox=dict(facecolor='#f2f2f2', edgecolor='none', pad=5))
 
     # Title
@@ -52,120 +112,169 @@ def create_expense_table(data, columns, title, include_total=False, total=None,
     buf.seek(0)
 
     plt.close(fig)  # Close the figure to free memory
-    
-    return buf 
 
+    return buf
+
+
+def _expense_table_pillow(data, columns, title, include_total, total, travel_data):
+    import table_raster
+
+    rows = [list(columns)] + [list(row) for row in data]
+    if include_total and total is not None:
+        rows.append(['Total', total])
+    header_style = table_raster.CellStyle(facecolor='#f2f2f2')
+    styles = [[header_style] * len(columns)]
+    styles += [[table_raster.DEFAULT_STYLE] * len(columns)] * (len(rows) - 1)
+
+    footer = None
+    if travel_data is not None and travel_data > 0:
+        footer = f"Travel expenses: {travel_data:.2f} EUR"
+    return table_raster.render_table(rows, title, styles, footer=footer)
 
-def create_budget_table(data):
-    """Create a table visualization of budget vs actual expenses."""
-    if not data:
-        return None
 
+def _budget_rows(data):
+    """Build the Category/month/Plan/Fact/Left rows of the budget table."""
     # Create a list of categories plus Total
     categories = EXPENSE_CATEGORIES + ['Total']
-    
+
     # Prepare data for DataFrame with the desired structure
     formatted_data = []
     for month_data in data:
         month_num = month_data['month']
         month_name = datetime.strptime(f"{month_num}", "%m").strftime("%B")
-        
+
         # Add category row
         formatted_data.append(['Category'] + categories)
-        
+
         # Add month name row (empty cells under Category and other columns)
         formatted_data.append([month_name] + [''] * len(categories))
-        
+
         # Add Plan row
         plan_row = ['Plan']
         for cat in categories:
             value = month_data.get(f"{cat}_budget", 0) or 0
             plan_row.append(f"{value:.2f}")
         formatted_data.append(plan_row)
-        
+
         # Add Fact row
         fact_row = ['Fact']
         for cat in categories:
             value = month_data.get(f"{cat}_actual", 0) or 0
             fact_row.append(f"{value:.2f}")
         formatted_data.append(fact_row)
-        
+
         # Add Left row
         left_row = ['Left']
         for cat in categories:
             value = month_data.get(f"{cat}_left", 0) or 0
             left_row.append(f"{value:.2f}")
         formatted_data.append(left_row)
-    
+
+    return formatted_data
+
+
+def _budget_cell_style(rows, i, j):
+    """Get (facecolor, color, weight, style) of a budget table cell."""
+    val = rows[i][j]
+
+    # Style Category headers
+    if val == 'Category':
+        return '#ADD8E6', '#000000', 'bold', 'normal'  # Light blue
+
+    # Style month name row
+    if i % 5 == 1:  # Month name row
+        weight = 'bold' if j == 0 else 'normal'  # Month name cell
+        return '#F0F8FF', '#000000', weight, 'normal'  # Very light blue
+
+    # Style Plan/Fact/Left rows
+    if val in ['Plan', 'Fact', 'Left']:
+        return '#ffffff', '#000000', 'normal', 'italic'
+
+    # Color negative values in red
+    if j > 0 and val and rows[i][0] == 'Left':
+        try:
+            if float(val) < 0:
+                return '#ffffff', 'red', 'normal', 'normal'
+        except ValueError:
+            pass
+
+    return '#ffffff', '#000000', 'normal', 'normal'
+
+
+def create_budget_table(data, backend=None):
+    """Create a table visualization of budget vs actual expenses."""
+    if not data:
+        return None
+
+    formatted_data = _budget_rows(data)
+
+    if _get_backend(backend) == 'pillow':
+        import table_raster
+
+        styles = [
+            [
+                table_raster.CellStyle(*_budget_cell_style(formatted_data, i, j))
+                for j in range(len(row))
+            ]
+            for i, row in enumerate(formatted_data)
+        ]
+        return table_raster.render_table(
+            formatted_data, 'Budget vs Actual Expenses', styles, font_size=18
+        )
+    with _mpl_lock:
+        return _budget_table_matplotlib(formatted_data)
+
+
+def _budget_table_matplotlib(formatted_data):
     # Create DataFrame
+    pd, plt = _mpl()
     df = pd.DataFrame(formatted_data)
-    
+
     # Calculate figure dimensions
     row_height = 0.4
     fig_height = max(6, len(formatted_data) * row_height)
-    
+
     # Create figure and axis
     fig, ax = plt.subplots(figsize=(15, fig_height))
     ax.axis('off')
-    
+
     # Create table
     table = ax.table(
         cellText=df.values,
         loc='center',
         cellLoc='center'
     )
-    
+
     # Style the table
     table.auto_set_font_size(False)
     table.set_fontsize(9)
-    
+
     # Color coding and styling for the cells
     for i in range(len(df)):
         for j in range(len(df.columns)):
             cell = table[i, j]
-            
-            # Get cell value
-            val = df.iloc[i, j]
-            
-            # Style Category headers
-            if val == 'Category':
-                cell.set_facecolor('#ADD8E6')  # Light blue
-                cell.set_text_props(weight='bold')
-            
-            # Style month name row
-            elif i % 5 == 1:  # Month name row
-                if j == 0:  # Month name cell
-                    cell.set_text_props(weight='bold')
-                cell.set_facecolor('#F0F8FF')  # Very light blue
-            
-            # Style Plan/Fact/Left rows
-            elif val in ['Plan', 'Fact', 'Left']:
-                cell.set_text_props(style='italic')
-            
-            # Style numeric cells
-            elif j > 0 and val:  # Numeric cells (not empty)
-                try:
-                    num_val = float(val)
-                    # Color negative values in red
-                    if df.iloc[i, 0] == 'Left' and num_val < 0:
-                        cell.set_text_props(color='red')
-                except ValueError:
-                    pass
-            
+            facecolor, color, weight, style = _budget_cell_style(
+                formatted_data, i, j
+            )
+            if facecolor != '#ffffff':
+                cell.set_facecolor(facecolor)
+            if (color, weight, style) != ('#000000', 'normal', 'normal'):
+                cell.set_text_props(color=color, weight=weight, style=style)
+
             # Adjust cell height and width
             cell.set_height(0.15)
             if j == 0:
                 cell.set_width(0.15)
             else:
                 cell.set_width(0.12)
-    
+
     # Title
     plt.title('Budget vs Actual Expenses', pad=20, fontsize=16)
-    
+
     # Save to buffer
     buf = io.BytesIO()
     plt.savefig(buf, format='png', dpi=150, bbox_inches='tight')
     buf.seek(0)
     plt.close(fig)
-    
-    return buf 
\ No newline at end of file
+
+    return buf
@@ -0,0 +1,221 @@
+"""Stream database tables to XLSX, gzip-compressed CSV or JSON Lines.
+
+Rows are read from the database in chunks and written to the output as
+they arrive, so memory use does not grow with the size of the ledger.
+The output is spooled to a temporary file once it gets large.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+from datetime import datetime
+
+import database
+
+FORMATS = ('xlsx', 'csv', 'jsonl')
+FILE_NAMES = {
+    'xlsx': 'database_dump.xlsx',
+    'csv': 'expenses.csv.gz',
+    'jsonl': 'database_dump.jsonl.gz',
+}
+# Rows fetched from the cursor at a time
+CHUNK_SIZE = 1000
+# Exports bigger than this are moved from memory to a temporary file
+SPOOL_MAX_BYTES = int(os.getenv('EXPORT_SPOOL_BYTES', 1024 * 1024))
+
+EXPENSE_COLUMNS = (
+    'id', 'date', 'username', 'pos', 'amount', 'currency', 'amount_eur',
+    'category', 'created_at', 'rate_date',
+)
+BUDGET_COLUMNS = ('id', 'month', 'category', 'amount_eur', 'created_at')
+
+
+class ExportOptions:
+    """What to export: format, date range and expense columns.
+
+    after and upto are optional (expense id, change log id) cursors that
+    limit the export to rows added or changed between them.
+    """
+
+    __slots__ = ('fmt', 'date_from', 'date_to', 'columns', 'after', 'upto')
+
+    def __init__(self, fmt='xlsx', date_from=None, date_to=None, columns=None,
+                 after=None, upto=None):
+        if fmt not in FORMATS:
+            raise ValueError(f'Unknown export format: {fmt}')
+        unknown = set(columns or ()) - set(EXPENSE_COLUMNS)
+        if unknown:
+            raise ValueError(f'Unknown columns: {", ".join(sorted(unknown))}')
+        self.fmt = fmt
+        self.date_from = date_from
+        self.date_to = date_to
+        self.columns = tuple(columns) if columns else EXPENSE_COLUMNS
+        self.after = after
+        self.upto = upto
+
+    def is_complete(self):
+        """Check whether every table, row and column gets exported."""
+        return (
+            self.fmt != 'csv'
+            and self.date_from is None
+            and self.date_to is None
+            and self.columns == EXPENSE_COLUMNS
+        )
+
+
+def parse_options(args):
+    """Build ExportOptions from /dump arguments.
+
+    Accepted arguments are a format name and from=, to= (YYYY-MM-DD) and
+    columns= (comma separated) options, e.g.
+    /dump csv from=2024-01-01 to=2024-12-31 columns=date,pos,amount_eur
+    """
+    kwargs = {}
+    for arg in args:
+        key, sep, value = arg.partition('=')
+        if not sep:
+            kwargs['fmt'] = arg.lower()
+        elif key in ('from', 'to'):
+            try:
+                day = datetime.strptime(value, '%Y-%m-%d').date()
+            except ValueError:
+                raise ValueError(f'Dates must look like 2024-01-31: {value}')
+            kwargs[f'date_{key}'] = day
+        elif key == 'columns':
+            kwargs['columns'] = [col for col in value.split(',') if col]
+        else:
+            raise ValueError(f'Unknown option: {key}')
+    return ExportOptions(**kwargs)
+
+
+def _day(value):
+    return value.year * 10000 + value.month * 100 + value.day
+
+
+def _expense_query(options):
+    query = f'SELECT {", ".join(options.columns)} FROM expenses'
+    conditions = []
+    params = []
+    if options.date_from:
+        conditions.append('day >= ?')
+        params.append(_day(options.date_from))
+    if options.date_to:
+        conditions.append('day <= ?')
+        params.append(_day(options.date_to))
+    if options.after:
+        conditions.append('id > ?')
+        params.append(options.after[0])
+    if options.upto:
+        conditions.append('id <= ?')
+        params.append(options.upto[0])
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    return query + ' ORDER BY created_at DESC', params
+
+
+def _budget_query(options):
+    query = f'SELECT {", ".join(BUDGET_COLUMNS)} FROM planned_expenses'
+    conditions = []
+    params = []
+    if options.after:
+        conditions.append('id > ?')
+        params.append(options.after[1])
+    if options.upto:
+        conditions.append('id <= ?')
+        params.append(options.upto[1])
+    if conditions:
+        # Only budgets set or changed between the two change log ids
+        query += (
+            " WHERE id IN (SELECT row_id FROM change_log"
+            " WHERE table_name = 'planned_expenses' AND "
+            + ' AND '.join(conditions) + ')'
+        )
+    return query + ' ORDER BY month, category', params
+
+
+def iter_chunks(conn, query, params):
+    """Yield lists of rows of a query, CHUNK_SIZE rows at a time."""
+    cursor = conn.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(CHUNK_SIZE)
+        if not rows:
+            return
+        yield rows
+
+
+def _write_xlsx(output, tables):
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(
+        output, {'constant_memory': True, 'tmpdir': tempfile.gettempdir()}
+    )
+    for sheet_name, columns, chunks in tables:
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.write_row(0, 0, columns)
+        row_num = 1
+        for rows in chunks:
+            for row in rows:
+                worksheet.write_row(row_num, 0, row)
+                row_num += 1
+    workbook.close()
+
+
+def _write_csv(output, tables):
+    # A CSV file holds a single table, so only expenses are exported
+    _, columns, chunks = tables[0]
+    with gzip.GzipFile(fileobj=output, mode='wb') as gz, \
+            io.TextIOWrapper(gz, encoding='utf-8', newline='') as text:
+        writer = csv.writer(text)
+        writer.writerow(columns)
+        for rows in chunks:
+            writer.writerows(rows)
+
+
+def _write_jsonl(output, tables):
+    with gzip.GzipFile(fileobj=output, mode='wb') as gz, \
+            io.TextIOWrapper(gz, encoding='utf-8') as text:
+        for sheet_name, columns, chunks in tables:
+            table = sheet_name.lower()
+            for rows in chunks:
+                for row in rows:
+                    record = dict(zip(columns, row))
+                    record['table'] = table
+                    text.write(json.dumps(record, ensure_ascii=False))
+                    text.write('\n')
+
+
+WRITERS = {
+    'xlsx': _write_xlsx,
+    'csv': _write_csv,
+    'jsonl': _write_jsonl,
+}
+
+
+def export(options=None):
+    """Export expenses and budgets according to options.
+
+    Returns the file name and a file object positioned at the start of the
+    export. The caller must close the file object.
+    """
+    options = options or ExportOptions()
+    output = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        with database.read_conn() as conn:
+            tables = [
+                ('Expenses', options.columns,
+                 iter_chunks(conn, *_expense_query(options))),
+            ]
+            if options.fmt != 'csv':
+                tables.append(
+                    ('Budget', BUDGET_COLUMNS,
+                     iter_chunks(conn, *_budget_query(options)))
+                )
+            WRITERS[options.fmt](output, tables)
+    except Exception:
+        output.close()
+        raise
+
+    output.seek(0)
+    return FILE_NAMES[options.fmt], output
@@ -0,0 +1,277 @@
+"""Import expenses from bank-statement CSV files.
+
+Rows are read one at a time from a text stream and stored in batches, so
+memory use stays bounded however long the statement is. Every row gets a
+key derived from its date, amount and store, and rows whose key is
+already stored are skipped, which makes importing an overlapping
+statement again cheap and harmless. Identical rows on the same day are
+told apart by their order, which assumes the statement is sorted by
+date, as bank exports are. Amounts in other currencies are converted
+with the stored exchange rate nearest to each row's date.
+"""
+import bisect
+import csv
+import hashlib
+import shlex
+import time
+from datetime import date, datetime
+
+import currencyapi
+import database
+from categories import EXPENSE_CATEGORIES
+
+# Rows stored per transaction
+IMPORT_BATCH_SIZE = 1000
+# Seconds between progress reports
+PROGRESS_INTERVAL = 2.0
+# Rows converted with a rate stored further than this from their date
+# are counted in ImportResult.approximated
+RATE_MAX_GAP_DAYS = 7
+
+FIELDS = ('date', 'amount', 'pos', 'currency', 'category')
+
+
+class ImportOptions:
+    """Column mapping and number/date format of a CSV file.
+
+    Columns are given by header name or by 1-based position.
+    """
+
+    __slots__ = (
+        'columns', 'date_format', 'decimal', 'delimiter', 'encoding',
+        'currency', 'category', 'debits',
+    )
+
+    def __init__(self, columns=None, date_format='%Y-%m-%d', decimal='.',
+                 delimiter=',', encoding='utf-8-sig', currency='EUR',
+                 category='Misc', debits='positive'):
+        if decimal not in ('.', ','):
+            raise ValueError('decimal must be "." or ","')
+        if debits not in ('positive', 'negative'):
+            raise ValueError('debits must be "positive" or "negative"')
+        if category not in EXPENSE_CATEGORIES:
+            raise ValueError(f'Unknown category: {category}')
+        self.columns = {field: field for field in FIELDS}
+        self.columns.update(columns or {})
+        self.date_format = date_format
+        self.decimal = decimal
+        self.delimiter = delimiter
+        self.encoding = encoding
+        self.currency = currency.upper()
+        self.category = category
+        self.debits = debits
+
+
+def parse_options(args):
+    """Build ImportOptions from key=value words of an /import caption.
+
+    Values with spaces can be quoted, e.g. pos="Counterparty name".
+    """
+    columns = {}
+    kwargs = {}
+    for arg in shlex.split(' '.join(args)):
+        key, sep, value = arg.partition('=')
+        if not sep:
+            raise ValueError(f'Options must look like key=value: {arg}')
+        if key in FIELDS:
+            columns[key] = value
+        elif key in ImportOptions.__slots__ and key != 'columns':
+            kwargs[key] = value
+        else:
+            raise ValueError(f'Unknown option: {key}')
+    return ImportOptions(columns=columns, **kwargs)
+
+
+class ImportResult:
+    """Counts of an import in progress or finished."""
+
+    __slots__ = (
+        'read', 'imported', 'duplicates', 'skipped', 'errors', 'approximated',
+    )
+
+    def __init__(self):
+        self.read = 0
+        self.imported = 0
+        self.duplicates = 0
+        self.skipped = 0
+        self.errors = 0
+        self.approximated = 0
+
+    def __str__(self):
+        text = (
+            f'{self.read} rows read: {self.imported} imported, '
+            f'{self.duplicates} already present, {self.skipped} skipped, '
+            f'{self.errors} with errors'
+        )
+        if self.approximated:
+            text += (
+                f'. {self.approximated} rows were converted with an exchange '
+                f'rate more than {RATE_MAX_GAP_DAYS} days from their date, '
+                f'as no closer rate is stored'
+            )
+        return text
+
+
+class _RateHistory:
+    """Stored rates of a currency, looked up by the nearest date."""
+
+    __slots__ = ('dates', 'rates', 'days')
+
+    def __init__(self, currency):
+        rows = database.get_rate_history(currency)
+        if not rows:
+            # Nothing stored yet: fetch and store the current rates
+            currencyapi.get_rates()
+            rows = database.get_rate_history(currency)
+        self.dates = [row[0] for row in rows]
+        # Stored values are units per 1 EUR
+        self.rates = [1 / row[1] for row in rows]
+        # day -> (rate, rate date, whether the rate is far from the day)
+        self.days = {}
+
+    def lookup(self, when):
+        """Get the rate, its date and whether it is far from when."""
+        day = when.date()
+        found = self.days.get(day)
+        if found is None:
+            i = bisect.bisect_left(self.dates, day.isoformat())
+            nearest = min(
+                (j for j in (i - 1, i) if 0 <= j < len(self.dates)),
+                key=lambda j: abs(
+                    (date.fromisoformat(self.dates[j]) - day).days
+                ),
+            )
+            gap = abs((date.fromisoformat(self.dates[nearest]) - day).days)
+            found = self.days[day] = (
+                self.rates[nearest], self.dates[nearest],
+                gap > RATE_MAX_GAP_DAYS,
+            )
+        return found
+
+
+def _column_index(header, column):
+    if column.isdigit():
+        return int(column) - 1
+    try:
+        return header.index(column)
+    except ValueError:
+        return None
+
+
+def _parse_amount(text, decimal):
+    text = text.strip().replace(' ', '').replace('\xa0', '')
+    if decimal == ',':
+        text = text.replace('.', '').replace(',', '.')
+    else:
+        text = text.replace(',', '')
+    return float(text)
+
+
+def dedup_key(day, amount, pos, occurrence):
+    """Key of an imported row; occurrence tells identical rows apart."""
+    raw = f'{day}|{amount:.2f}|{pos.strip().lower()}|{occurrence}'
+    return hashlib.sha1(raw.encode()).hexdigest()[:20]
+
+
+def import_csv(text, options, username, progress=None):
+    """Import expenses from a CSV text stream.
+
+    progress(result) is called at most every PROGRESS_INTERVAL seconds.
+    """
+    reader = csv.reader(text, delimiter=options.delimiter)
+    header = [name.strip() for name in next(reader, [])]
+    index = {
+        field: _column_index(header, column)
+        for field, column in options.columns.items()
+    }
+    for field in ('date', 'amount', 'pos'):
+        if index[field] is None:
+            raise ValueError(f'Column not found: {options.columns[field]}')
+
+    result = ImportResult()
+    rates = {}
+    # Rows seen on the current day: (day, amount, pos) -> count
+    occurrences = {}
+    current_day = None
+    batch = []
+    created_at = datetime.now().isoformat()
+    last_report = time.monotonic()
+
+    def flush():
+        inserted = database.import_expenses(batch)
+        result.imported += inserted
+        result.duplicates += len(batch) - inserted
+        batch.clear()
+
+    def value(row, field, default=None):
+        i = index[field]
+        if i is None or i >= len(row) or not row[i].strip():
+            return default
+        return row[i].strip()
+
+    for row in reader:
+        if not any(row):
+            continue
+        result.read += 1
+        try:
+            when = datetime.strptime(value(row, 'date'), options.date_format)
+            amount = _parse_amount(value(row, 'amount'), options.decimal)
+            pos = value(row, 'pos')
+            currency = value(row, 'currency', options.currency).upper()
+        except (TypeError, ValueError, AttributeError):
+            result.errors += 1
+            continue
+        if options.debits == 'negative':
+            amount = -amount
+        if amount <= 0 or not pos:
+            result.skipped += 1
+            continue
+        category = value(row, 'category', options.category)
+        if category not in EXPENSE_CATEGORIES:
+            category = options.category
+
+        if currency == currencyapi.TARGET_CUR:
+            rate, rate_date = 1.0, None
+        else:
+            if currency not in rates:
+                rates[currency] = (
+                    _RateHistory(currency)
+                    if currencyapi.is_known_currency(currency) else None
+                )
+            history = rates[currency]
+            if history is None or not history.dates:
+                result.errors += 1
+                continue
+            rate, rate_date, far = history.lookup(when)
+            result.approximated += far
+
+        amount = round(amount, 2)
+        day = when.year * 10000 + when.month * 100 + when.day
+        if day != current_day:
+            occurrences.clear()
+            current_day = day
+        same = (day, amount, pos.lower())
+        occurrences[same] = occurrences.get(same, 0) + 1
+        batch.append((
+            when.strftime('%d/%m/%Y'),
+            username,
+            pos,
+            amount,
+            currency,
+            round(amount * rate, 2),
+            category,
+            created_at,
+            rate_date,
+            day,
+            day // 100,
+            dedup_key(day, amount, pos, occurrences[same]),
+        ))
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            flush()
+            if progress and time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                progress(result)
+                last_report = time.monotonic()
+
+    if batch:
+        flush()
+    return result
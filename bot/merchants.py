@@ -0,0 +1,203 @@
+"""Know the stores expenses were paid at.
+
+CategoryIndex predicts the category of an expense: every approved
+expense adds one vote for its category to the store's normalized name,
+and when one category holds a clear majority of a store's votes, it is
+suggested instead of asking for a category.
+
+PrefixIndex suggests store names while they are typed in inline mode,
+from a sorted list of names searched with bisect.
+
+Both are built from the same per-store counts; load_indexes() reads them
+once for all indexes.
+"""
+import bisect
+import logging
+import os
+import re
+import threading
+from collections import Counter
+
+import database
+
+# Expenses of a store needed before its category is predicted
+CATEGORY_MIN_COUNT = int(os.getenv('CATEGORY_MIN_COUNT', 3))
+# Share of a store's expenses the predicted category must have
+CATEGORY_MIN_SHARE = float(os.getenv('CATEGORY_MIN_SHARE', 0.8))
+
+# Suggestions returned for one inline query
+SUGGESTION_LIMIT = 10
+# Names looked at per query when a short prefix matches many stores
+SUGGESTION_SCAN_LIMIT = 500
+
+_WORD_PATTERN = re.compile(r'[^\W\d_]+')
+
+
+def normalize_pos(pos):
+    """Key of a store name: lower-case words, without digits or punctuation.
+
+    "PINGO DOCE #123, Lisboa" and "pingo doce lisboa" get the same key.
+    """
+    return ' '.join(_WORD_PATTERN.findall((pos or '').lower()))
+
+
+def search_key(pos):
+    """Key of a store name for prefix search; also ignores spaces.
+
+    "Pingo Doce" and "PingoDoce" get the same key.
+    """
+    return ''.join(_WORD_PATTERN.findall((pos or '').lower()))
+
+
+class CategoryIndex:
+    """Category counts of every store, updated as expenses are approved."""
+
+    def __init__(self, min_count=CATEGORY_MIN_COUNT,
+                 min_share=CATEGORY_MIN_SHARE):
+        self.min_count = min_count
+        self.min_share = min_share
+        # normalized store name -> Counter of categories
+        self._counts = {}
+        self._lock = threading.Lock()
+        self.stats = {'predicted': 0, 'unknown': 0, 'accepted': 0, 'corrected': 0}
+
+    def load(self, pos_counts=None):
+        """Build the index from database.get_pos_counts() rows."""
+        if pos_counts is None:
+            pos_counts = database.get_pos_counts()
+        counts = {}
+        for pos, category, _, count in pos_counts:
+            key = normalize_pos(pos)
+            if key:
+                counts.setdefault(key, Counter())[category] += count
+        with self._lock:
+            self._counts = counts
+        logging.info(f'Category index built for {len(counts)} stores')
+        return len(counts)
+
+    def add(self, pos, category, predicted=None):
+        """Count an approved expense; predicted is what was suggested."""
+        key = normalize_pos(pos)
+        if not key or not category:
+            return
+        with self._lock:
+            self._counts.setdefault(key, Counter())[category] += 1
+        if predicted is not None:
+            outcome = 'accepted' if predicted == category else 'corrected'
+            self.stats[outcome] += 1
+
+    def predict(self, pos):
+        """Get the dominant category of a store, or None if there is none."""
+        with self._lock:
+            counts = self._counts.get(normalize_pos(pos))
+            best = counts.most_common(1)[0] if counts else None
+            total = sum(counts.values()) if counts else 0
+        if (
+            best is None
+            or total < self.min_count
+            or best[1] < total * self.min_share
+        ):
+            self.stats['unknown'] += 1
+            return None
+        self.stats['predicted'] += 1
+        return best[0]
+
+    def hit_rate(self):
+        """Share of expenses whose category was predicted correctly."""
+        stats = self.stats
+        total = stats['predicted'] + stats['unknown']
+        return stats['accepted'] / total if total else 0.0
+
+    def __len__(self):
+        return len(self._counts)
+
+
+class _Store:
+    __slots__ = ('count', 'names', 'categories', 'currencies')
+
+    def __init__(self):
+        self.count = 0
+        self.names = Counter()
+        self.categories = Counter()
+        self.currencies = Counter()
+
+    def add(self, pos, category, currency, count=1):
+        self.count += count
+        self.names[pos] += count
+        self.categories[category] += count
+        self.currencies[currency] += count
+
+    def suggestion(self):
+        """Get the usual (spelling, category, currency) of the store."""
+        return (
+            self.names.most_common(1)[0][0],
+            self.categories.most_common(1)[0][0],
+            self.currencies.most_common(1)[0][0],
+        )
+
+
+class PrefixIndex:
+    """Stores by search key, kept sorted for prefix lookups."""
+
+    def __init__(self):
+        self._keys = []
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def load(self, pos_counts=None):
+        """Build the index from database.get_pos_counts() rows."""
+        if pos_counts is None:
+            pos_counts = database.get_pos_counts()
+        stores = {}
+        for pos, category, currency, count in pos_counts:
+            key = search_key(pos)
+            if key:
+                stores.setdefault(key, _Store()).add(
+                    pos.strip(), category, currency, count
+                )
+        with self._lock:
+            self._stores = stores
+            self._keys = sorted(stores)
+        logging.info(f'Prefix index built for {len(stores)} stores')
+        return len(stores)
+
+    def add(self, pos, category, currency):
+        """Count an expense added at a store."""
+        key = search_key(pos)
+        if not key:
+            return
+        with self._lock:
+            store = self._stores.get(key)
+            if store is None:
+                store = self._stores[key] = _Store()
+                bisect.insort(self._keys, key)
+            store.add(pos.strip(), category, currency)
+
+    def suggest(self, prefix, limit=SUGGESTION_LIMIT):
+        """Get (name, category, currency) of the most used matching stores.
+
+        At most SUGGESTION_SCAN_LIMIT stores are compared, so a short
+        prefix costs no more than a long one.
+        """
+        prefix = search_key(prefix)
+        with self._lock:
+            start = bisect.bisect_left(self._keys, prefix)
+            matches = []
+            for key in self._keys[start:start + SUGGESTION_SCAN_LIMIT]:
+                if not key.startswith(prefix):
+                    break
+                matches.append(self._stores[key])
+            matches.sort(key=lambda store: store.count, reverse=True)
+            return [store.suggestion() for store in matches[:limit]]
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def load_indexes(*indexes):
+    """Build indexes from one read of the stored counts.
+
+    Returns the number of stores in each index.
+    """
+    pos_counts = database.get_pos_counts()
+    return [index.load(pos_counts) for index in indexes]
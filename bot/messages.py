@@ -7,3 +7,33 @@ CATEGORY = 'What category does this expense belong to?'
 TRANSACTION_SAVED = 'Your expense is saved'
 TRANSACTION_DELETED = 'Your expense was deleted'
 STOP_INPUT = 'Input was stopped.'
+BATCH_ERRORS = 'These lines could not be read, please fix them and send the whole list again:'
+BATCH_TOO_LONG = 'Please send at most {} expenses at a time.'
+BATCH_UNKNOWN_CURRENCY = 'Unknown currency codes: {}. Please fix them and send the list again.'
+BATCH_CATEGORY = 'What category do the expenses at {} belong to?'
+BATCH_SUMMARY = 'Here are your expenses:'
+BATCH_SAVED = '{} expenses are saved'
+EXPENSE_EXPIRED = 'This expense is no longer pending, please send it again.'
+DUMP_USAGE = (
+    'Usage: /dump [since|full] [xlsx|csv|jsonl] [from=2024-01-01] '
+    '[to=2024-12-31] [columns=date,pos,amount_eur]'
+)
+DUMP_NO_CHANGES = 'Nothing was added or changed since your last dump.'
+DUMP_MODE_PARTIAL = (
+    '/dump since and /dump full move your dump watermark, so they always '
+    'export everything: use xlsx or jsonl without from=, to= or columns=.'
+)
+IMPORT_USAGE = (
+    'Send a CSV file with the caption /import and, if its columns are not '
+    'named date, amount, pos, currency and category, say which columns to '
+    'use, e.g.\n/import date="Booking date" amount=Amount pos=Payee '
+    'date_format=%d.%m.%Y decimal=, delimiter=; debits=negative'
+)
+IMPORT_DOWNLOAD_FAILED = "Couldn't download the file, please send it again."
+IMPORT_FAILED = 'The import failed, please try again later.'
+PROFILE_USAGE = (
+    'Usage: /profile [handlers N | renders N | slow MS]\n'
+    'handlers N profiles the next N handler calls, renders N traces the '
+    'memory of the next N table renders, slow MS logs queries slower than '
+    'MS milliseconds (0 turns it off).'
+)
@@ -0,0 +1,294 @@
+"""Latency and throughput metrics, served in the Prometheus text format.
+
+instrument_*() wrap bot handlers, module functions and Telegram API
+requests so that every call records its duration in a histogram and
+failed calls are counted. Collectors registered with add_collector()
+report current values, such as queue depths, when metrics are scraped.
+MetricsServer serves everything on GET /metrics.
+"""
+import bisect
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Port of the metrics endpoint; metrics are off when it is not set
+METRICS_PORT = os.getenv('METRICS_PORT', '')
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+_HELP = {
+    'handler': 'Time spent in bot update handlers',
+    'db': 'Time spent in database.py functions',
+    'telegram_api': 'Time spent in Telegram Bot API requests',
+    'currencyapi': 'Time spent in CurrencyAPI requests, retries included',
+}
+
+
+class Histogram:
+    """Count of observations per latency bucket, with their sum."""
+
+    __slots__ = ('counts', 'sum', 'count', 'errors')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, seconds, failed=False):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+        if failed:
+            self.errors += 1
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of its bucket."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank and seen:
+                return bound
+        return 0.0
+
+
+# (metric, label name, label value) -> Histogram
+_histograms = {}
+_lock = threading.Lock()
+_collectors = []
+
+
+def observe(metric, label, value, seconds, failed=False):
+    key = (metric, label, value)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(seconds, failed)
+
+
+def summary(metric):
+    """Get {label value: (calls, errors, p50, p99)} of a metric."""
+    with _lock:
+        return {
+            value: (h.count, h.errors, h.quantile(0.5), h.quantile(0.99))
+            for (name, _, value), h in _histograms.items()
+            if name == metric
+        }
+
+
+def timed(metric, label, value):
+    """Decorator recording the duration of every call of a function."""
+
+    def decorate(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                failed = True
+                try:
+                    result = await func(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    observe(
+                        metric, label, value,
+                        time.perf_counter() - start, failed,
+                    )
+
+            async_wrapper.__metrics__ = True
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                observe(metric, label, value, time.perf_counter() - start, failed)
+
+        wrapper.__metrics__ = True
+        return wrapper
+
+    return decorate
+
+
+def instrument_handlers(bot):
+    """Time every registered message, callback query and inline handler."""
+    for kind in ('message', 'callback_query', 'inline'):
+        for handler in getattr(bot, f'{kind}_handlers'):
+            func = handler['function']
+            if not getattr(func, '__metrics__', False):
+                handler['function'] = timed(
+                    'handler', 'handler', func.__name__
+                )(func)
+
+
+def instrument_module(module, metric, names):
+    """Replace functions of a module with timed versions."""
+    for name in names:
+        func = getattr(module, name)
+        if not getattr(func, '__metrics__', False):
+            setattr(module, name, timed(metric, 'function', name)(func))
+
+
+def public_functions(module):
+    """Names of the functions defined in a module, without a leading _.
+
+    Context managers are left out: timing them would only time their
+    creation.
+    """
+    return [
+        name for name, func in vars(module).items()
+        if inspect.isfunction(func)
+        and func.__module__ == module.__name__
+        and not name.startswith('_')
+        and not inspect.isgeneratorfunction(getattr(func, '__wrapped__', None))
+    ]
+
+
+def instrument_telegram():
+    """Time every Bot API request made by the synchronous TeleBot."""
+    from telebot import apihelper
+
+    make_request = apihelper._make_request
+    if getattr(make_request, '__metrics__', False):
+        return
+
+    @functools.wraps(make_request)
+    def timed_request(token, method_name, *args, **kwargs):
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = make_request(token, method_name, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            observe(
+                'telegram_api', 'method', method_name,
+                time.perf_counter() - start, failed,
+            )
+
+    timed_request.__metrics__ = True
+    apihelper._make_request = timed_request
+
+
+def add_collector(collect):
+    """Register collect(), returning (name, help, type, value) tuples.
+
+    type is 'gauge' or 'counter'; it is called on every scrape.
+    """
+    _collectors.append(collect)
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def render():
+    """Get all metrics in the Prometheus text exposition format."""
+    with _lock:
+        snapshot = sorted(
+            (key, list(h.counts), h.sum, h.count, h.errors)
+            for key, h in _histograms.items()
+        )
+    lines = []
+    seen = set()
+    for (metric, label, value), counts, total, count, errors in snapshot:
+        name = f'expensebot_{metric}_duration_seconds'
+        if metric not in seen:
+            seen.add(metric)
+            help_text = _HELP.get(metric, metric)
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+        labels = f'{label}="{value}"'
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS + (float('inf'),), counts):
+            cumulative += bucket
+            lines.append(
+                f'{name}_bucket{{{labels},le="{_format_bound(bound)}"}} '
+                f'{cumulative}'
+            )
+        lines.append(f'{name}_sum{{{labels}}} {total}')
+        lines.append(f'{name}_count{{{labels}}} {count}')
+    for metric in sorted(seen):
+        name = f'expensebot_{metric}_errors_total'
+        lines.append(f'# HELP {name} Failed calls')
+        lines.append(f'# TYPE {name} counter')
+        for (m, label, value), _, _, _, errors in snapshot:
+            if m == metric:
+                lines.append(f'{name}{{{label}="{value}"}} {errors}')
+
+    samples = []
+    for collect in _collectors:
+        try:
+            samples.extend(collect())
+        except Exception:
+            logging.exception('Metrics collector failed')
+    # Samples of one metric have to follow its HELP and TYPE lines
+    samples.sort(key=lambda sample: sample[0].split('{')[0])
+    for name, help_text, kind, value in samples:
+        base = name.split('{')[0]
+        if base not in seen:
+            seen.add(base)
+            lines.append(f'# HELP expensebot_{base} {help_text}')
+            lines.append(f'# TYPE expensebot_{base} {kind}')
+        lines.append(f'expensebot_{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    server_version = 'ExpenseBot'
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(HTTPStatus.NOT_FOUND)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = render().encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f'Metrics {self.address_string()}: {format % args}')
+
+
+class MetricsServer:
+    """HTTP server answering GET /metrics from a daemon thread."""
+
+    def __init__(self, host=METRICS_HOST, port=None):
+        port = int(METRICS_PORT) if port is None else port
+        self._server = ThreadingHTTPServer((host, port), _RequestHandler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_port
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name='metrics', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
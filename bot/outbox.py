@@ -0,0 +1,360 @@
+"""Send messages to Telegram within its flood limits.
+
+Handlers queue what they send instead of calling the Bot API directly.
+Background threads send the queued calls in order per chat, waiting
+for a token from a per-chat and a global token bucket before each one,
+and pause a chat for as long as Telegram asks when it answers 429.
+Uploads are sent by a thread of their own. Consecutive texts to a chat
+that are still waiting are sent as one message. Failed calls that
+nobody waits for are logged and dropped. Until start() is called, calls
+are made directly.
+"""
+import html
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from telebot.apihelper import ApiTelegramException
+
+# Messages per second to all chats
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', 25))
+# Messages per second to one private chat, and the burst allowed
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', 1))
+OUTBOX_CHAT_BURST = int(os.getenv('OUTBOX_CHAT_BURST', 3))
+# Messages per second to one group chat
+OUTBOX_GROUP_RATE = 20 / 60
+# Attempts at a call failing with network errors before it is dropped
+OUTBOX_MAX_ATTEMPTS = 3
+# Longest text Telegram accepts in one message
+MAX_MESSAGE_LENGTH = 4096
+# Calls go to one of two lanes, each sent by its own thread
+LANES = ('messages', 'uploads')
+UPLOAD_METHODS = frozenset(('send_document', 'send_photo'))
+# Calls that don't count towards the message limits
+UNLIMITED_METHODS = frozenset(('answer_callback_query',))
+
+
+class TokenBucket:
+    """Allow rate calls per second on average, and bursts of capacity."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        # Set from the retry_after of a 429 answer
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available."""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def idle(self, now):
+        """Whether the bucket is as good as a new one."""
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+class _Call:
+    __slots__ = ('method', 'args', 'kwargs', 'future', 'attempts')
+
+    def __init__(self, method, args, kwargs, future=None):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+
+    def merge(self, other):
+        """Append the text of another send_message call, if possible.
+
+        A waiting edit of a message is replaced by a newer edit of it.
+        """
+        if (
+            self.method == other.method == 'edit_message_text'
+            and self.args[1:] == other.args[1:]
+            and self.future is None and other.future is None
+        ):
+            self.args, self.kwargs = other.args, other.kwargs
+            return True
+        if (
+            self.method != 'send_message' or other.method != 'send_message'
+            or self.future is not None or other.future is not None
+            or set(self.kwargs) - {'parse_mode'}
+            or set(other.kwargs) - {'parse_mode', 'reply_markup'}
+        ):
+            return False
+        texts = [self.args[1], other.args[1]]
+        modes = [self.kwargs.get('parse_mode'), other.kwargs.get('parse_mode')]
+        if modes[0] != modes[1]:
+            if set(modes) != {None, 'HTML'}:
+                return False
+            # Plain text is escaped to be sent as HTML
+            texts = [
+                html.escape(str(text)) if mode is None else text
+                for text, mode in zip(texts, modes)
+            ]
+            modes = ['HTML', 'HTML']
+        text = f'{texts[0]}\n\n{texts[1]}'
+        if len(text) > MAX_MESSAGE_LENGTH:
+            return False
+        self.args = (self.args[0], text)
+        self.kwargs = dict(other.kwargs, parse_mode=modes[0])
+        return True
+
+
+def _retry_after(error):
+    if isinstance(error, ApiTelegramException) and error.error_code == 429:
+        parameters = error.result_json.get('parameters') or {}
+        return float(parameters.get('retry_after', 1))
+    return None
+
+
+class Outbox:
+    """Queue of Bot API calls, sent within the rate limits.
+
+    Uploads have their own lane and thread, so a slow upload to one chat
+    doesn't hold up the replies to the others. A chat's calls are still
+    made one at a time and in order across both lanes.
+    """
+
+    def __init__(self, bot, global_rate=OUTBOX_GLOBAL_RATE,
+                 chat_rate=OUTBOX_CHAT_RATE, chat_burst=OUTBOX_CHAT_BURST):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = {}
+        # lane -> chat_id -> deque of calls, chats in round-robin order
+        self._lanes = {lane: OrderedDict() for lane in LANES}
+        # Chats with a call being sent; their next call waits for it
+        self._busy = set()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self.stats = {
+            'sent': 0, 'coalesced': 0, 'retried': 0, 'rate_limited': 0,
+            'dropped': 0,
+        }
+
+    def start(self):
+        self._threads = [
+            threading.Thread(
+                target=self._work, args=(lane,), name=f'outbox-{lane}',
+                daemon=True,
+            )
+            for lane in LANES
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=10):
+        """Send what is queued, waiting at most timeout seconds."""
+        if not self._threads:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        self._threads = []
+        logging.info(f'Outbox stopped: {self.stats}')
+
+    def queued(self):
+        with self._cond:
+            return sum(
+                len(calls)
+                for pending in self._lanes.values()
+                for calls in pending.values()
+            )
+
+    def send_message(self, chat_id, text, parse_mode=None, reply_markup=None,
+                     **kwargs):
+        """Queue a text message; it may be merged with the one before."""
+        if parse_mode is not None:
+            kwargs['parse_mode'] = parse_mode
+        if reply_markup is not None:
+            kwargs['reply_markup'] = reply_markup
+        self._put(chat_id, _Call('send_message', (chat_id, text), kwargs))
+
+    def delete_message(self, chat_id, message_id):
+        self._put(
+            chat_id, _Call('delete_message', (chat_id, message_id), {})
+        )
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        """Queue an edit; a newer edit of the message replaces a waiting one."""
+        self._put(chat_id, _Call(
+            'edit_message_text', (text, chat_id, message_id), kwargs
+        ))
+
+    def edit_message_reply_markup(self, chat_id, message_id, reply_markup=None):
+        self._put(chat_id, _Call(
+            'edit_message_reply_markup', (chat_id, message_id),
+            {'reply_markup': reply_markup},
+        ))
+
+    def answer_callback_query(self, chat_id, callback_query_id, text=None):
+        """Queue the answer to a button press in the chat's turn.
+
+        Answers don't count towards the chat's message rate.
+        """
+        kwargs = {} if text is None else {'text': text}
+        self._put(chat_id, _Call(
+            'answer_callback_query', (callback_query_id,), kwargs
+        ))
+
+    def call(self, method, chat_id, *args, **kwargs):
+        """Make a Bot API call in turn with the chat's queued ones.
+
+        Blocks until it is made and returns its result or raises its error.
+        """
+        future = Future()
+        self._put(
+            chat_id, _Call(method, (chat_id, *args), kwargs, future)
+        )
+        return future.result()
+
+    def _put(self, chat_id, call):
+        if not self._threads:
+            self._send(call)
+            return
+        lane = 'uploads' if call.method in UPLOAD_METHODS else 'messages'
+        with self._cond:
+            pending = self._lanes[lane]
+            calls = pending.get(chat_id)
+            if calls and calls[-1].merge(call):
+                self.stats['coalesced'] += 1
+                return
+            if calls is None:
+                calls = pending[chat_id] = deque()
+            calls.append(call)
+            self._cond.notify_all()
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            rate = OUTBOX_GROUP_RATE if chat_id < 0 else self.chat_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def _ready(self, lane, chat_id):
+        """Whether a chat's next call in a lane may be sent now."""
+        if chat_id in self._busy:
+            return False
+        # An upload goes after the texts queued before it
+        return lane != 'uploads' or chat_id not in self._lanes['messages']
+
+    def _next(self, lane):
+        """Wait for a chat allowed to send and take its first call."""
+        pending = self._lanes[lane]
+        with self._cond:
+            while True:
+                if not pending:
+                    if self._stopping:
+                        return None, None
+                    self._prune()
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                global_wait = self._global.delay(now)
+                wait = None
+                for chat_id, calls in pending.items():
+                    # Chats that aren't ready wake the lane when they are
+                    if not self._ready(lane, chat_id):
+                        continue
+                    if calls[0].method in UNLIMITED_METHODS:
+                        return chat_id, self._take(pending, chat_id, now)
+                    chat_wait = max(
+                        global_wait, self._bucket(chat_id).delay(now)
+                    )
+                    if chat_wait <= 0:
+                        return chat_id, self._take(pending, chat_id, now)
+                    wait = chat_wait if wait is None else min(wait, chat_wait)
+                self._cond.wait(wait)
+
+    def _take(self, pending, chat_id, now):
+        calls = pending.pop(chat_id)
+        call = calls.popleft()
+        if calls:
+            # The chat goes to the back of the round
+            pending[chat_id] = calls
+        self._busy.add(chat_id)
+        if call.method not in UNLIMITED_METHODS:
+            self._global.take(now)
+            self._bucket(chat_id).take(now)
+        return call
+
+    def _prune(self):
+        now = time.monotonic()
+        for chat_id in [c for c, b in self._buckets.items() if b.idle(now)]:
+            del self._buckets[chat_id]
+
+    def _work(self, lane):
+        pending = self._lanes[lane]
+        while True:
+            chat_id, call = self._next(lane)
+            if call is None:
+                return
+            retry_after = self._send(call)
+            with self._cond:
+                self._busy.discard(chat_id)
+                if retry_after is not None:
+                    self._bucket(chat_id).blocked_until = (
+                        time.monotonic() + retry_after
+                    )
+                    calls = pending.pop(chat_id, deque())
+                    calls.appendleft(call)
+                    # Other chats go first while this one waits
+                    pending[chat_id] = calls
+                self._cond.notify_all()
+
+    def _send(self, call):
+        """Make a call. Returns seconds to wait before retrying it, if any."""
+        call.attempts += 1
+        try:
+            result = getattr(self.bot, call.method)(*call.args, **call.kwargs)
+        except Exception as error:
+            retry_after = _retry_after(error)
+            if retry_after is not None and self._threads:
+                self.stats['rate_limited'] += 1
+                logging.warning(
+                    f'{call.method} was rate limited, retrying in '
+                    f'{retry_after} s'
+                )
+                return retry_after
+            network_error = not isinstance(error, ApiTelegramException)
+            if (
+                network_error and self._threads
+                and call.attempts < OUTBOX_MAX_ATTEMPTS
+            ):
+                self.stats['retried'] += 1
+                return float(2 ** call.attempts)
+            if call.future is not None:
+                call.future.set_exception(error)
+            else:
+                self.stats['dropped'] += 1
+                logging.exception(f'Failed to {call.method}')
+            return None
+        self.stats['sent'] += 1
+        if call.future is not None:
+            call.future.set_result(result)
+        return None
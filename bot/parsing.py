@@ -0,0 +1,95 @@
+"""Parse expenses out of message text."""
+import re
+
+from categories import EXPENSE_CATEGORIES
+
+TRANS_REGEX = r'^(\d+(?:[.,]\d+)?)\s+(.*?)(?:\s+\(([^)]+)\))?$'
+DEFAULT_CURRENCY = 'EUR'
+# Most lines accepted in one batch message
+MAX_BATCH_LINES = 100
+
+_TRANS_PATTERN = re.compile(TRANS_REGEX, re.IGNORECASE)
+# Optional category at the end of a batch line, e.g. "12 Lidl #grocery"
+_CATEGORY_PATTERN = re.compile(r'\s+#(\w+)$')
+# Inline query: an amount followed by the beginning of a store name
+_INLINE_PATTERN = re.compile(r'^(\d+(?:[.,]\d+)?)(?:\s+(.*))?$')
+_CATEGORIES = {category.lower(): category for category in EXPENSE_CATEGORIES}
+
+
+def parse_message(message):
+    """Parse message text to create expanse data."""
+    match = _TRANS_PATTERN.match(message.strip())
+
+    amount_str = match.group(1).replace(',', '.')
+    pos = match.group(2).strip()
+    cur_str = match.group(3)
+
+    try:
+        amount = round(float(amount_str), 2)
+    except ValueError:
+        return None
+
+    if cur_str is None:
+        cur = DEFAULT_CURRENCY
+    else:
+        cur = cur_str.upper().strip()
+
+    return {'pos': pos, 'sum': amount, 'currency': cur}
+
+
+def is_batch(text):
+    """Check whether a message holds more than one line."""
+    return bool(text) and '\n' in text.strip()
+
+
+def parse_batch(text):
+    """Parse one expense per line, each with an optional #category suffix.
+
+    Returns the list of parsed expenses, with 'category' set to None when
+    the line has none, and the list of (line number, line) that could not
+    be parsed.
+    """
+    expenses = []
+    errors = []
+    lines = [line.strip() for line in text.strip().splitlines()]
+    for number, raw in enumerate(lines, start=1):
+        if not raw:
+            continue
+        line = raw
+        category = None
+        suffix = _CATEGORY_PATTERN.search(line)
+        if suffix:
+            category = _CATEGORIES.get(suffix.group(1).lower())
+            if category is None:
+                errors.append((number, raw))
+                continue
+            line = line[:suffix.start()]
+        if not _TRANS_PATTERN.match(line):
+            errors.append((number, raw))
+            continue
+        expense = parse_message(line)
+        if expense is None:
+            errors.append((number, raw))
+            continue
+        expense['category'] = category
+        expenses.append(expense)
+    return expenses, errors
+
+
+def parse_inline_query(text):
+    """Split "12.5 pin" into the amount and the typed part of the store.
+
+    Returns None when the query does not start with an amount.
+    """
+    match = _INLINE_PATTERN.match(text.strip())
+    if match is None:
+        return None
+    amount = match.group(1).replace(',', '.')
+    return amount, (match.group(2) or '').strip()
+
+
+def inline_expense_text(amount, pos, currency):
+    """Message text sent when an inline suggestion is chosen."""
+    if currency == DEFAULT_CURRENCY:
+        return f'{amount} {pos}'
+    return f'{amount} {pos} ({currency.lower()})'
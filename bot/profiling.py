@@ -0,0 +1,374 @@
+"""Profile a running bot without redeploying it.
+
+- The next N handler calls can be run under cProfile. The stats are
+  written to PROFILE_DIR as a .prof file and a readable summary.
+- The next N table renders can be traced with tracemalloc. Their peak
+  memory and largest allocations are written to PROFILE_DIR.
+- SQLite statements slower than SLOW_QUERY_MS are logged with their
+  query plan, and with their bound values if SLOW_QUERY_VALUES is set.
+
+Captures are requested with PROFILE_HANDLERS and PROFILE_RENDERS at
+start-up, or with the admin's /profile command. Every written summary
+is passed to the dump handler, which bot_main uses to send it to the
+admin chat.
+"""
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import sqlite3
+import threading
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime
+
+PROFILE_DIR = os.getenv(
+    'PROFILE_DIR',
+    os.path.join(
+        os.path.dirname(os.path.abspath(os.getenv('DB_FILE', 'expenses.db'))),
+        'profiles',
+    ),
+)
+# Statements taking at least this many ms are logged; 0 turns it off
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 0))
+# Log slow statements with their bound values, which hold user data
+SLOW_QUERY_VALUES = os.getenv('SLOW_QUERY_VALUES') == '1'
+# Slow statements kept for /profile
+SLOW_QUERY_HISTORY = 20
+# Lines of the profile and allocation summaries
+SUMMARY_LINES = 40
+# Statements whose query plan is logged when they are slow
+EXPLAINED = ('SELECT', 'WITH', 'UPDATE', 'DELETE')
+# Rows read at a time when a timed cursor is iterated
+ITER_CHUNK_ROWS = 256
+
+# Captures still to take: handler calls under cProfile, traced renders
+remaining = {
+    'handlers': int(os.getenv('PROFILE_HANDLERS', 0)),
+    'renders': int(os.getenv('PROFILE_RENDERS', 0)),
+}
+slow_queries = deque(maxlen=SLOW_QUERY_HISTORY)
+
+_lock = threading.Lock()
+# Only one capture runs at a time: profilers and tracemalloc are global
+_capture_lock = threading.Lock()
+_statement = threading.local()
+_dump_handler = None
+
+
+def set_dump_handler(handler):
+    """Call handler(path) with the summary of every finished capture."""
+    global _dump_handler
+    _dump_handler = handler
+
+
+def request(kind, count):
+    """Capture the next count handler calls or renders."""
+    if kind not in remaining:
+        raise ValueError(f'Unknown capture: {kind}')
+    with _lock:
+        remaining[kind] = count
+
+
+def set_slow_query_ms(ms):
+    """Change the slow query threshold; 0 turns the log off.
+
+    Open connections attach or detach their trace callback before their
+    next statement, in the thread using them: swapping it from another
+    thread could race with a callback in progress.
+    """
+    global SLOW_QUERY_MS
+    SLOW_QUERY_MS = float(ms)
+
+
+def _claim(kind):
+    """Take one capture of a kind and the capture lock, if available."""
+    with _lock:
+        if remaining[kind] <= 0 or not _capture_lock.acquire(blocking=False):
+            return False
+        remaining[kind] -= 1
+        return True
+
+
+def _write(name, suffix, text):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    path = os.path.join(PROFILE_DIR, f'{stamp}-{name}{suffix}')
+    mode = 'wb' if isinstance(text, bytes) else 'w'
+    with open(path, mode) as f:
+        f.write(text)
+    return path
+
+
+def _dump(path):
+    logging.info(f'Profile written to {path}')
+    if _dump_handler is not None:
+        try:
+            _dump_handler(path)
+        except Exception:
+            logging.exception(f'Failed to pass on the profile {path}')
+
+
+def profiled(func):
+    """Run calls of func under cProfile while handler captures remain."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _claim('handlers'):
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            _capture_lock.release()
+            _dump(_write_profile(func.__name__, profile, elapsed))
+
+    wrapper.__profiled__ = True
+    return wrapper
+
+
+def _write_profile(name, profile, elapsed):
+    stats_file = _write(name, '.prof', b'')
+    profile.dump_stats(stats_file)
+    out = io.StringIO()
+    out.write(f'{name}: {elapsed * 1000:.1f} ms\n\n')
+    stats = pstats.Stats(profile, stream=out)
+    stats.sort_stats('cumulative').print_stats(SUMMARY_LINES)
+    return _write(name, '.txt', out.getvalue())
+
+
+def traced(func):
+    """Trace memory allocated by calls of func while render captures remain."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _claim('renders'):
+            return func(*args, **kwargs)
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            after = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if not was_tracing:
+                tracemalloc.stop()
+            _capture_lock.release()
+            lines = [
+                f'{func.__name__}: {elapsed * 1000:.1f} ms, '
+                f'peak {peak / 2**20:.1f} MB traced',
+                '',
+            ]
+            lines += [
+                str(stat)
+                for stat in after.compare_to(before, 'lineno')[:SUMMARY_LINES]
+            ]
+            _dump(_write(func.__name__, '.txt', '\n'.join(lines) + '\n'))
+
+    wrapper.__profiled__ = True
+    return wrapper
+
+
+def instrument_handlers(bot):
+    """Make every registered handler available for cProfile captures."""
+    for kind in ('message', 'callback_query', 'inline'):
+        for handler in getattr(bot, f'{kind}_handlers'):
+            if not getattr(handler['function'], '__profiled__', False):
+                handler['function'] = profiled(handler['function'])
+
+
+def instrument_renderers(module, names):
+    """Make functions of a module available for tracemalloc captures."""
+    for name in names:
+        func = getattr(module, name)
+        if not getattr(func, '__profiled__', False):
+            setattr(module, name, traced(func))
+
+
+def _trace(statement):
+    # SQLite reports each statement with its bound values expanded, then
+    # the statements of the triggers it fires. The BEGIN sqlite3 adds
+    # before a write is skipped.
+    if (
+        getattr(_statement, 'sql', None) is None
+        and not statement.startswith('BEGIN')
+    ):
+        _statement.sql = statement
+
+
+def _check_slow(conn, sql, parameters, elapsed, statement=None):
+    if not SLOW_QUERY_MS or elapsed * 1000 < SLOW_QUERY_MS:
+        return
+    statement = statement or getattr(_statement, 'sql', None) or sql
+    plan = ''
+    if parameters is not None and sql.lstrip().upper().startswith(EXPLAINED):
+        try:
+            rows = sqlite3.Connection.execute(
+                conn, 'EXPLAIN QUERY PLAN ' + sql, parameters
+            ).fetchall()
+            plan = '\n'.join(f'  {row[-1]}' for row in rows)
+        except sqlite3.Error:
+            pass
+    slow_queries.append((time.time(), round(elapsed * 1000, 1), statement))
+    logging.warning(
+        f'Slow query ({elapsed * 1000:.1f} ms): {" ".join(statement.split())}'
+        + (f'\nQuery plan:\n{plan}' if plan else '')
+    )
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that reports statements slower than SLOW_QUERY_MS.
+
+    A statement returning rows is timed until its rows are exhausted,
+    the cursor is closed or reused, or it is garbage collected. Only the
+    time spent in SQLite counts, not the caller's work between fetches.
+    Iterating the cursor reads rows ITER_CHUNK_ROWS at a time.
+    """
+
+    _sql = None
+    _elapsed = 0.0
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        self.connection.sync_trace()
+        _statement.sql = None
+        start = time.perf_counter()
+        try:
+            super().execute(sql, parameters)
+        except BaseException:
+            _check_slow(
+                self.connection, sql, None, time.perf_counter() - start
+            )
+            raise
+        self._elapsed = time.perf_counter() - start
+        self._sql = sql
+        self._parameters = parameters
+        self._statement = getattr(_statement, 'sql', None)
+        if self.description is None:
+            self._finish()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        # Tracing every row would slow down imports; the statement is
+        # logged without values instead
+        self._finish()
+        _statement.sql = None
+        self.connection.sync_trace()
+        self.connection.set_trace_callback(None)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            elapsed = time.perf_counter() - start
+            if self.connection.traced:
+                self.connection.set_trace_callback(_trace)
+            # Plans of batched statements are not explained
+            _check_slow(self.connection, sql, None, elapsed)
+
+    def _finish(self, explain=True):
+        if self._sql is None:
+            return
+        sql, self._sql = self._sql, None
+        _check_slow(
+            self.connection, sql, self._parameters if explain else None,
+            self._elapsed, self._statement,
+        )
+
+    def _fetch(self, fetch, *args):
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            self._elapsed += time.perf_counter() - start
+
+    def fetchone(self):
+        row = self._fetch(super().fetchone)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._fetch(super().fetchmany, size)
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._fetch(super().fetchall)
+        self._finish()
+        return rows
+
+    def __iter__(self):
+        return self._rows()
+
+    def _rows(self):
+        while True:
+            rows = self.fetchmany(ITER_CHUNK_ROWS)
+            yield from rows
+            if len(rows) < ITER_CHUNK_ROWS:
+                return
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # The connection may be in use by another thread by now, so the
+        # plan is not explained
+        self._finish(explain=False)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose statements all go through TimedCursor."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.traced = False
+        self.sync_trace()
+
+    def sync_trace(self):
+        """Attach or detach the trace callback to match the settings."""
+        traced = bool(SLOW_QUERY_MS and SLOW_QUERY_VALUES)
+        if self.traced != traced:
+            self.traced = traced
+            self.set_trace_callback(_trace if self.traced else None)
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def status():
+    """Describe pending captures and the recent slow queries."""
+    lines = [
+        f'Handler profiles pending: {remaining["handlers"]}',
+        f'Render traces pending: {remaining["renders"]}',
+        f'Slow query threshold: {SLOW_QUERY_MS:g} ms'
+        + (' (off)' if not SLOW_QUERY_MS else '')
+        + (', with values' if SLOW_QUERY_VALUES else ''),
+        f'Profiles are written to {PROFILE_DIR}',
+    ]
+    if slow_queries:
+        lines.append('Recent slow queries:')
+        lines += [
+            f'{datetime.fromtimestamp(at):%H:%M:%S} {ms} ms: '
+            f'{" ".join(sql.split())[:200]}'
+            for at, ms, sql in slow_queries
+        ]
+    return '\n'.join(lines)
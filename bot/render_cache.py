@@ -0,0 +1,125 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+# Memory budget for cached PNG renders
+RENDER_CACHE_BYTES = int(os.getenv('RENDER_CACHE_BYTES', 32 * 1024 * 1024))
+# Optional directory for a second, on-disk cache tier
+RENDER_CACHE_DIR = os.getenv('RENDER_CACHE_DIR')
+RENDER_CACHE_DISK_BYTES = int(
+    os.getenv('RENDER_CACHE_DISK_BYTES', 256 * 1024 * 1024)
+)
+# Number of Telegram file_ids remembered for re-sending renders
+MAX_FILE_IDS = 1024
+
+_entries = OrderedDict()
+_size = 0
+_file_ids = OrderedDict()
+_lock = threading.Lock()
+
+stats = {
+    'hits': 0,
+    'disk_hits': 0,
+    'misses': 0,
+    'evictions': 0,
+    'file_id_hits': 0,
+}
+
+
+def make_key(renderer, *args, **kwargs):
+    """Build a cache key from the renderer and the data it draws."""
+    content = repr((renderer, args, sorted(kwargs.items())))
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _disk_path(key):
+    return os.path.join(RENDER_CACHE_DIR, f'{key}.png')
+
+
+def _put_memory(key, data):
+    global _size
+    with _lock:
+        if key in _entries:
+            _entries.move_to_end(key)
+            return
+        _entries[key] = data
+        _size += len(data)
+        while _size > RENDER_CACHE_BYTES and _entries:
+            _, evicted = _entries.popitem(last=False)
+            _size -= len(evicted)
+            stats['evictions'] += 1
+
+
+def _prune_disk():
+    files = [entry for entry in os.scandir(RENDER_CACHE_DIR) if entry.is_file()]
+    total = sum(entry.stat().st_size for entry in files)
+    for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+        if total <= RENDER_CACHE_DISK_BYTES:
+            break
+        total -= entry.stat().st_size
+        os.remove(entry.path)
+
+
+def get(key):
+    """Get cached PNG bytes for a key, or None."""
+    with _lock:
+        data = _entries.get(key)
+        if data is not None:
+            _entries.move_to_end(key)
+            stats['hits'] += 1
+            return data
+
+    if RENDER_CACHE_DIR:
+        try:
+            with open(_disk_path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            pass
+        else:
+            stats['disk_hits'] += 1
+            _put_memory(key, data)
+            return data
+
+    stats['misses'] += 1
+    return None
+
+
+def put(key, data):
+    """Cache PNG bytes under a key."""
+    _put_memory(key, data)
+    if not RENDER_CACHE_DIR:
+        return
+    try:
+        os.makedirs(RENDER_CACHE_DIR, exist_ok=True)
+        with open(_disk_path(key), 'wb') as f:
+            f.write(data)
+        _prune_disk()
+    except OSError as e:
+        logging.warning(f'Failed to write render cache to disk. Error = {e}')
+
+
+def get_file_id(key):
+    """Get the Telegram file_id of a render that was already uploaded."""
+    with _lock:
+        file_id = _file_ids.get(key)
+        if file_id is not None:
+            _file_ids.move_to_end(key)
+            stats['file_id_hits'] += 1
+        return file_id
+
+
+def put_file_id(key, file_id):
+    """Remember the Telegram file_id of an uploaded render."""
+    with _lock:
+        _file_ids[key] = file_id
+        _file_ids.move_to_end(key)
+        while len(_file_ids) > MAX_FILE_IDS:
+            _file_ids.popitem(last=False)
+
+
+def forget_file_id(key):
+    """Drop a file_id that Telegram no longer accepts."""
+    with _lock:
+        _file_ids.pop(key, None)
@@ -0,0 +1,197 @@
+"""Conversation state that survives restarts.
+
+Each chat in the middle of a conversation has one small record: an
+expense or a batch of expenses waiting for a currency, a category or
+approval, or a budget being set up. Records live in memory and are written through to the
+conversation_state table, so they are restored after a redeploy.
+Abandoned records are evicted after STATE_TTL seconds or when a store
+holds more than STATE_MAX_ENTRIES chats.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import database
+
+# Seconds after the last change before a conversation is dropped
+STATE_TTL = int(os.getenv('STATE_TTL', 24 * 60 * 60))
+# Conversations kept per store before the least recently used is dropped
+STATE_MAX_ENTRIES = int(os.getenv('STATE_MAX_ENTRIES', 10000))
+# Seconds between sweeps for expired conversations
+SWEEP_INTERVAL = 10 * 60
+
+
+class _Record:
+    __slots__ = ()
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls()
+        for name in cls.__slots__:
+            if name in data:
+                setattr(record, name, data[name])
+        return record
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()})'
+
+
+class PendingExpense(_Record):
+    """An expense being entered.
+
+    step is what the bot waits for: 'currency', 'category' or 'approval'.
+    predicted is the category suggested from the store's history, if any.
+    """
+
+    __slots__ = (
+        'step', 'pos', 'sum', 'currency', 'sum_in_eur', 'category', 'rate_date',
+        'predicted',
+    )
+
+    def __init__(self, pos=None, sum=None, currency=None, step=None):
+        self.step = step
+        self.pos = pos
+        self.sum = sum
+        self.currency = currency
+        self.sum_in_eur = None
+        self.category = None
+        self.rate_date = None
+        self.predicted = None
+
+
+class PendingBatch(_Record):
+    """Expenses entered in one message.
+
+    items are dicts with the PendingExpense fields; step is 'category'
+    while some items have no category, then 'approval'.
+    """
+
+    __slots__ = ('step', 'items')
+
+    def __init__(self, items=None, step=None):
+        self.step = step
+        self.items = items or []
+
+
+class BudgetSession(_Record):
+    """Budget targets being set up; step is 'month' or 'amount'."""
+
+    __slots__ = ('step', 'month', 'current_category', 'budgets')
+
+    def __init__(self, step='month'):
+        self.step = step
+        self.month = None
+        self.current_category = None
+        self.budgets = {}
+
+
+class StateStore:
+    """Per-chat records of one kind, kept in LRU order."""
+
+    def __init__(self, kind, record_type, ttl=STATE_TTL,
+                 max_entries=STATE_MAX_ENTRIES):
+        self.kind = kind
+        self.record_type = record_type
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # chat_id -> (updated_at, record)
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'restored': 0, 'expired': 0, 'evicted': 0}
+
+    def get(self, chat_id):
+        """Get the chat's record, or None if there is none or it expired."""
+        with self._lock:
+            entry = self._records.get(chat_id)
+            if entry is None:
+                return None
+            if time.time() - entry[0] < self.ttl:
+                self._records.move_to_end(chat_id)
+                return entry[1]
+            del self._records[chat_id]
+        self.stats['expired'] += 1
+        database.delete_state(self.kind, chat_id)
+        return None
+
+    def updated_at(self, chat_id):
+        entry = self._records.get(chat_id)
+        return entry[0] if entry else 0.0
+
+    def put(self, chat_id, record):
+        """Store the chat's record in memory and in the database."""
+        now = time.time()
+        database.save_state(
+            self.kind, chat_id, json.dumps(record.to_dict()), now
+        )
+        evicted = []
+        with self._lock:
+            self._records[chat_id] = (now, record)
+            self._records.move_to_end(chat_id)
+            while len(self._records) > self.max_entries:
+                evicted.append(self._records.popitem(last=False)[0])
+        for old_chat_id in evicted:
+            self.stats['evicted'] += 1
+            database.delete_state(self.kind, old_chat_id)
+
+    def pop(self, chat_id):
+        """Remove and return the chat's record."""
+        with self._lock:
+            entry = self._records.pop(chat_id, None)
+        database.delete_state(self.kind, chat_id)
+        return entry[1] if entry else None
+
+    def __contains__(self, chat_id):
+        return self.get(chat_id) is not None
+
+    def __len__(self):
+        return len(self._records)
+
+    def sweep(self):
+        """Drop expired records. Returns how many were dropped."""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [
+                chat_id for chat_id, (updated_at, _) in self._records.items()
+                if updated_at < cutoff
+            ]
+            for chat_id in expired:
+                del self._records[chat_id]
+        self.stats['expired'] += len(expired)
+        database.delete_expired_states(self.kind, cutoff)
+        return len(expired)
+
+    def restore(self):
+        """Load the records that have not expired from the database."""
+        rows = database.load_states(self.kind, time.time() - self.ttl)
+        with self._lock:
+            for chat_id, data, updated_at in rows[-self.max_entries:]:
+                record = self.record_type.from_dict(json.loads(data))
+                self._records[chat_id] = (updated_at, record)
+        self.stats['restored'] += len(rows)
+        return len(rows)
+
+
+def _sweep_loop(stores):
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        for store in stores:
+            try:
+                expired = store.sweep()
+            except Exception:
+                logging.exception(f'Failed to sweep {store.kind} state')
+                continue
+            if expired:
+                logging.info(f'Dropped {expired} expired {store.kind} conversations')
+
+
+def start_sweeper(*stores):
+    """Start a daemon thread that drops expired records periodically."""
+    threading.Thread(
+        target=_sweep_loop, args=(stores,), name='state-sweeper', daemon=True
+    ).start()
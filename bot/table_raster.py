@@ -0,0 +1,143 @@
+"""Draw text tables straight into a Pillow image."""
+import importlib.util
+import io
+import os
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+BACKGROUND = '#ffffff'
+GRID_COLOR = '#000000'
+FOOTER_COLOR = '#f2f2f2'
+
+# Font files matching the matplotlib backend, looked up without importing it
+FONT_FILES = {
+    ('normal', 'normal'): 'DejaVuSans.ttf',
+    ('bold', 'normal'): 'DejaVuSans-Bold.ttf',
+    ('normal', 'italic'): 'DejaVuSans-Oblique.ttf',
+    ('bold', 'italic'): 'DejaVuSans-BoldOblique.ttf',
+}
+
+
+def _font_dir():
+    spec = importlib.util.find_spec('matplotlib')
+    if spec is None or spec.origin is None:
+        return None
+    return os.path.join(os.path.dirname(spec.origin), 'mpl-data', 'fonts', 'ttf')
+
+
+@lru_cache(maxsize=None)
+def get_font(size, weight='normal', style='normal'):
+    """Get a TrueType font, falling back to Pillow's default font."""
+    font_dir = os.getenv('VIZ_FONT_DIR') or _font_dir()
+    if font_dir:
+        try:
+            return ImageFont.truetype(
+                os.path.join(font_dir, FONT_FILES[(weight, style)]), size
+            )
+        except OSError:
+            pass
+    return ImageFont.load_default(size)
+
+
+class CellStyle:
+    """Look of a single table cell."""
+
+    __slots__ = ('facecolor', 'color', 'weight', 'style')
+
+    def __init__(self, facecolor=BACKGROUND, color='#000000', weight='normal',
+                 style='normal'):
+        self.facecolor = facecolor
+        self.color = color
+        self.weight = weight
+        self.style = style
+
+
+DEFAULT_STYLE = CellStyle()
+
+
+def render_table(rows, title, styles=None, footer=None, font_size=20,
+                 title_size=32, padding=12):
+    """Render rows of text as a PNG table.
+
+    styles is an optional grid of CellStyle matching rows; footer is an
+    optional line of text drawn in a box below the table.
+    """
+    font = get_font(font_size)
+    title_font = get_font(title_size)
+    n_cols = max(len(row) for row in rows) if rows else 0
+
+    def style_of(i, j):
+        if styles is None:
+            return DEFAULT_STYLE
+        return styles[i][j]
+
+    # Column widths fit the widest cell in each column
+    widths = [0] * n_cols
+    for i, row in enumerate(rows):
+        for j, text in enumerate(row):
+            style = style_of(i, j)
+            cell_font = get_font(font_size, style.weight, style.style)
+            widths[j] = max(widths[j], cell_font.getlength(str(text)))
+    widths = [int(width) + 2 * padding for width in widths]
+    row_height = int(font_size * 1.8)
+
+    table_width = sum(widths)
+    title_height = int(title_size * 1.8)
+    footer_height = int(font_size * 3) if footer else 0
+    width = max(table_width, int(title_font.getlength(title))) + 2 * padding
+    height = (
+        title_height + row_height * len(rows) + footer_height + 2 * padding
+    )
+
+    image = Image.new('RGB', (width, height), BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    draw.text(
+        (width / 2, padding + title_height / 2),
+        title,
+        fill='#000000',
+        font=title_font,
+        anchor='mm',
+    )
+
+    left = (width - table_width) // 2
+    top = padding + title_height
+    for i, row in enumerate(rows):
+        x = left
+        y = top + i * row_height
+        for j in range(n_cols):
+            text = str(row[j]) if j < len(row) else ''
+            style = style_of(i, j)
+            box = (x, y, x + widths[j], y + row_height)
+            draw.rectangle(box, fill=style.facecolor, outline=GRID_COLOR)
+            if text:
+                draw.text(
+                    (x + widths[j] / 2, y + row_height / 2),
+                    text,
+                    fill=style.color,
+                    font=get_font(font_size, style.weight, style.style),
+                    anchor='mm',
+                )
+            x += widths[j]
+
+    if footer:
+        y = top + row_height * len(rows) + footer_height / 2
+        footer_width = font.getlength(footer) + 2 * padding
+        draw.rectangle(
+            (
+                width / 2 - footer_width / 2,
+                y - font_size,
+                width / 2 + footer_width / 2,
+                y + font_size,
+            ),
+            fill=FOOTER_COLOR,
+        )
+        draw.text(
+            (width / 2, y), footer, fill='#000000', font=font, anchor='mm'
+        )
+
+    buf = io.BytesIO()
+    # Fast compression: encoding dominates render time for big tables
+    image.save(buf, format='PNG', compress_level=1)
+    buf.seek(0)
+    return buf
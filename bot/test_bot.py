@@ -27,3 +27,276 @@ def test_parse_message_with_comma_decimal():
     assert result['pos'] == 'Apple'
     assert result['sum'] == 100.50
     assert result['currency'] == 'USD'
+
+
+def test_setup_bot_commands_skips_unchanged(db, monkeypatch):
+    """Check that commands are only registered when the command set changes."""
+    import bot_main
+
+    calls = []
+    monkeypatch.setattr(bot_main.bot, 'set_my_commands', calls.append)
+
+    assert bot_main.setup_bot_commands()
+    assert not bot_main.setup_bot_commands()
+    assert len(calls) == 1
+
+
+def test_pending_approval_survives_restart(db, monkeypatch):
+    """Check that an expense waiting for approval can be approved after a restart."""
+    from types import SimpleNamespace
+
+    import bot_main
+    import database
+    import state_store
+
+    for name in ('send_message', 'answer_callback_query', 'delete_message'):
+        monkeypatch.setattr(bot_main.bot, name, lambda *args, **kwargs: None)
+
+    def message(text):
+        return SimpleNamespace(text=text, chat=SimpleNamespace(id=7))
+
+    monkeypatch.setattr(bot_main, 'pending_expenses', state_store.StateStore(
+        'expense', state_store.PendingExpense
+    ))
+    bot_main.check_message_for_transaction(message('12.5 Shop'))
+    bot_main.continue_conversation(message('Grocery'))
+
+    # A new process only has what was written to the database
+    restarted = state_store.StateStore('expense', state_store.PendingExpense)
+    restarted.restore()
+    monkeypatch.setattr(bot_main, 'pending_expenses', restarted)
+    bot_main.callback_query(SimpleNamespace(
+        id='1',
+        data='approve',
+        message=SimpleNamespace(chat=SimpleNamespace(id=7), id=3),
+        from_user=SimpleNamespace(username='user'),
+    ))
+
+    assert database.get_last_expenses(1)[0][2:] == ('Shop', 12.5, 'EUR', 12.5, 'Grocery')
+    assert 7 not in restarted
+
+
+def test_batch_is_saved_with_one_approval(db, monkeypatch):
+    """Check that a multi-line message is converted once per currency and saved at once."""
+    from types import SimpleNamespace
+
+    import bot_main
+    import currencyapi
+    import database
+    import state_store
+
+    sent = []
+    monkeypatch.setattr(
+        bot_main.bot, 'send_message', lambda *args, **kwargs: sent.append(args)
+    )
+    for name in ('answer_callback_query', 'delete_message'):
+        monkeypatch.setattr(bot_main.bot, name, lambda *args, **kwargs: None)
+    monkeypatch.setattr(bot_main, 'pending_batches', state_store.StateStore(
+        'batch', state_store.PendingBatch
+    ))
+    monkeypatch.setattr(currencyapi, 'is_known_currency', lambda code: code == 'USD')
+    conversions = []
+
+    def convert(amount, currency):
+        conversions.append(currency)
+        return amount * 0.8, '2025-03-01'
+
+    monkeypatch.setattr(currencyapi, 'convert', convert)
+
+    def message(text):
+        return SimpleNamespace(text=text, chat=SimpleNamespace(id=7))
+
+    bot_main.check_message_for_batch(
+        message('10 Shop #grocery\n5 Cafe (usd)\n2.5 Taxi (usd)\n1 cafe (usd)')
+    )
+    # Asked once per store without a category
+    bot_main.continue_conversation(message('Misc'))
+    assert 'Taxi' in sent[-1][1]
+    bot_main.continue_conversation(message('Commute'))
+    bot_main.batch_callback_query(SimpleNamespace(
+        id='1',
+        data='approve_batch',
+        message=SimpleNamespace(chat=SimpleNamespace(id=7), id=3),
+        from_user=SimpleNamespace(username='user'),
+    ))
+
+    assert conversions == ['USD']
+    rows = sorted(row[2:] for row in database.get_last_expenses(10))
+    assert rows == [
+        ('Cafe', 5.0, 'USD', 4.0, 'Misc'),
+        ('Shop', 10.0, 'EUR', 10.0, 'Grocery'),
+        ('Taxi', 2.5, 'USD', 2.0, 'Commute'),
+        ('cafe', 1.0, 'USD', 0.8, 'Misc'),
+    ]
+    assert 'Total</b>: 16.80 EUR' in sent[-2][1]
+
+
+def test_known_store_skips_category_question(db, monkeypatch):
+    """Check that the category of a store used often is filled in for approval."""
+    from types import SimpleNamespace
+
+    import bot_main
+    import database
+    import merchants
+    import state_store
+
+    sent = []
+    monkeypatch.setattr(
+        bot_main.bot, 'send_message', lambda *args, **kwargs: sent.append(args)
+    )
+    for name in ('answer_callback_query', 'delete_message'):
+        monkeypatch.setattr(bot_main.bot, name, lambda *args, **kwargs: None)
+    monkeypatch.setattr(bot_main, 'pending_expenses', state_store.StateStore(
+        'expense', state_store.PendingExpense
+    ))
+    monkeypatch.setattr(bot_main, 'category_index', merchants.CategoryIndex(
+        min_count=2, min_share=0.8
+    ))
+
+    def message(text):
+        return SimpleNamespace(text=text, chat=SimpleNamespace(id=7))
+
+    approve = SimpleNamespace(
+        id='1',
+        data='approve',
+        message=SimpleNamespace(chat=SimpleNamespace(id=7), id=3),
+        from_user=SimpleNamespace(username='user'),
+    )
+    for _ in range(2):
+        bot_main.check_message_for_transaction(message('5 Pingo Doce'))
+        assert sent[-1][1] == bot_main.messages.CATEGORY
+        bot_main.continue_conversation(message('Grocery'))
+        bot_main.callback_query(approve)
+
+    bot_main.check_message_for_transaction(message('7 pingo doce'))
+    assert 'Grocery' in sent[-2][1]
+    bot_main.callback_query(approve)
+
+    assert database.get_last_expenses(1)[0][2:] == ('pingo doce', 7.0, 'EUR', 7.0, 'Grocery')
+    assert bot_main.category_index.stats['accepted'] == 1
+
+
+def test_inline_query_suggests_known_stores(monkeypatch):
+    """Check that an inline query is answered from the prefix index."""
+    from types import SimpleNamespace
+
+    import bot_main
+    import merchants
+
+    index = merchants.PrefixIndex()
+    index.add('Pingo Doce', 'Grocery', 'EUR')
+    index.add('Pizza Hut', 'Restaurants', 'USD')
+    monkeypatch.setattr(bot_main, 'pos_index', index)
+    answers = []
+    monkeypatch.setattr(
+        bot_main.bot,
+        'answer_inline_query',
+        lambda query_id, results, **kwargs: answers.append(results),
+    )
+
+    bot_main.suggest_stores(SimpleNamespace(id='1', query='12.5 piz'))
+    bot_main.suggest_stores(SimpleNamespace(id='2', query='piz'))
+
+    [result] = answers[0]
+    assert result.title == 'Pizza Hut'
+    assert result.input_message_content.message_text == '12.5 Pizza Hut (usd)'
+    assert answers[1] == []
+
+
+def test_unknown_text_gets_the_fallback_reply():
+    """Check that the catch-all reply is the last message handler."""
+    import bot_main
+
+    functions = [handler['function'] for handler in bot_main.bot.message_handlers]
+    assert functions[-1] is bot_main.send_basic_message
+    assert functions.index(bot_main.dump_data) < len(functions) - 1
+
+
+def test_failed_download_does_not_leak_the_token(monkeypatch, caplog):
+    """Check that the file URL, which holds the token, is never shown."""
+    from types import SimpleNamespace
+
+    import bot_main
+    import messages
+    import requests
+
+    url = 'https://api.telegram.org/file/bot123:SECRET/documents/file.csv'
+    sent = []
+    monkeypatch.setattr(bot_main.bot, 'get_file_url', lambda file_id: url)
+    monkeypatch.setattr(
+        bot_main.bot, 'send_message',
+        lambda *args, **kwargs: SimpleNamespace(message_id=2),
+    )
+    monkeypatch.setattr(
+        bot_main.bot, 'edit_message_text',
+        lambda text, chat_id, message_id: sent.append(text),
+    )
+
+    def get(*args, **kwargs):
+        raise requests.HTTPError(f'404 Client Error: Not Found for url: {url}')
+
+    monkeypatch.setattr(bot_main.requests, 'get', get)
+
+    bot_main.import_document(SimpleNamespace(
+        chat=SimpleNamespace(id=7),
+        caption='/import',
+        document=SimpleNamespace(file_id='f'),
+        from_user=SimpleNamespace(username='user'),
+    ))
+
+    assert sent == [messages.IMPORT_DOWNLOAD_FAILED]
+    assert 'SECRET' not in caplog.text
+
+
+def test_csv_dump_does_not_move_the_watermark(db, monkeypatch):
+    """Check that a partial dump cannot make "since" skip budgets or rows."""
+    from types import SimpleNamespace
+
+    import bot_main
+    import messages
+
+    sent = []
+    monkeypatch.setattr(bot_main, 'send_queue', SimpleNamespace(
+        send_message=lambda chat_id, text: sent.append(text),
+        call=lambda method, chat_id, document, **kwargs: sent.append(document[0]),
+    ))
+    db.add_expense('05/04/2025', 'user', 'Bakery', 3, 'EUR', 3, 'Grocery')
+    db.add_budget(4, 'Grocery', 120)
+
+    def dump(text):
+        bot_main.dump_data(SimpleNamespace(chat=SimpleNamespace(id=7), text=text))
+
+    dump('/dump since csv')
+    dump('/dump full jsonl columns=date,pos')
+    assert sent == [messages.DUMP_MODE_PARTIAL] * 2
+    assert db.get_export_watermark(7) == (0, 0)
+
+    dump('/dump since jsonl')
+    assert sent[-1] == 'database_dump.jsonl.gz'
+    assert db.get_export_watermark(7) == db.get_change_cursor()
+
+
+def test_currency_answer_reports_an_unavailable_api(monkeypatch):
+    """Check that a CurrencyAPI error in the currency step is sent back."""
+    from types import SimpleNamespace
+
+    import bot_main
+    import currencyapi
+    import state_store
+
+    sent = []
+    monkeypatch.setattr(bot_main, 'send_queue', SimpleNamespace(
+        send_message=lambda chat_id, text: sent.append(str(text)),
+    ))
+
+    def unavailable(code):
+        raise currencyapi.NoApiResponseError('Currency codes are not available')
+
+    monkeypatch.setattr(currencyapi, 'is_known_currency', unavailable)
+    trans_data = state_store.PendingExpense(sum=12.5, pos='Shop', step='currency')
+
+    bot_main.check_currency_code(
+        SimpleNamespace(chat=SimpleNamespace(id=7), text='usd'), trans_data
+    )
+
+    assert sent == ['Currency codes are not available']
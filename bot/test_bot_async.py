@@ -0,0 +1,122 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from telebot import types
+
+import bot_async
+import currencyapi
+
+
+def make_update(update_id, text, chat_id=1):
+    return types.Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'u'},
+            'text': text,
+        },
+    })
+
+
+class FakeBot:
+    """Synchronous bot whose report handler is slow."""
+
+    def __init__(self):
+        self.threaded = True
+        self.done = []
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            if update.message.text.startswith('/get_budget'):
+                time.sleep(0.3)
+            self.done.append((update.message.text, threading.current_thread().name))
+
+
+def test_expense_entry_is_not_blocked_by_reports():
+    """Check that reports render on the pool while expenses keep flowing."""
+    fake = FakeBot()
+    router = bot_async.UpdateRouter(fake, render_workers=2)
+
+    report = router.submit(make_update(1, '/get_budget'))
+    start = time.perf_counter()
+    router.submit(make_update(2, '10 Shop')).result()
+    router.submit(make_update(3, '5 Cafe')).result()
+    elapsed = time.perf_counter() - start
+    report.result()
+    router.shutdown()
+
+    assert not fake.threaded
+    assert elapsed < 0.2
+    assert [text for text, _ in fake.done] == ['10 Shop', '5 Cafe', '/get_budget']
+    assert fake.done[2][1].startswith('bot-render')
+
+
+def test_reports_stay_in_order_during_conversation():
+    """Check that a chat waiting for a reply keeps using the main worker."""
+    fake = FakeBot()
+    router = bot_async.UpdateRouter(fake, in_conversation=lambda chat_id: chat_id == 1)
+
+    assert router.executor_for(make_update(1, '/top')) is router.main_executor
+    assert router.executor_for(make_update(2, '/top', chat_id=2)) is router.render_executor
+    router.shutdown()
+
+
+def test_async_rates_refresh(db, monkeypatch):
+    """Check that rates fetched with aiohttp are stored and served."""
+    aiohttp = pytest.importorskip('aiohttp')
+    from aiohttp import web
+
+    monkeypatch.setattr(currencyapi, '_rates', {})
+
+    async def latest(request):
+        return web.json_response({
+            'meta': {'last_updated_at': '2025-03-01T23:59:59Z'},
+            'data': {'USD': {'code': 'USD', 'value': 1.25}},
+        })
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/v3/latest', latest)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        monkeypatch.setattr(
+            currencyapi, 'RATES_URL', f'http://127.0.0.1:{port}/v3/latest'
+        )
+        try:
+            async with aiohttp.ClientSession() as session:
+                return await currencyapi.refresh_rates_async(session)
+        finally:
+            await runner.cleanup()
+
+    assert asyncio.run(run())
+    assert currencyapi.convert(12.5, 'USD') == (10.0, '2025-03-01')
+
+
+def test_fresh_stored_data_is_not_refetched_on_start(db, monkeypatch):
+    """Check that the refresher waits until the stored rates go stale."""
+    monkeypatch.setattr(currencyapi, '_rates', {})
+    db.save_rates('2025-03-01', {'USD': 1.25})
+    calls = []
+
+    async def refresh(session, executor):
+        calls.append(time.monotonic())
+
+    async def run(ttl):
+        monkeypatch.setattr(currencyapi, 'RATES_TTL', ttl)
+        task = asyncio.create_task(bot_async._refresh_periodically(
+            refresh, currencyapi.rates_fresh_for, 60, None, None
+        ))
+        await asyncio.sleep(0.2)
+        task.cancel()
+
+    asyncio.run(run(3600))
+    assert calls == []
+    asyncio.run(run(0))
+    assert len(calls) == 1
@@ -0,0 +1,228 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import currencyapi
+import database
+
+
+def test_currency_codes_are_cached(db, monkeypatch):
+    """Check that currency codes are fetched once and served from memory."""
+    monkeypatch.setattr(currencyapi, '_codes', frozenset())
+    monkeypatch.setattr(currencyapi, '_codes_loaded_at', 0.0)
+    monkeypatch.setattr(
+        currencyapi, 'codes_stats', dict.fromkeys(currencyapi.codes_stats, 0)
+    )
+    calls = []
+
+    def fake_fetch():
+        calls.append(1)
+        return frozenset({'USD', 'CHF'})
+
+    monkeypatch.setattr(currencyapi, 'fetch_currency_codes', fake_fetch)
+
+    assert currencyapi.is_known_currency('USD')
+    assert not currencyapi.is_known_currency('XYZ')
+    assert currencyapi.is_known_currency('CHF')
+    assert len(calls) == 1
+    assert currencyapi.codes_stats['misses'] == 1
+    assert currencyapi.codes_stats['hits'] == 2
+
+
+def test_stale_codes_are_left_to_the_async_refresher(monkeypatch):
+    """Check that stale codes start no refresh thread when turned off."""
+    monkeypatch.setattr(currencyapi, '_codes', frozenset({'USD'}))
+    monkeypatch.setattr(currencyapi, '_codes_loaded_at', 0.0)
+    started = []
+    monkeypatch.setattr(
+        currencyapi, '_refresh_in_background', lambda: started.append(1)
+    )
+
+    currencyapi.set_background_refresh(False)
+    try:
+        assert currencyapi.is_known_currency('USD')
+    finally:
+        currencyapi.set_background_refresh(True)
+    assert started == []
+    assert currencyapi.is_known_currency('USD')
+    assert started == [1]
+
+
+def test_currency_codes_restored_from_database(db, monkeypatch):
+    """Check that stored codes are used when the API is not reachable."""
+    database.save_currency_codes({'GBP', 'JPY'})
+    monkeypatch.setattr(currencyapi, '_codes', frozenset())
+    monkeypatch.setattr(currencyapi, '_codes_loaded_at', 0.0)
+
+    def failing_fetch():
+        raise currencyapi.NoApiResponseError('No response from API')
+
+    monkeypatch.setattr(currencyapi, 'fetch_currency_codes', failing_fetch)
+
+    assert currencyapi.get_currency_codes() == frozenset({'GBP', 'JPY'})
+
+
+def test_convert_uses_local_cross_rates(db, monkeypatch):
+    """Check that conversions use one bulk fetch and stored cross-rates."""
+    monkeypatch.setattr(currencyapi, '_rates', {})
+    calls = []
+
+    def fake_fetch():
+        calls.append(1)
+        return '2025-03-01', {'USD': 1.25, 'GBP': 0.8}
+
+    monkeypatch.setattr(currencyapi, 'fetch_latest_rates', fake_fetch)
+
+    assert currencyapi.convert(12.5, 'USD') == (10.0, '2025-03-01')
+    assert currencyapi.convert(8, 'GBP') == (10.0, '2025-03-01')
+    assert currencyapi.convert(10, 'GBP', 'USD')[0] == 15.625
+    assert currencyapi.convert(10, 'EUR') == (10, None)
+    assert len(calls) == 1
+
+    monkeypatch.setattr(currencyapi, '_rates', {})
+    assert database.get_latest_rates()[2] == {'USD': 1.25, 'GBP': 0.8}
+    assert currencyapi.convert(12.5, 'USD') == (10.0, '2025-03-01')
+    assert len(calls) == 1
+
+
+class StubApi:
+    """Local HTTP server answering with the queued status codes, then 200."""
+
+    def __init__(self, statuses=(), body=None):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.statuses = list(statuses)
+        self.body = body
+        self.requests = 0
+        self.connections = set()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub.requests += 1
+                stub.connections.add(self.client_address)
+                status = stub.statuses.pop(0) if stub.statuses else 200
+                body = stub.body or json.dumps({
+                    'meta': {'last_updated_at': '2025-03-01T23:59:59Z'},
+                    'data': {'USD': {'code': 'USD', 'value': 1.25}},
+                }).encode()
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/v3/latest'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def use_stub(monkeypatch, stub, **breaker):
+    monkeypatch.setattr(currencyapi, 'RATES_URL', stub.url)
+    monkeypatch.setattr(currencyapi, 'RETRY_BASE_DELAY', 0.01)
+    monkeypatch.setattr(currencyapi, '_session', None)
+    monkeypatch.setattr(
+        currencyapi, '_breaker', currencyapi.CircuitBreaker(**breaker)
+    )
+    monkeypatch.setattr(
+        currencyapi, 'client_stats', dict.fromkeys(currencyapi.client_stats, 0)
+    )
+
+
+def test_client_retries_on_one_kept_alive_connection(monkeypatch):
+    """Check that 5xx answers are retried and connections are reused."""
+    stub = StubApi(statuses=[503, 502])
+    use_stub(monkeypatch, stub)
+    try:
+        assert currencyapi.fetch_latest_rates() == ('2025-03-01', {'USD': 1.25})
+        assert currencyapi.fetch_latest_rates()[1] == {'USD': 1.25}
+    finally:
+        stub.close()
+
+    stats = currencyapi.get_client_stats()
+    assert stub.requests == 4
+    assert len(stub.connections) == 1
+    assert stats['retries'] == 2
+    assert stats['failures'] == 2
+    assert stats['circuit'] == 'closed'
+
+
+def test_circuit_opens_and_closes_after_a_trial(monkeypatch):
+    """Check that requests are refused while CurrencyAPI keeps failing."""
+    stub = StubApi(statuses=[500] * 6)
+    use_stub(monkeypatch, stub, threshold=2, reset_timeout=0.2)
+    try:
+        for _ in range(2):
+            with pytest.raises(currencyapi.ServerResponseError):
+                currencyapi.fetch_latest_rates()
+        with pytest.raises(currencyapi.NoApiResponseError):
+            currencyapi.fetch_latest_rates()
+        assert stub.requests == 6
+        assert currencyapi.get_client_stats()['rejected'] == 1
+
+        time.sleep(0.2)
+        assert currencyapi.fetch_latest_rates()[1] == {'USD': 1.25}
+    finally:
+        stub.close()
+    assert currencyapi.get_client_stats()['circuit'] == 'closed'
+
+
+def test_invalid_json_counts_as_a_failure(monkeypatch):
+    """Check that a 200 answer that isn't JSON trips the circuit."""
+    stub = StubApi(body=b'<html>Maintenance</html>')
+    use_stub(monkeypatch, stub, threshold=1)
+    try:
+        with pytest.raises(currencyapi.ServerResponseError, match='JSON'):
+            currencyapi.fetch_latest_rates()
+    finally:
+        stub.close()
+    stats = currencyapi.get_client_stats()
+    assert (stats['failures'], stats['circuit']) == (1, 'open')
+
+
+def test_client_gives_up_on_a_hung_request(monkeypatch):
+    """Check that a request without an answer fails after the read timeout."""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    monkeypatch.setattr(
+        currencyapi,
+        'RATES_URL',
+        f'http://127.0.0.1:{listener.getsockname()[1]}/v3/latest',
+    )
+    monkeypatch.setattr(currencyapi, 'READ_TIMEOUT', 0.1)
+    monkeypatch.setattr(currencyapi, 'MAX_ATTEMPTS', 1)
+    monkeypatch.setattr(currencyapi, '_breaker', currencyapi.CircuitBreaker())
+    started = time.monotonic()
+    try:
+        with pytest.raises(currencyapi.NoApiResponseError):
+            currencyapi.fetch_latest_rates()
+    finally:
+        listener.close()
+    assert time.monotonic() - started < 2
+
+
+def test_attempts_must_be_positive():
+    """Check that CURRENCYAPI_ATTEMPTS=0 is refused when the module loads."""
+    result = subprocess.run(
+        [sys.executable, '-c', 'import currencyapi'],
+        capture_output=True, text=True,
+        cwd=os.path.dirname(currencyapi.__file__),
+        env={**os.environ, 'CURRENCYAPI_ATTEMPTS': '0'},
+    )
+    assert result.returncode != 0
+    assert 'CURRENCYAPI_ATTEMPTS must be at least 1' in result.stderr
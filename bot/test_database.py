@@ -0,0 +1,180 @@
+import sqlite3
+
+import pytest
+
+import database
+
+
+def test_connections_use_wal(db):
+    """Check that the shared connections are opened in WAL mode."""
+    with db.write_conn() as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    with db.read_conn() as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_reader_sees_committed_writes(db):
+    """Check that pooled readers see expenses added by the writer."""
+    db.add_expense('01/03/2025', 'user', 'Shop', 10, 'EUR', 10, 'Grocery')
+    db.add_expense('02/03/2025', 'user', 'Cafe', 5, 'EUR', 5, 'Misc')
+
+    rows = db.get_last_expenses(10)
+    assert {row[2] for row in rows} == {'Shop', 'Cafe'}
+
+
+def test_failed_write_is_rolled_back(db):
+    """Check that a write block that raises leaves no partial changes."""
+    with pytest.raises(RuntimeError):
+        with db.write_conn() as conn:
+            conn.execute(
+                'INSERT INTO currency_codes (code, updated_at) VALUES (?, ?)',
+                ('USD', 0),
+            )
+            raise RuntimeError
+
+    assert db.load_currency_codes() == (frozenset(), 0.0)
+
+
+def test_migrations_upgrade_legacy_database(tmp_path, monkeypatch):
+    """Check that a database created by the old init_db is backfilled."""
+    path = tmp_path / 'legacy.db'
+    conn = sqlite3.connect(path)
+    conn.execute("""
+    CREATE TABLE expenses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        date TEXT NOT NULL,
+        username TEXT NOT NULL,
+        pos TEXT NOT NULL,
+        amount REAL NOT NULL,
+        currency TEXT NOT NULL,
+        amount_eur REAL NOT NULL,
+        category TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )
+    """)
+    conn.execute(
+        'INSERT INTO expenses (date, username, pos, amount, currency, '
+        'amount_eur, category, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        ('07/02/2024', 'user', 'Shop', 3, 'EUR', 3, 'Misc', '2024-02-07T10:00:00'),
+    )
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(database, 'DB_FILE', str(path))
+    try:
+        database.init_db()
+        database.init_db()
+
+        assert database.get_schema_version() == database.MIGRATIONS[-1][0]
+        with database.read_conn() as conn:
+            row = conn.execute('SELECT day, period FROM expenses').fetchone()
+            plan = conn.execute(
+                'EXPLAIN QUERY PLAN SELECT category, SUM(amount_eur) '
+                'FROM expenses WHERE period = 202402 GROUP BY category'
+            ).fetchall()
+    finally:
+        database.close_connections()
+
+    assert row == (20240207, 202402)
+    assert 'USING COVERING INDEX idx_expenses_period' in plan[0][3]
+
+
+def test_period_report(db):
+    """Check totals, Travel split and top expenses of the period report."""
+    expenses = [
+        ('Shop', 10.004, 'Grocery'),
+        ('Market', 20, 'Grocery'),
+        ('Bakery', 1, 'Grocery'),
+        ('Flight', 300, 'Travel'),
+        ('Power', 50, 'Bills'),
+    ]
+    for pos, amount, category in expenses:
+        db.add_expense('01/03/2025', 'user', pos, amount, 'EUR', amount, category)
+
+    report = db.get_period_report(start_day=0, top_n=2)
+
+    assert report.category_totals == [('Bills', 50.0), ('Grocery', 31.0)]
+    assert report.total == 81.0
+    assert report.travel_total == 300.0
+    assert report.top_expenses == [
+        ('Bills', 'user', 'Power', 50.0),
+        ('Grocery', 'user', 'Market', 20.0),
+        ('Grocery', 'user', 'Shop', 10.0),
+    ]
+
+
+def test_budget_comparison_by_year(db):
+    """Check that the budget comparison only counts expenses of one year."""
+    db.add_budget(1, 'Grocery', 100)
+    with db.write_conn() as conn:
+        conn.executemany(
+            'INSERT INTO expenses (date, username, pos, amount, currency, '
+            'amount_eur, category, created_at, day, period) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [
+                ('', 'user', 'Shop', 30, 'EUR', 30, 'Grocery', '', 20240110, 202401),
+                ('', 'user', 'Shop', 50, 'EUR', 50, 'Grocery', '', 20250110, 202501),
+                ('', 'user', 'Cafe', 5, 'EUR', 5, 'Misc', '', 20250301, 202503),
+            ],
+        )
+
+    result = db.get_budget_comparison(2025)
+
+    assert [month['month'] for month in result] == [1, 3]
+    assert result[0]['Grocery_budget'] == 100
+    assert result[0]['Grocery_actual'] == 50
+    assert result[0]['Grocery_left'] == 50
+    assert result[1]['Misc_actual'] == 5
+    assert result[1]['Total_budget'] == 0
+    assert db.get_budget_comparison(2024)[0]['Grocery_actual'] == 30
+
+
+def test_monthly_totals_follow_expense_changes(db):
+    """Check that the rollup is updated on insert, update and delete."""
+    db.add_expense('01/03/2025', 'user', 'Shop', 10, 'EUR', 10, 'Grocery')
+    db.add_expense('01/03/2025', 'user', 'Market', 15, 'EUR', 15, 'Grocery')
+    db.add_expense('01/03/2025', 'user', 'Cafe', 5, 'EUR', 5, 'Misc')
+    with db.write_conn() as conn:
+        conn.execute("UPDATE expenses SET category = 'Misc' WHERE pos = 'Market'")
+        conn.execute("DELETE FROM expenses WHERE pos = 'Cafe'")
+        rollup = conn.execute(
+            'SELECT category, total_eur, count FROM monthly_totals '
+            'ORDER BY category'
+        ).fetchall()
+
+    assert rollup == [('Grocery', 10, 1), ('Misc', 15, 1)]
+    assert db.rebuild_rollups() == 0
+    assert (
+        db.get_period_report(start_day=0, top_n=0).category_totals
+        == db.get_period_report(start_day=0, top_n=1).category_totals
+    )
+
+
+def test_rebuild_rollups_repairs_drift(db):
+    """Check that rebuild_rollups reports and fixes inconsistent rows."""
+    db.add_expense('01/03/2025', 'user', 'Shop', 10, 'EUR', 10, 'Grocery')
+    with db.write_conn() as conn:
+        conn.execute('UPDATE monthly_totals SET total_eur = 99')
+
+    assert db.rebuild_rollups() == 1
+    assert db.rebuild_rollups() == 0
+
+
+def test_rollup_totals_start_mid_month(db):
+    """Check that rollup totals leave out the days before start_day."""
+    with db.write_conn() as conn:
+        conn.executemany(
+            'INSERT INTO expenses (date, username, pos, amount, currency, '
+            'amount_eur, category, created_at, day, period) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [
+                ('', 'user', 'Shop', 7, 'EUR', 7, 'Misc', '', 20250303, 202503),
+                ('', 'user', 'Shop', 30, 'EUR', 30, 'Grocery', '', 20250306, 202503),
+                ('', 'user', 'Shop', 20, 'EUR', 20, 'Grocery', '', 20250402, 202504),
+            ],
+        )
+
+    report = db.get_period_report(start_day=20250305, top_n=0)
+
+    assert report.category_totals == [('Grocery', 50.0)]
+    assert report.total == 50.0
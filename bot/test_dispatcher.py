@@ -0,0 +1,51 @@
+import threading
+import time
+
+from telebot import types
+
+import dispatcher
+
+
+def make_update(update_id, chat_id):
+    return types.Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'u'},
+            'text': str(update_id),
+        },
+    })
+
+
+def test_updates_keep_chat_order_and_run_in_parallel():
+    """Check per-chat ordering while different chats are handled at once."""
+    handled = {}
+    lock = threading.Lock()
+
+    def process(update):
+        time.sleep(0.05)
+        with lock:
+            handled.setdefault(update.message.chat.id, []).append(update.update_id)
+
+    workers = dispatcher.Dispatcher(process, workers=4)
+    workers.start()
+    start = time.perf_counter()
+    for update_id in range(5):
+        for chat_id in range(4):
+            workers.submit(make_update(update_id * 4 + chat_id, chat_id))
+    workers.stop()
+    elapsed = time.perf_counter() - start
+
+    assert handled == {
+        chat_id: [update_id * 4 + chat_id for update_id in range(5)]
+        for chat_id in range(4)
+    }
+    # 20 updates of 50 ms on 4 workers, not one after another
+    assert elapsed < 0.6
+    stats = workers.stats()
+    assert [worker['processed'] for worker in stats] == [5, 5, 5, 5]
+    assert all(worker['busy_seconds'] >= 0.25 for worker in stats)
+    assert all(worker['queued'] == 0 for worker in stats)
+
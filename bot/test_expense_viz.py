@@ -0,0 +1,54 @@
+import subprocess
+import sys
+
+from PIL import Image
+
+import expense_viz
+from categories import EXPENSE_CATEGORIES
+
+
+def budget_data(left):
+    month = {'month': 3}
+    for cat in EXPENSE_CATEGORIES + ['Total']:
+        month.update({f'{cat}_budget': 10, f'{cat}_actual': 10 - left,
+                      f'{cat}_left': left})
+    return [month]
+
+
+def test_pillow_backend_renders_png():
+    """Check that the Pillow backend draws expense and budget tables."""
+    buf = expense_viz.create_expense_table(
+        [('Grocery', 12.5)],
+        ['Category', 'Total Amount (EUR)'],
+        'Current Month Expenses',
+        include_total=True,
+        total=12.5,
+        travel_data=3,
+        backend='pillow',
+    )
+    assert buf.getvalue().startswith(b'\x89PNG')
+    assert expense_viz.create_budget_table([], backend='pillow') is None
+
+
+def test_pillow_budget_table_marks_overspending_red():
+    """Check that negative Left values are drawn in red."""
+    def has_red(data):
+        image = Image.open(expense_viz.create_budget_table(data, backend='pillow'))
+        colors = image.convert('RGB').getcolors(maxcolors=1 << 16)
+        return any(r > 200 and g < 80 and b < 80 for _, (r, g, b) in colors)
+
+    assert has_red(budget_data(-5))
+    assert not has_red(budget_data(5))
+
+
+def test_rendering_libraries_are_not_imported_up_front():
+    """Check that importing expense_viz loads neither Pillow nor pandas."""
+    code = (
+        'import sys, expense_viz; '
+        "print([m for m in ('PIL', 'pandas', 'matplotlib') if m in sys.modules])"
+    )
+    out = subprocess.run(
+        [sys.executable, '-c', code], capture_output=True, text=True, check=True,
+        cwd=expense_viz.os.path.dirname(expense_viz.__file__),
+    ).stdout
+    assert out.strip() == '[]'
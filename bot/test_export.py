@@ -0,0 +1,98 @@
+import csv
+import gzip
+import io
+import json
+import zipfile
+from datetime import date
+
+import pytest
+
+import database
+import export
+
+
+@pytest.fixture
+def db(db):
+    with database.write_conn() as conn:
+        conn.executemany(
+            'INSERT INTO expenses (date, username, pos, amount, currency, '
+            'amount_eur, category, created_at, day, period) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [
+                ('01/03/2025', 'user', 'Shop', 10, 'EUR', 10, 'Grocery',
+                 '2025-03-01T10:00:00', 20250301, 202503),
+                ('02/04/2025', 'user', 'Cafe', 5, 'EUR', 5, 'Misc',
+                 '2025-04-02T10:00:00', 20250402, 202504),
+            ],
+        )
+    database.add_budget(3, 'Grocery', 100)
+    return database
+
+
+def test_csv_export_with_date_range_and_columns(db, monkeypatch):
+    """Check that the CSV export streams only the selected rows and columns."""
+    monkeypatch.setattr(export, 'CHUNK_SIZE', 1)
+    options = export.parse_options(
+        ['csv', 'from=2025-03-01', 'to=2025-03-31', 'columns=pos,amount_eur']
+    )
+
+    file_name, output = export.export(options)
+    with output, gzip.open(output, 'rt', newline='') as text:
+        rows = list(csv.reader(text))
+
+    assert file_name.endswith('.csv.gz')
+    assert rows == [['pos', 'amount_eur'], ['Shop', '10.0']]
+
+
+def test_jsonl_export_includes_budgets(db):
+    """Check that JSON Lines exports both tables, tagged by table name."""
+    _, output = export.export(export.ExportOptions('jsonl'))
+    with output, gzip.open(output, 'rt') as text:
+        records = [json.loads(line) for line in text]
+
+    assert [r['table'] for r in records] == ['expenses', 'expenses', 'budget']
+    assert records[0]['pos'] == 'Cafe'
+    assert records[2]['amount_eur'] == 100
+
+
+def test_xlsx_export_has_both_sheets(db):
+    """Check that the XLSX export is a workbook with expense and budget sheets."""
+    pytest.importorskip('xlsxwriter')
+    _, output = export.export()
+    with output:
+        with zipfile.ZipFile(io.BytesIO(output.read())) as archive:
+            names = archive.namelist()
+
+    assert 'xl/worksheets/sheet1.xml' in names
+    assert 'xl/worksheets/sheet2.xml' in names
+
+
+def test_parse_options_rejects_bad_input():
+    """Check that unknown formats, columns and dates are reported."""
+    for args in (['pdf'], ['columns=secret'], ['from=2025/01/01'], ['x=1']):
+        with pytest.raises(ValueError):
+            export.parse_options(args)
+    assert export.parse_options([]).date_from is None
+    assert export.parse_options(['to=2025-01-31']).date_to == date(2025, 1, 31)
+
+
+def test_incremental_export_since_watermark(db):
+    """Check that an export between cursors only holds new rows and budgets."""
+    first = db.get_change_cursor()
+    db.add_expense('05/04/2025', 'user', 'Bakery', 3, 'EUR', 3, 'Grocery')
+    db.add_budget(3, 'Grocery', 120)
+    db.add_budget(4, 'Misc', 50)
+    db.set_export_watermark(42, first)
+
+    options = export.ExportOptions(
+        'jsonl', after=db.get_export_watermark(42), upto=db.get_change_cursor()
+    )
+    _, output = export.export(options)
+    with output, gzip.open(output, 'rt') as text:
+        records = [json.loads(line) for line in text]
+
+    assert [r.get('pos') for r in records if r['table'] == 'expenses'] == ['Bakery']
+    assert sorted(
+        (r['month'], r['amount_eur']) for r in records if r['table'] == 'budget'
+    ) == [('03', 120), ('04', 50)]
+    assert db.get_export_watermark(7) == (0, 0)
@@ -0,0 +1,83 @@
+import io
+
+import pytest
+
+import currencyapi
+import database
+import importer
+
+STATEMENT = '''Booking date;Payee;Amount;Currency
+01.03.2025;Lidl;-12,50;EUR
+01.03.2025;Lidl;-12,50;EUR
+02.03.2025;Salary;2.500,00;EUR
+03.03.2025;Amazon;-20,00;USD
+bad date;Cafe;-3,00;EUR
+'''
+
+
+@pytest.fixture
+def db(db, monkeypatch):
+    monkeypatch.setattr(currencyapi, 'is_known_currency', lambda code: code == 'USD')
+    database.save_rates('2025-03-01', {'EUR': 1.0, 'USD': 1.25})
+    database.save_rates('2025-03-05', {'EUR': 1.0, 'USD': 1.6})
+    return database
+
+
+def run_import(text, progress=None):
+    options = importer.parse_options([
+        'date="Booking date"', 'pos=Payee', 'amount=Amount',
+        'currency=Currency', 'date_format=%d.%m.%Y', 'decimal=,',
+        'delimiter=;', 'debits=negative',
+    ])
+    return importer.import_csv(io.StringIO(text), options, 'user', progress)
+
+
+def test_statement_is_imported(db):
+    """Check mapping, locale, currency conversion and skipped rows."""
+    result = run_import(STATEMENT)
+
+    assert (result.read, result.imported, result.skipped, result.errors) == (5, 3, 1, 1)
+    rows = sorted(row[1:] for row in db.get_last_expenses(10))
+    assert rows == [
+        ('user', 'Amazon', 20.0, 'USD', 16.0, 'Misc'),
+        ('user', 'Lidl', 12.5, 'EUR', 12.5, 'Misc'),
+        ('user', 'Lidl', 12.5, 'EUR', 12.5, 'Misc'),
+    ]
+    report = db.get_period_report(start_day=20250301, top_n=0)
+    assert report.total == 41.0
+
+
+def test_reimport_skips_duplicates(db, monkeypatch):
+    """Check that an overlapping statement only adds the new rows."""
+    run_import(STATEMENT)
+    monkeypatch.setattr(importer, 'IMPORT_BATCH_SIZE', 1)
+
+    result = run_import(STATEMENT + '04.03.2025;Lidl;-12,50;EUR\n')
+
+    assert (result.imported, result.duplicates) == (1, 3)
+    assert len(db.get_last_expenses(10)) == 4
+
+
+def test_missing_column_is_reported(db):
+    """Check that a mapping to a column that does not exist fails early."""
+    with pytest.raises(ValueError, match='Payee'):
+        importer.import_csv(
+            io.StringIO('date,amount\n2025-03-01,1\n'),
+            importer.ImportOptions(columns={'pos': 'Payee'}),
+            'user',
+        )
+
+
+def test_rows_use_the_rate_nearest_to_their_date(db):
+    """Check historical conversion and that distant rates are reported."""
+    result = run_import(
+        'Booking date;Payee;Amount;Currency\n'
+        '02.03.2025;Amazon;-10,00;USD\n'
+        '05.03.2025;Amazon;-16,00;USD\n'
+        '01.03.2023;Amazon;-10,00;USD\n'
+    )
+
+    assert (result.imported, result.approximated) == (3, 1)
+    assert 'rate more than 7 days from their date' in str(result)
+    amounts = sorted(row[5] for row in db.get_last_expenses(10))
+    assert amounts == [8.0, 8.0, 10.0]
@@ -0,0 +1,76 @@
+import database
+import merchants
+
+
+def test_normalize_pos():
+    """Check that store names differing in case, digits and punctuation match."""
+    assert merchants.normalize_pos('PINGO DOCE #123, Lisboa') == 'pingo doce lisboa'
+    assert merchants.normalize_pos('  Café  Nata ') == 'café nata'
+    assert merchants.normalize_pos('1234') == ''
+
+
+def test_predict_needs_a_dominant_category(db, monkeypatch):
+    """Check that a category is only predicted with enough agreeing history."""
+    database.add_expenses('01/03/2025', 'user', [
+        ('Pingo Doce', 10, 'EUR', 10, 'Grocery', None),
+        ('PINGO DOCE 42', 12, 'EUR', 12, 'Grocery', None),
+        ('Pingo Doce', 3, 'EUR', 3, 'Grocery', None),
+        ('Worten', 30, 'EUR', 30, 'Misc', None),
+    ])
+
+    index = merchants.CategoryIndex(min_count=3, min_share=0.8)
+    assert index.load() == 2
+    assert index.predict('pingo doce') == 'Grocery'
+    assert index.predict('Worten') is None
+
+    # A fourth expense in another category drops the share to 75%
+    index.add('Pingo Doce', 'Misc', predicted='Grocery')
+    assert index.predict('Pingo Doce') is None
+    index.add('Pingo Doce', 'Grocery', predicted='Grocery')
+    assert index.stats == {
+        'predicted': 1, 'unknown': 2, 'accepted': 1, 'corrected': 1,
+    }
+
+
+def test_prefix_index_suggests_most_used_stores(db, monkeypatch):
+    """Check that spellings of a store are merged and ranked by use."""
+    database.add_expenses('01/03/2025', 'user', [
+        ('Pingo Doce', 10, 'EUR', 10, 'Grocery', None),
+        ('pingo doce ', 12, 'EUR', 12, 'Grocery', None),
+        ('PingoDoce', 3, 'EUR', 3, 'Grocery', None),
+        ('Pizza Hut', 30, 'USD', 25, 'Restaurants', None),
+        ('Lidl', 5, 'EUR', 5, 'Grocery', None),
+    ])
+
+    index = merchants.PrefixIndex()
+    assert index.load() == 3
+    assert index.suggest('pi') == [
+        ('Pingo Doce', 'Grocery', 'EUR'),
+        ('Pizza Hut', 'Restaurants', 'USD'),
+    ]
+    assert index.suggest('Pingo D') == [('Pingo Doce', 'Grocery', 'EUR')]
+    assert index.suggest('x') == []
+
+    # Stores used equally often are listed alphabetically
+    index.add('Piri Piri', 'Restaurants', 'EUR')
+    assert [name for name, _, _ in index.suggest('pi')] == [
+        'Pingo Doce', 'Piri Piri', 'Pizza Hut',
+    ]
+    assert len(index.suggest('', limit=2)) == 2
+
+
+def test_indexes_share_one_read_of_the_counts(monkeypatch):
+    """Check that load_indexes() reads the stored counts once."""
+    reads = []
+
+    def get_pos_counts():
+        reads.append(1)
+        return [('Lidl', 'Grocery', 'EUR', 5), ('Uber', 'Commute', 'EUR', 1)]
+
+    monkeypatch.setattr(database, 'get_pos_counts', get_pos_counts)
+    categories, names = merchants.CategoryIndex(), merchants.PrefixIndex()
+
+    assert merchants.load_indexes(categories, names) == [2, 2]
+    assert reads == [1]
+    assert categories.predict('LIDL') == 'Grocery'
+    assert names.suggest('ub') == [('Uber', 'Commute', 'EUR')]
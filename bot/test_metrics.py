@@ -0,0 +1,99 @@
+import types
+import urllib.error
+import urllib.request
+
+import pytest
+from telebot import TeleBot
+from telebot import types as telegram
+
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def empty_registry(monkeypatch):
+    monkeypatch.setattr(metrics, '_histograms', {})
+    monkeypatch.setattr(metrics, '_collectors', [])
+
+
+def test_timed_functions_fill_histograms():
+    """Check that call durations and failures end up in the histogram."""
+    module = types.ModuleType('fake')
+
+    def fast():
+        return 1
+
+    def broken():
+        raise ValueError
+
+    fast.__module__ = broken.__module__ = 'fake'
+    module.fast, module.broken = fast, broken
+    metrics.instrument_module(module, 'db', metrics.public_functions(module))
+
+    for _ in range(3):
+        assert module.fast() == 1
+    with pytest.raises(ValueError):
+        module.broken()
+
+    text = metrics.render()
+    assert 'expensebot_db_duration_seconds_count{function="fast"} 3' in text
+    assert 'expensebot_db_duration_seconds_bucket{function="fast",le="+Inf"} 3' in text
+    assert 'expensebot_db_errors_total{function="broken"} 1' in text
+    calls, errors, p50, p99 = metrics.summary('db')['fast']
+    assert (calls, errors) == (3, 0)
+    assert p50 <= p99 <= metrics.BUCKETS[0]
+
+
+def test_handlers_are_timed_by_name():
+    """Check that bot handlers report under their function name."""
+    bot = TeleBot('123:abc', threaded=False)
+
+    @bot.message_handler(commands=['get_budget'])
+    def get_budget(message):
+        pass
+
+    metrics.instrument_handlers(bot)
+    metrics.instrument_handlers(bot)
+    bot.process_new_updates([telegram.Update.de_json({
+        'update_id': 1,
+        'message': {
+            'message_id': 1,
+            'date': 0,
+            'chat': {'id': 7, 'type': 'private'},
+            'from': {'id': 7, 'is_bot': False, 'first_name': 'A'},
+            'text': '/get_budget',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 11}],
+        },
+    })])
+
+    assert metrics.summary('handler')['get_budget'][0] == 1
+
+
+def test_server_serves_metrics_and_collectors():
+    """Check the /metrics endpoint with a collector reporting a gauge."""
+    metrics.observe('handler', 'handler', 'callback_query', 0.02)
+    metrics.add_collector(lambda: [
+        ('dispatch_queued{worker="1"}', 'Queued', 'gauge', 4),
+        ('outbox_queued', 'Queued', 'gauge', 2),
+        ('dispatch_queued{worker="0"}', 'Queued', 'gauge', 3),
+    ])
+    server = metrics.MetricsServer(port=0)
+    server.start()
+    try:
+        url = f'http://127.0.0.1:{server.port}'
+        with urllib.request.urlopen(f'{url}/metrics') as response:
+            text = response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f'{url}/other')
+    finally:
+        server.stop()
+
+    assert (
+        'expensebot_handler_duration_seconds_bucket'
+        '{handler="callback_query",le="0.025"} 1'
+    ) in text
+    lines = text.splitlines()
+    start = lines.index('# TYPE expensebot_dispatch_queued gauge')
+    assert lines[start + 1:start + 3] == [
+        'expensebot_dispatch_queued{worker="1"} 4',
+        'expensebot_dispatch_queued{worker="0"} 3',
+    ]
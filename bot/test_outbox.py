@@ -0,0 +1,143 @@
+import threading
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+import outbox
+
+
+class FakeBot:
+    """Record sent messages; fail the first call with 429 if asked to."""
+
+    def __init__(self, flood_once=False):
+        self.sent = []
+        self.flood_once = flood_once
+        self.release = threading.Event()
+        self.release.set()
+        self.uploading = threading.Event()
+        self.uploading.set()
+
+    def send_message(self, chat_id, text, parse_mode=None, reply_markup=None):
+        self.release.wait()
+        if self.flood_once:
+            self.flood_once = False
+            raise ApiTelegramException('sendMessage', None, {
+                'error_code': 429,
+                'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 0.2},
+            })
+        self.sent.append((chat_id, text, parse_mode, time.monotonic()))
+        return len(self.sent)
+
+    def send_document(self, chat_id, document):
+        self.uploading.wait(5)
+        self.sent.append((chat_id, document, None, time.monotonic()))
+
+    def edit_message_text(self, text, chat_id, message_id):
+        self.sent.append((chat_id, text, 'edit', time.monotonic()))
+
+    def answer_callback_query(self, callback_query_id, text=None):
+        self.sent.append((None, text, 'answer', time.monotonic()))
+
+
+def wait_for(box):
+    deadline = time.monotonic() + 5
+    while box.queued() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    box.stop()
+
+
+def test_waiting_texts_are_merged():
+    """Check that texts queued for a chat while it waits are sent as one."""
+    bot = FakeBot()
+    box = outbox.Outbox(bot)
+    box.start()
+    bot.release.clear()
+    box.send_message(1, 'first')
+    time.sleep(0.05)
+    # The first message is being sent, these two wait behind it
+    box.send_message(1, 'saved')
+    box.send_message(1, 'Only <b>5</b> EUR left', 'HTML')
+    box.send_message(2, 'other chat')
+    bot.release.set()
+    wait_for(box)
+
+    texts = [(chat_id, text, mode) for chat_id, text, mode, _ in bot.sent]
+    assert texts == [
+        (1, 'first', None),
+        (1, 'saved\n\nOnly <b>5</b> EUR left', 'HTML'),
+        (2, 'other chat', None),
+    ]
+    assert box.stats['coalesced'] == 1
+
+
+def test_chat_rate_and_retry_after():
+    """Check that a chat's rate is kept and a 429 answer is waited out."""
+    bot = FakeBot(flood_once=True)
+    box = outbox.Outbox(bot, chat_rate=20, chat_burst=1)
+    box.start()
+    started = time.monotonic()
+    assert box.call('send_message', 1, 'a') == 1
+    box.call('send_message', 1, 'b')
+    box.call('send_message', 1, 'c')
+    wait_for(box)
+
+    times = [sent_at for _, _, _, sent_at in bot.sent]
+    assert times[0] - started >= 0.2
+    assert all(b - a >= 0.04 for a, b in zip(times, times[1:]))
+    assert box.stats['rate_limited'] == 1
+
+
+def test_calls_are_direct_until_started():
+    """Check that calls are made at once when the queue is not running."""
+    bot = FakeBot()
+    box = outbox.Outbox(bot)
+    box.send_message(1, 'hello')
+    assert bot.sent[0][:2] == (1, 'hello')
+
+
+def test_uploads_do_not_hold_up_other_chats():
+    """Check that a slow upload leaves other chats' messages flowing."""
+    bot = FakeBot()
+    box = outbox.Outbox(bot)
+    box.start()
+    bot.uploading.clear()
+    upload = threading.Thread(
+        target=box.call, args=('send_document', 1, b'report')
+    )
+    upload.start()
+    time.sleep(0.05)
+    box.send_message(2, 'other chat')
+    box.send_message(1, 'after the upload')
+    deadline = time.monotonic() + 5
+    while len(bot.sent) < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # Chat 2 is answered while the upload to chat 1 is still running
+    assert [text for _, text, _, _ in bot.sent] == ['other chat']
+    bot.uploading.set()
+    upload.join(5)
+    wait_for(box)
+
+    assert [text for _, text, _, _ in bot.sent] == [
+        'other chat', b'report', 'after the upload',
+    ]
+
+
+def test_edits_are_replaced_and_answers_are_free():
+    """Check that a waiting edit is replaced and answers skip the rate."""
+    bot = FakeBot()
+    box = outbox.Outbox(bot, chat_rate=4, chat_burst=1)
+    box.start()
+    box.send_message(1, 'Importing...')
+    box.edit_message_text('Importing: 1000 rows', 1, 5)
+    box.edit_message_text('Imported: 2000 rows', 1, 5)
+    box.answer_callback_query(2, 'id', 'Approved')
+    deadline = time.monotonic() + 5
+    while len(bot.sent) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # Chat 1 waits for a token, the answer to chat 2 doesn't need one
+    assert {mode for _, _, mode, _ in bot.sent} == {None, 'answer'}
+    wait_for(box)
+
+    assert [text for _, text, _, _ in bot.sent][2:] == ['Imported: 2000 rows']
+    assert box.stats['coalesced'] == 1
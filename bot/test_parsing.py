@@ -0,0 +1,40 @@
+from parsing import (
+    inline_expense_text, parse_batch, parse_inline_query, parse_message,
+)
+
+
+def test_parse_message_with_currency_in_brackets():
+    """Check the amount, store and currency of a single expense."""
+    assert parse_message('12,5 Lidl (usd)') == {
+        'pos': 'Lidl', 'sum': 12.5, 'currency': 'USD'
+    }
+
+
+def test_parse_batch():
+    """Check that every line is parsed, with optional #category suffixes."""
+    text = '12.5 Lidl #grocery\n\n3 Coffee shop (usd)\n40 Train #Commute\n'
+
+    expenses, errors = parse_batch(text)
+
+    assert errors == []
+    assert expenses == [
+        {'pos': 'Lidl', 'sum': 12.5, 'currency': 'EUR', 'category': 'Grocery'},
+        {'pos': 'Coffee shop', 'sum': 3.0, 'currency': 'USD', 'category': None},
+        {'pos': 'Train', 'sum': 40.0, 'currency': 'EUR', 'category': 'Commute'},
+    ]
+
+
+def test_parse_batch_reports_bad_lines():
+    """Check that unreadable lines and unknown categories are reported."""
+    expenses, errors = parse_batch('10 Shop\nShop ten\n5 Cafe #coffee')
+
+    assert [expense['pos'] for expense in expenses] == ['Shop']
+    assert errors == [(2, 'Shop ten'), (3, '5 Cafe #coffee')]
+
+
+def test_parse_inline_query():
+    """Check that an inline query is split into amount and store prefix."""
+    assert parse_inline_query('12,5 pin') == ('12.5', 'pin')
+    assert parse_inline_query(' 7 ') == ('7', '')
+    assert parse_inline_query('pingo') is None
+    assert inline_expense_text('12.5', 'Pizza Hut', 'USD') == '12.5 Pizza Hut (usd)'
@@ -0,0 +1,109 @@
+import logging
+import sqlite3
+import time
+
+import profiling
+
+
+def test_slow_queries_are_logged_with_values_and_plan(monkeypatch, caplog):
+    """Check that a slow statement is logged with its values and plan."""
+    monkeypatch.setattr(profiling, 'SLOW_QUERY_MS', 1e-6)
+    monkeypatch.setattr(profiling, 'SLOW_QUERY_VALUES', True)
+    monkeypatch.setattr(profiling, 'slow_queries', profiling.deque(maxlen=5))
+    conn = sqlite3.connect(':memory:', factory=profiling.TimedConnection)
+    conn.execute('CREATE TABLE expenses (pos TEXT, amount REAL)')
+    conn.executemany('INSERT INTO expenses VALUES (?, ?)', [('Lidl', 1.5)] * 3)
+
+    with caplog.at_level(logging.WARNING):
+        rows = conn.cursor().execute(
+            'SELECT SUM(amount) FROM expenses WHERE pos = ?', ('Lidl',)
+        ).fetchall()
+
+    assert rows == [(4.5,)]
+    _, _, statement = profiling.slow_queries[-1]
+    assert statement == "SELECT SUM(amount) FROM expenses WHERE pos = 'Lidl'"
+    assert 'SCAN expenses' in caplog.records[-1].getMessage()
+    assert profiling.slow_queries[1][2] == 'INSERT INTO expenses VALUES (?, ?)'
+    profiling.set_slow_query_ms(0)
+    conn.execute('SELECT 1')
+    assert len(profiling.slow_queries) == 3
+
+
+def test_streamed_rows_are_timed_until_exhausted(monkeypatch):
+    """Check that a scan is timed over all its rows, not only execute()."""
+    monkeypatch.setattr(profiling, 'SLOW_QUERY_MS', 0.0)
+    monkeypatch.setattr(profiling, 'SLOW_QUERY_VALUES', True)
+    monkeypatch.setattr(profiling, 'slow_queries', profiling.deque(maxlen=5))
+    conn = sqlite3.connect(':memory:', factory=profiling.TimedConnection)
+    conn.create_function('slow', 1, lambda x: time.sleep(0.005) or x)
+    conn.execute('CREATE TABLE t (x INTEGER)')
+    conn.executemany('INSERT INTO t VALUES (?)', [(i,) for i in range(10)])
+
+    # Turned on at runtime, the trace callback is attached before the
+    # connection's next statement
+    profiling.set_slow_query_ms(30)
+    assert sum(x for x, in conn.execute('SELECT slow(x) FROM t')) == 45
+
+    assert conn.traced
+    [(_, ms, statement)] = profiling.slow_queries
+    assert ms >= 30
+    assert statement == 'SELECT slow(x) FROM t'
+    profiling.set_slow_query_ms(0)
+    conn.execute('SELECT 1')
+
+
+def test_values_are_only_logged_when_asked(monkeypatch, caplog):
+    """Check that slow statements are logged without user data by default."""
+    monkeypatch.setattr(profiling, 'SLOW_QUERY_MS', 1e-6)
+    monkeypatch.setattr(profiling, 'slow_queries', profiling.deque(maxlen=5))
+    conn = sqlite3.connect(':memory:', factory=profiling.TimedConnection)
+    conn.execute('CREATE TABLE expenses (pos TEXT)')
+
+    with caplog.at_level(logging.WARNING):
+        conn.execute('SELECT * FROM expenses WHERE pos = ?', ('Lidl',))
+
+    assert not conn.traced
+    assert 'Lidl' not in caplog.text
+    assert profiling.slow_queries[-1][2] == 'SELECT * FROM expenses WHERE pos = ?'
+    assert 'with values' not in profiling.status()
+    assert not conn.traced
+
+
+def test_next_handler_calls_are_profiled(tmp_path, monkeypatch):
+    """Check that only the requested number of calls is profiled."""
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', str(tmp_path))
+    dumped = []
+    monkeypatch.setattr(profiling, '_dump_handler', dumped.append)
+
+    @profiling.profiled
+    def get_budget(n):
+        return sum(range(n))
+
+    profiling.request('handlers', 1)
+    assert get_budget(1000) == 499500
+    assert get_budget(10) == 45
+
+    assert sorted(path.suffix for path in tmp_path.iterdir()) == ['.prof', '.txt']
+    [summary] = dumped
+    assert summary.endswith('-get_budget.txt')
+    with open(summary) as f:
+        assert 'function calls' in f.read()
+
+
+def test_render_memory_is_traced(tmp_path, monkeypatch):
+    """Check that a traced render reports its peak memory."""
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', str(tmp_path))
+    monkeypatch.setattr(profiling, '_dump_handler', None)
+
+    @profiling.traced
+    def create_expense_table():
+        return len([bytes(1000) for _ in range(1000)])
+
+    profiling.request('renders', 1)
+    assert create_expense_table() == 1000
+
+    [report] = tmp_path.iterdir()
+    first_line = report.read_text().splitlines()[0]
+    assert first_line.startswith('create_expense_table:')
+    assert 'peak 1.' in first_line
+    assert profiling.remaining['renders'] == 0
@@ -0,0 +1,43 @@
+from collections import OrderedDict
+
+import render_cache
+
+
+def reset_cache(monkeypatch, max_bytes, cache_dir=None):
+    monkeypatch.setattr(render_cache, '_entries', OrderedDict())
+    monkeypatch.setattr(render_cache, '_size', 0)
+    monkeypatch.setattr(render_cache, '_file_ids', OrderedDict())
+    monkeypatch.setattr(render_cache, 'RENDER_CACHE_BYTES', max_bytes)
+    monkeypatch.setattr(render_cache, 'RENDER_CACHE_DIR', cache_dir)
+
+
+def test_cache_key_depends_on_renderer_and_data():
+    """Check that keys change with the renderer and the rendered data."""
+    key = render_cache.make_key('table', [('a', 1)], title='t')
+    assert key == render_cache.make_key('table', [('a', 1)], title='t')
+    assert key != render_cache.make_key('chart', [('a', 1)], title='t')
+    assert key != render_cache.make_key('table', [('a', 2)], title='t')
+    assert key != render_cache.make_key('table', [('a', 1)], title='u')
+
+
+def test_least_recently_used_renders_are_evicted(monkeypatch):
+    """Check that the memory tier stays within its byte budget."""
+    reset_cache(monkeypatch, max_bytes=10)
+    render_cache.put('a', b'12345')
+    render_cache.put('b', b'12345')
+    render_cache.get('a')
+    render_cache.put('c', b'12345')
+
+    assert render_cache.get('a') == b'12345'
+    assert render_cache.get('b') is None
+    assert render_cache.get('c') == b'12345'
+
+
+def test_disk_tier_survives_memory_eviction(tmp_path, monkeypatch):
+    """Check that renders evicted from memory are read back from disk."""
+    reset_cache(monkeypatch, max_bytes=5, cache_dir=str(tmp_path))
+    render_cache.put('a', b'12345')
+    render_cache.put('b', b'67890')
+
+    assert render_cache.get('a') == b'12345'
+    assert render_cache.stats['disk_hits'] >= 1
@@ -0,0 +1,54 @@
+import time
+
+import state_store
+
+
+def test_records_are_restored_after_restart(db):
+    """Check that a new store gets the records written by the old one."""
+    store = state_store.StateStore('expense', state_store.PendingExpense)
+    expense = state_store.PendingExpense('Shop', 12.5, 'USD', step='approval')
+    expense.sum_in_eur = 10.0
+    store.put(1, expense)
+    session = state_store.BudgetSession()
+    session.budgets = {'Grocery': 100.0}
+    state_store.StateStore('budget', state_store.BudgetSession).put(1, session)
+
+    restored = state_store.StateStore('expense', state_store.PendingExpense)
+    assert restored.restore() == 1
+    record = restored.get(1)
+    assert record.to_dict() == expense.to_dict()
+    assert not hasattr(record, '__dict__')
+
+    budgets = state_store.StateStore('budget', state_store.BudgetSession)
+    budgets.restore()
+    assert budgets.get(1).budgets == {'Grocery': 100.0}
+
+
+def test_expired_records_are_dropped(db, monkeypatch):
+    """Check TTL expiry on read, on sweep and on restore."""
+    store = state_store.StateStore('budget', state_store.BudgetSession, ttl=60)
+    store.put(1, state_store.BudgetSession())
+    store.put(2, state_store.BudgetSession())
+
+    now = time.time()
+    monkeypatch.setattr(state_store.time, 'time', lambda: now + 61)
+    assert store.get(1) is None
+    assert store.sweep() == 1
+    assert len(store) == 0
+    assert db.load_states('budget', 0) == []
+
+
+def test_least_recently_used_records_are_evicted(db):
+    """Check that a full store evicts the chat used least recently."""
+    store = state_store.StateStore(
+        'expense', state_store.PendingExpense, max_entries=2
+    )
+    for chat_id in (1, 2):
+        store.put(chat_id, state_store.PendingExpense('Shop', 1, 'EUR'))
+    store.get(1)
+    store.put(3, state_store.PendingExpense('Cafe', 2, 'EUR'))
+
+    assert 2 not in store
+    assert 1 in store and 3 in store
+    assert store.stats['evicted'] == 1
+    assert sorted(row[0] for row in db.load_states('expense', 0)) == [1, 3]
@@ -0,0 +1,106 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import webhook
+
+UPDATE = {
+    'update_id': 10,
+    'message': {
+        'message_id': 1,
+        'date': 0,
+        'chat': {'id': 5, 'type': 'private'},
+        'from': {'id': 5, 'is_bot': False, 'first_name': 'u'},
+        'text': '10 Shop',
+    },
+}
+
+
+def post(server, body, secret='s3cret', path='/webhook'):
+    request = urllib.request.Request(
+        f'http://127.0.0.1:{server.port}{path}',
+        data=body if isinstance(body, bytes) else json.dumps(body).encode(),
+        headers={webhook.SECRET_HEADER: secret},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+@pytest.fixture
+def make_server():
+    servers = []
+
+    def make(process, **kwargs):
+        kwargs.setdefault('secret', 's3cret')
+        server = webhook.WebhookServer(
+            process, host='127.0.0.1', port=0, **kwargs
+        )
+        server.start()
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.stop()
+
+
+def test_updates_are_queued_and_processed(make_server):
+    """Check that a recorded update is accepted and handed to a worker."""
+    processed = []
+    done = threading.Event()
+
+    def process(update):
+        processed.append((update.update_id, update.message.text))
+        done.set()
+
+    server = make_server(process)
+
+    assert post(server, UPDATE) == 200
+    assert done.wait(5)
+    assert processed == [(10, '10 Shop')]
+
+
+def test_bad_requests_are_rejected(make_server):
+    """Check the secret token, the path and the payload are validated."""
+    server = make_server(lambda update: None)
+
+    assert post(server, UPDATE, secret='wrong') == 403
+    assert post(server, UPDATE, path='/other') == 404
+    assert post(server, b'not json') == 400
+    assert server.stats['rejected'] == 1
+    assert server.stats['invalid'] == 1
+
+
+def test_full_queue_applies_backpressure(make_server):
+    """Check that the server answers 503 instead of queueing without bound."""
+    started = threading.Event()
+    release = threading.Event()
+
+    def process(update):
+        started.set()
+        release.wait(5)
+
+    server = make_server(process, queue_size=1)
+
+    statuses = [post(server, UPDATE)]
+    assert started.wait(5)
+    statuses += [post(server, dict(UPDATE, update_id=i)) for i in range(3)]
+    release.set()
+
+    # One update is being handled, one waits in the queue
+    assert statuses == [200, 200, 503, 503]
+    assert server.stats['overflows'] == 2
+
+
+def test_missing_secret_rejects_everything(make_server):
+    """Check that a server without a secret accepts no updates."""
+    server = make_server(lambda update: None, secret='')
+
+    assert post(server, UPDATE, secret='') == 403
+    assert post(server, UPDATE) == 403
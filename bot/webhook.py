@@ -0,0 +1,137 @@
+"""Receive Telegram updates through a webhook.
+
+A small stdlib HTTP server checks the secret token, decodes each update
+and puts it on a bounded queue that handler workers drain. Telegram gets
+200 as soon as the update is queued. When the queue is full the server
+answers 503, and Telegram keeps the update and delivers it again later.
+"""
+import hmac
+import json
+import logging
+import os
+import queue
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import types
+
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+# Updates accepted but not yet handled
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+# Threads taking updates off the queue. bot_main passes them on to its
+# per-chat dispatcher, which keeps each chat in order
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 1))
+# Telegram updates are small; anything bigger is rejected unread
+MAX_BODY_BYTES = 1024 * 1024
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    server_version = 'ExpenseBot'
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        server = self.server.webhook
+        if self.path != server.path:
+            return self._reply(HTTPStatus.NOT_FOUND)
+        secret = self.headers.get(SECRET_HEADER, '')
+        # Without a secret anyone could post updates, so nothing is accepted
+        if not server.secret or not hmac.compare_digest(secret, server.secret):
+            server.stats['rejected'] += 1
+            return self._reply(HTTPStatus.FORBIDDEN)
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_BYTES:
+            return self._reply(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        try:
+            update = types.Update.de_json(json.loads(self.rfile.read(length)))
+        except Exception:
+            server.stats['invalid'] += 1
+            return self._reply(HTTPStatus.BAD_REQUEST)
+
+        try:
+            server.queue.put_nowait(update)
+        except queue.Full:
+            server.stats['overflows'] += 1
+            return self._reply(HTTPStatus.SERVICE_UNAVAILABLE)
+        server.stats['accepted'] += 1
+        self._reply(HTTPStatus.OK)
+
+    def log_message(self, format, *args):
+        logging.debug(f'Webhook {self.address_string()}: {format % args}')
+
+
+class WebhookServer:
+    """HTTP server that queues updates for process(update) workers."""
+
+    def __init__(self, process, host=WEBHOOK_HOST, port=WEBHOOK_PORT,
+                 path=WEBHOOK_PATH, secret=WEBHOOK_SECRET,
+                 queue_size=WEBHOOK_QUEUE_SIZE, workers=WEBHOOK_WORKERS):
+        self.process = process
+        self.path = path
+        self.secret = secret
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats = {
+            'accepted': 0,
+            'rejected': 0,
+            'invalid': 0,
+            'overflows': 0,
+            'errors': 0,
+        }
+        self.httpd = ThreadingHTTPServer((host, port), _RequestHandler)
+        self.httpd.webhook = self
+        self._threads = [
+            threading.Thread(
+                target=self._work, name=f'webhook-worker-{i}', daemon=True
+            )
+            for i in range(workers)
+        ]
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def _work(self):
+        while True:
+            update = self.queue.get()
+            try:
+                if update is None:
+                    return
+                self.process(update)
+            except Exception:
+                self.stats['errors'] += 1
+                logging.exception(f'Error processing update {update.update_id}')
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        """Start the workers and serve requests in a background thread."""
+        for thread in self._threads:
+            thread.start()
+        threading.Thread(
+            target=self.httpd.serve_forever, name='webhook-server', daemon=True
+        ).start()
+
+    def serve_forever(self):
+        """Start the workers and serve requests until stop() is called."""
+        for thread in self._threads:
+            thread.start()
+        self.httpd.serve_forever()
+
+    def stop(self):
+        """Stop accepting updates and let the workers finish the queue."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()